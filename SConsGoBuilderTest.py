@@ -1,7 +1,15 @@
 import collections
+import hashlib
+import imp
+import io
 import os.path
+import shutil
+import tempfile
 
 import unittest
+import SCons.Environment
+import SCons.Errors
+import SCons.SConsign
 import GoBuilder
 import TestUnit
 
@@ -46,6 +54,22 @@ class GoDummyNode(object):
         return self.contents
 
 
+class GoDummyFileNode(GoDummyNode):
+    """
+    Dummy test Node backed by a real file on disk
+    """
+    def __init__(self, path):
+        GoDummyNode.__init__(self, name=os.path.basename(path))
+        self.abspath = path
+
+    def get_contents(self):
+        with open(self.abspath, 'r') as f:
+            return f.read()
+
+    def get_content_hash(self):
+        return hashlib.md5(self.get_contents().encode('utf-8')).hexdigest()
+
+
 class TestImportParsing(unittest.TestCase):
 
     def test_single_line_imports(self):
@@ -53,23 +77,77 @@ class TestImportParsing(unittest.TestCase):
             test_node=GoDummyNode(name='xyz.go', contents=sli.read())
 
             GoBuilder.parse_file(None, test_node)
-            self.assertEqual(test_node.attributes.go_packages,['sli'])
+            self.assertEqual(test_node.attributes.go_scan.packages, ('sli',))
 
     def test_multi_line_imports(self):
         test_node = GoDummyNode(name='xyz.go', contents="import (\n\t\"mli\"\n\t)")
         GoBuilder.parse_file(None,test_node)
-        self.assertEqual(test_node.attributes.go_packages, ['mli'])
+        self.assertEqual(test_node.attributes.go_scan.packages, ('mli',))
 
     def test_single_line_namespace_import(self):
         test_node=GoDummyNode(name='xyz.go', contents="package main\nimport abc \"slni\"\n")
 
         GoBuilder.parse_file(None, test_node)
-        self.assertEqual(test_node.attributes.go_packages,['slni'])
+        self.assertEqual(test_node.attributes.go_scan.packages, ('slni',))
 
     def test_multi_line_namespace_imports(self):
         test_node = GoDummyNode(name='xyz.go', contents="import (\n\tabc\"mlni\"\n\t)")
         GoBuilder.parse_file(None, test_node)
-        self.assertEqual(test_node.attributes.go_packages, ['mlni'])
+        self.assertEqual(test_node.attributes.go_scan.packages, ('mlni',))
+
+    def test_records_shared(self):
+        contents = "// +build wolf\n\npackage x\nimport (\n\t\"fmt\"\n\t\"lib/shared\"\n)\n"
+        a = GoDummyNode(name='a.go', contents=contents)
+        b = GoDummyNode(name='b.go', contents=contents[:])
+        GoBuilder.parse_file(None, a)
+        GoBuilder.parse_file(None, b)
+        self.assertTrue(a.attributes.go_scan is b.attributes.go_scan)
+        self.assertTrue(a.attributes.go_scan.constraint is b.attributes.go_scan.constraint)
+
+        c = GoDummyNode(name='c.go', contents="package x\nimport \"lib/shared\"\n")
+        GoBuilder.parse_file(None, c)
+        self.assertTrue(c.attributes.go_scan.packages[0] is a.attributes.go_scan.packages[1])
+        self.assertEqual(c.attributes.go_scan.constraint, None)
+
+
+class TestHeaderParsing(unittest.TestCase):
+
+    @staticmethod
+    def _parse(contents, chunk_size=None):
+        if chunk_size:
+            chunks = [contents[i:i+chunk_size] for i in range(0, len(contents), chunk_size)]
+        else:
+            chunks = [contents]
+        return GoBuilder._parse_go_header(GoBuilder.GoHeaderLexer(chunks))
+
+    def test_stops_at_first_declaration(self):
+        (packages, build_statements, go_build) = self._parse('package main\nimport "a"\nfunc main() {\n'
+                                                   '\ts := `import "b"`\n}\nimport "c"\n// +build d\n')
+        self.assertEqual(packages, ['a'])
+        self.assertEqual(build_statements, [])
+
+    def test_comments_and_named_imports(self):
+        contents = ('// +build linux\n\n/* import "x" */\npackage main // trailing\n\n'
+                    'import (\n\t// import "y"\n\t. "dot"\n\t_ "blank"\n\tm `raw/path`\n)\n'
+                    'import "C"\nvar x = 1\n')
+        (packages, build_statements, go_build) = self._parse(contents)
+        self.assertEqual(packages, ['dot', 'blank', 'raw/path', 'C'])
+        self.assertEqual(build_statements, ['linux'])
+        self.assertEqual(go_build, None)
+
+    def test_go_build_line(self):
+        (packages, build_statements, go_build) = self._parse('//go:build linux && !cgo\n// +build linux,!cgo\n\n'
+                                                             'package main\n')
+        self.assertEqual(build_statements, ['linux,!cgo'])
+        self.assertEqual(go_build, 'linux && !cgo')
+
+    def test_small_chunks(self):
+        contents = ('// +build linux,amd64\n/* a long\n comment */\npackage example\n'
+                    'import (\n\tabc "github.com/a/b"\n\t"fmt"\n)\nconst x = "y"\n')
+        for chunk_size in (1, 2, 3, 7):
+            (packages, build_statements, go_build) = self._parse(contents, chunk_size)
+            self.assertEqual(packages, ['github.com/a/b', 'fmt'], 'chunk size %d' % chunk_size)
+            self.assertEqual(build_statements, ['linux,amd64'], 'chunk size %d' % chunk_size)
 
 
 class TestBuildTagParsing(unittest.TestCase):
@@ -84,7 +162,7 @@ class TestBuildTagParsing(unittest.TestCase):
     def test_single_build_tag_parse(self):
         test_node = TestBuildTagParsing._load_single_build_node()
 
-        self.assertEqual(test_node.attributes.go_build_statements,['wolf'])
+        self.assertEqual(test_node.attributes.go_scan.build_statements, ('wolf',))
 
     def test_single_build_tag_positive_eval(self):
         test_node = TestBuildTagParsing._load_single_build_node()
@@ -264,11 +342,1048 @@ class TestBuildTagParsing(unittest.TestCase):
         self.assertFalse(include_file, 'Failed testing negative for two line space ORed build tags')
 
 
+class TestBuildConstraints(unittest.TestCase):
+
+    @staticmethod
+    def _eval(contents, **kw):
+        test_node = GoDummyNode(name='xyz.go', contents=contents)
+        GoBuilder.parse_file(None, test_node)
+        return GoBuilder._eval_build_statements(GoDummyEnv(**kw), test_node)
+
+    def test_go_build_expression(self):
+        contents = '//go:build linux && (amd64 || arm64) && !purego\n\npackage testfiles\n'
+        self.assertTrue(self._eval(contents))
+        self.assertTrue(self._eval(contents, goarch='arm64'))
+        self.assertFalse(self._eval(contents, goarch='386'))
+        self.assertFalse(self._eval(contents, gotags=['purego']))
+
+    def test_go_build_takes_precedence(self):
+        contents = '//go:build wolf\n// +build !wolf\n\npackage testfiles\n'
+        self.assertTrue(self._eval(contents, gotags=['wolf']))
+
+    def test_invalid_go_build_excludes_file(self):
+        self.assertFalse(self._eval('//go:build linux &&\n\npackage testfiles\n'))
+
+    def test_go_version_tags_past_go1_7(self):
+        self.assertTrue(self._eval('//go:build go1.21 && unix\n\npackage testfiles\n', goversion='go1.21.6'))
+        self.assertFalse(self._eval('//go:build go1.22\n\npackage testfiles\n', goversion='go1.21.6'))
+
+    def test_identical_constraints_shared(self):
+        self.assertTrue(GoBuilder.compile_build_constraint(['wolf bear']) is
+                        GoBuilder.compile_build_constraint(['wolf bear']))
+        self.assertEqual(GoBuilder.compile_build_constraint([]), None)
+
+
+class TestScanCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.tmpdir, 'cache')
+        self.go_file = os.path.join(self.tmpdir, 'a.go')
+        self._write('package a\n\n// +build wolf\n\nimport "one"\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, contents):
+        with open(self.go_file, 'w') as f:
+            f.write(contents)
+
+    def _scan(self, cache):
+        node = GoDummyFileNode(self.go_file)
+        if not cache.fetch(node):
+            GoBuilder.parse_file(None, node)
+            cache.store(node)
+        return node
+
+    def test_hit_after_reload(self):
+        cache = GoBuilder.GoScanCache(self.cache_file)
+        self._scan(cache)
+        cache.save()
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+        cache = GoBuilder.GoScanCache(self.cache_file)
+        node = self._scan(cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        self.assertEqual(node.attributes.go_scan.packages, ('one',))
+        self.assertEqual(node.attributes.go_scan.build_statements, ('wolf',))
+
+    def test_miss_after_change(self):
+        cache = GoBuilder.GoScanCache(self.cache_file)
+        self._scan(cache)
+        self._write('package a\n\nimport "two"\n')
+        node = self._scan(cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        self.assertEqual(node.attributes.go_scan.packages, ('two',))
+
+    def test_null_build_not_written(self):
+        os.utime(self.go_file, (1000000000, 1000000000))
+        cache = GoBuilder.GoScanCache(self.cache_file, max_age=4)
+        self._scan(cache)
+        cache.save()
+        for i in range(4):
+            cache = GoBuilder.GoScanCache(self.cache_file, max_age=4)
+            self._scan(cache)
+            self.assertEqual(cache.hits, 1)
+            # Used but only marked as such every max_age / 2 generations
+            self.assertEqual(cache.dirty, i % 2 == 1, i)
+            cache.dirty = True
+            cache.save()
+        self.assertEqual(cache.stats()['entries'], 1)
+
+    def test_stale_entries_evicted(self):
+        cache = GoBuilder.GoScanCache(self.cache_file, max_age=1)
+        self._scan(cache)
+        cache.save()
+        for i in range(2):
+            cache = GoBuilder.GoScanCache(self.cache_file, max_age=1)
+            cache.fetch(GoDummyFileNode(os.path.join(self.tmpdir, 'missing.go')))
+            cache.dirty = True
+            cache.save()
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertEqual(cache.evicted, 1)
+
+
+class TestPackageIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pkgdir = os.path.join(self.tmpdir, 'src', 'pkg')
+        os.makedirs(self.pkgdir)
+        for name in ('a.go', 'a_test.go', 'b_windows.go'):
+            self._write(name)
+        self.env = SCons.Environment.Environment(tools=[], GOOS='linux', GOARCH='amd64',
+                                                 GOTAGS=[], GOVERSION='1.6')
+        self.path = (self.env.Dir(self.tmpdir),)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name):
+        with open(os.path.join(self.pkgdir, name), 'w') as f:
+            f.write('package pkg\n')
+
+    def test_filtered_and_memoized(self):
+        index = GoBuilder.GoPackageIndex()
+        files = index.package_files(self.env, 'pkg', self.path)
+        self.assertEqual([f.name for f in files], ['a.go'])
+        self.assertTrue(index.package_files(self.env, 'pkg', self.path) is files)
+        self.assertEqual(index.package_files(self.env, 'missing', self.path), [])
+
+    def test_invalidated_by_directory_mtime(self):
+        index = GoBuilder.GoPackageIndex()
+        index.package_files(self.env, 'pkg', self.path)
+        self._write('c.go')
+        mtime = os.stat(self.pkgdir).st_mtime + 10
+        os.utime(self.pkgdir, (mtime, mtime))
+        files = index.package_files(self.env, 'pkg', self.path)
+        self.assertEqual([f.name for f in files], ['a.go', 'c.go'])
+
+    def test_package_node(self):
+        os.makedirs(os.path.join(self.tmpdir, 'src', 'dep'))
+        with open(os.path.join(self.tmpdir, 'src', 'dep', 'dep.go'), 'w') as f:
+            f.write('package dep\n')
+        with open(os.path.join(self.pkgdir, 'a.go'), 'w') as f:
+            f.write('package pkg\nimport (\n\t"fmt"\n\t"dep"\n)\n')
+        self.env['GO_SYSTEM_PACKAGES'] = frozenset(['fmt'])
+
+        index = GoBuilder.GoPackageIndex()
+        node = index.package_node(self.env, 'pkg', self.path)
+        dep = index.package_node(self.env, 'dep', self.path)
+        self.assertTrue(index.package_node(self.env, 'pkg', self.path) is node)
+        self.assertEqual([str(c) for c in node.children()],
+                         [os.path.join(self.pkgdir, 'a.go'), str(dep)])
+        self.assertEqual(dep.attributes.go_import_path, 'dep')
+        self.assertEqual(index.package_node(self.env, 'missing', self.path), None)
+
+    def test_invalidate(self):
+        os.makedirs(os.path.join(self.tmpdir, 'src', 'dep'))
+        with open(os.path.join(self.tmpdir, 'src', 'dep', 'dep.go'), 'w') as f:
+            f.write('package dep\n')
+        with open(os.path.join(self.pkgdir, 'a.go'), 'w') as f:
+            f.write('package pkg\nimport "dep"\n')
+        self.env['GO_SYSTEM_PACKAGES'] = frozenset()
+
+        index = GoBuilder.GoPackageIndex()
+        node = index.package_node(self.env, 'pkg', self.path)
+        self.assertEqual(len(node.children()), 2)
+
+        # The package no longer imports dep
+        self._write('a.go')
+        index.invalidate([self.pkgdir])
+        self.assertTrue(index.package_node(self.env, 'pkg', self.path) is node)
+        self.assertEqual([str(c) for c in node.children()], [os.path.join(self.pkgdir, 'a.go')])
+
+    def test_invalidate_importers_only(self):
+        for (name, imports) in (('dep', ''), ('other', ''), ('pkg', 'import "dep"\n')):
+            if not os.path.isdir(os.path.join(self.tmpdir, 'src', name)):
+                os.makedirs(os.path.join(self.tmpdir, 'src', name))
+            with open(os.path.join(self.tmpdir, 'src', name, name + '.go'), 'w') as f:
+                f.write('package %s\n%s' % (name, imports))
+        os.unlink(os.path.join(self.pkgdir, 'a.go'))
+        self.env['GO_SYSTEM_PACKAGES'] = frozenset()
+
+        index = GoBuilder.GoPackageIndex()
+        index.package_node(self.env, 'pkg', self.path)
+        index.package_node(self.env, 'other', self.path)
+        index.invalidate([os.path.join(self.tmpdir, 'src', 'dep')])
+        self.assertEqual(sorted(index.nodes), [os.path.join(self.tmpdir, 'src', 'other')])
+
+        # A new vendored copy takes precedence for the packages under it
+        node = index.package_node(self.env, 'pkg', self.path)
+        vendored = os.path.join(self.pkgdir, 'vendor', 'dep')
+        os.makedirs(vendored)
+        with open(os.path.join(vendored, 'dep.go'), 'w') as f:
+            f.write('package dep\n')
+        index.resolver.forget_vendor_scopes()
+        index.invalidate([vendored])
+        self.assertTrue(index.package_node(self.env, 'pkg', self.path) is node)
+        self.assertEqual(node.children()[1].attributes.go_import_path, 'pkg/vendor/dep')
+
+
+class TestWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self._write('a.go')
+        self.watcher = GoBuilder.GoWatcher([self.tmpdir], interval=0)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, content='package a\n'):
+        with open(os.path.join(self.tmpdir, name), 'w') as f:
+            f.write(content)
+
+    def test_changes(self):
+        self.assertEqual(self.watcher.changes(), set())
+        self._write('a.go', 'package a\nimport "b"\n')
+        self._write('b.go')
+        self._write('notes.txt')
+        os.unlink(os.path.join(self.tmpdir, 'a.go'))
+        self._write('a.go', 'package a\n\n')
+        self.assertEqual(self.watcher.changes(1),
+                         set(os.path.join(self.tmpdir, n) for n in ('a.go', 'b.go')))
+        self.assertEqual(self.watcher.changes(), set())
+
+
+class TestImportResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, contents=''):
+        path = os.path.join(self.tmpdir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+        return path
+
+    def test_parse_mod_file(self):
+        mod = GoBuilder._parse_mod_file(self._write('go.mod', '\n'.join([
+            'module example.com/m // the main module',
+            'go 1.21',
+            'require example.com/a v1.0.0',
+            'require (',
+            '\t"example.com/b" v1.2.0 // indirect',
+            ')',
+            'replace example.com/a => ../a',
+            'replace (',
+            '\texample.com/b v1.2.0 => example.com/c v1.3.0',
+            ')'])))
+        self.assertEqual(mod['module'], 'example.com/m')
+        self.assertEqual(mod['go'], '1.21')
+        self.assertEqual(mod['require'], {'example.com/a': 'v1.0.0', 'example.com/b': 'v1.2.0'})
+        self.assertEqual(mod['replace'], {'example.com/a': ('../a', None),
+                                          'example.com/b': ('example.com/c', 'v1.3.0')})
+
+    def test_gopath_vendor_precedence(self):
+        src = os.path.join(self.tmpdir, 'src')
+        for d in ('app/sub', 'app/vendor/lib/v', 'lib/v', 'other'):
+            os.makedirs(os.path.join(src, d))
+        resolver = GoBuilder.GoImportResolver(None, [src])
+
+        scope = resolver.vendor_scope(os.path.join(src, 'app', 'sub'))
+        self.assertEqual(scope, (os.path.join(src, 'app', 'vendor'),))
+        self.assertEqual(resolver.candidates('lib/v', scope),
+                         [(os.path.join(src, 'app', 'vendor', 'lib', 'v'), 'app/vendor/lib/v'),
+                          (os.path.join(src, 'lib', 'v'), 'lib/v')])
+        scope = resolver.vendor_scope(os.path.join(src, 'other'))
+        self.assertEqual(resolver.candidates('lib/v', scope), [(os.path.join(src, 'lib', 'v'), 'lib/v')])
+
+    def test_module_precedence(self):
+        mod_file = self._write('m/go.mod', '\n'.join([
+            'module example.com/m',
+            'require (',
+            '\texample.com/m/nested v1.0.0',
+            '\texample.com/dep v1.2.0',
+            '\texample.com/Up v1.0.0',
+            ')',
+            'replace example.com/dep => ../dep']))
+        root = os.path.dirname(mod_file)
+        resolver = GoBuilder.GoImportResolver(None, [], mod_file, modcache=lambda: '/modcache')
+
+        self.assertEqual(resolver.candidates('example.com/m/a/b'), [(os.path.join(root, 'a', 'b'), 'example.com/m/a/b')])
+        self.assertEqual(resolver.candidates('example.com/m/nested/c')[0][0], '/modcache/example.com/m/nested@v1.0.0/c')
+        self.assertEqual(resolver.candidates('example.com/dep/y'), [(os.path.join(self.tmpdir, 'dep', 'y'), 'example.com/dep/y')])
+        self.assertEqual(resolver.candidates('example.com/Up'), [('/modcache/example.com/!up@v1.0.0', 'example.com/Up')])
+        self.assertEqual(resolver.candidates('example.com/unknown'), [])
+
+        self._write('m/vendor/modules.txt')
+        resolver = GoBuilder.GoImportResolver(None, [], mod_file, modcache=lambda: '/modcache')
+        self.assertEqual(resolver.candidates('example.com/dep/y'),
+                         [(os.path.join(root, 'vendor', 'example.com', 'dep', 'y'), 'example.com/dep/y')])
+        self.assertEqual(resolver.candidates('example.com/m/a')[0][0], os.path.join(root, 'a'))
+
+    def test_workspace(self):
+        self._write('a/go.mod', 'module example.com/a\nrequire example.com/b v1.0.0\n')
+        self._write('b/go.mod', 'module example.com/b\n')
+        work_file = self._write('go.work', 'use (\n\t./a\n\t./b\n)\n')
+        resolver = GoBuilder.GoImportResolver(None, [], work_file=work_file, modcache=lambda: '/modcache')
+        self.assertEqual(resolver.candidates('example.com/b/x'), [(os.path.join(self.tmpdir, 'b', 'x'), 'example.com/b/x')])
+
+
+class TestGoListBackend(unittest.TestCase):
+
+    class CannedGraph(GoBuilder.GoListGraph):
+        def __init__(self, packages):
+            GoBuilder.GoListGraph.__init__(self, 'go-list-test', ())
+            self.canned = packages
+            self.calls = []
+
+        def _go_list(self, env, dir_path):
+            self.calls.append(dir_path)
+            return self.canned
+
+    def test_iter_json_values(self):
+        stream = io.BytesIO(b'{"ImportPath": "a", "Imports": ["b"]}\n{"ImportPath": "b"}\n')
+        self.assertEqual(list(GoBuilder._iter_json_values(stream, chunk_size=5)),
+                         [{'ImportPath': 'a', 'Imports': ['b']}, {'ImportPath': 'b'}])
+        self.assertRaises(ValueError, list, GoBuilder._iter_json_values(io.BytesIO(b'{"ImportPath": ')))
+
+    def test_graph(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            app = os.path.join(tmpdir, 'src', 'app')
+            lib = os.path.join(tmpdir, 'src', 'lib')
+            for d in (app, lib):
+                os.makedirs(d)
+            env = SCons.Environment.Environment(tools=[], GOTAGS=[])
+            graph = self.CannedGraph([
+                {'ImportPath': 'fmt', 'Standard': True},
+                {'ImportPath': 'lib', 'Dir': lib, 'GoFiles': ['lib.go']},
+                {'ImportPath': 'app', 'Dir': app, 'GoFiles': ['main.go'], 'Imports': ['fmt', 'lib']},
+            ])
+            main = env.File(os.path.join(app, 'main.go'))
+            self.assertTrue(graph.includes(env, main))
+            self.assertFalse(graph.includes(env, env.File(os.path.join(app, 'main_windows.go'))))
+
+            deps = graph.imported_nodes(env, main)
+            self.assertEqual(len(deps), 1)
+            self.assertEqual(deps[0].attributes.go_import_path, 'lib')
+            self.assertEqual([str(c) for c in deps[0].children()], [os.path.join(lib, 'lib.go')])
+            # lib was listed as a dependency of app
+            self.assertEqual(graph.imported_nodes(env, env.File(os.path.join(lib, 'lib.go'))), [])
+            self.assertEqual(graph.calls, [app])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_errors(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            app = os.path.join(tmpdir, 'app')
+            os.makedirs(app)
+            env = SCons.Environment.Environment(tools=[], GOTAGS=[])
+            graph = self.CannedGraph([
+                {'ImportPath': 'missing', 'Error': {'Err': 'cannot find package "missing"'}},
+                {'ImportPath': '_' + app, 'Dir': app, 'GoFiles': ['main.go'], 'Imports': ['missing'],
+                 'DepsErrors': [{'Err': 'cannot find package "missing"'}]},
+            ])
+            # Left to the compiler to report
+            self.assertEqual(graph.imported_nodes(env, env.File(os.path.join(app, 'main.go'))), [])
+
+            env = SCons.Environment.Environment(tools=[], GOTAGS=[], GO='false', GOVERSION='go1.21')
+            self.assertRaises(SCons.Errors.UserError, GoBuilder.GoListGraph('go-list-test', ())._go_list, env, app)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_module_signature(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            app = os.path.join(tmpdir, 'app')
+            os.makedirs(os.path.join(tmpdir, 'vendor'))
+            os.makedirs(app)
+            self.assertEqual(GoBuilder._module_signature(app), ())
+            for name in ('go.mod', os.path.join('vendor', 'modules.txt')):
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write('module app\n')
+                os.utime(os.path.join(tmpdir, name), (1000000000, 1000000000))
+            self.assertEqual([f for (f, size, mtime) in GoBuilder._module_signature(app)],
+                             [os.path.join(tmpdir, 'go.mod'), os.path.join(tmpdir, 'vendor', 'modules.txt')])
+            # Just written, can't be trusted yet
+            open(os.path.join(app, 'go.work'), 'w').close()
+            self.assertEqual(GoBuilder._module_signature(app), None)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestSystemPackages(unittest.TestCase):
+
+    def test_list_goroot_packages(self):
+        goroot = tempfile.mkdtemp()
+        try:
+            for d in ('fmt', 'net/http', 'net/http/testdata', 'cmd/go', 'vendor/golang.org/x/net',
+                      'internal/_skip', 'nogo'):
+                os.makedirs(os.path.join(goroot, 'src', d))
+                if d != 'nogo':
+                    open(os.path.join(goroot, 'src', d, 'x.go'), 'w').close()
+            packages = GoBuilder._list_goroot_packages(goroot)
+            self.assertEqual(sorted(packages), ['fmt', 'net/http'])
+            self.assertEqual(GoBuilder._list_goroot_packages(os.path.join(goroot, 'missing')), None)
+        finally:
+            shutil.rmtree(goroot)
+
+    def test_is_not_go_standard_library(self):
+        env = GoDummyEnv()
+        env['GO_SYSTEM_PACKAGES'] = frozenset(['fmt', 'net/http', 'C'])
+        self.assertFalse(GoBuilder.is_not_go_standard_library(env, 'net/http'))
+        self.assertFalse(GoBuilder.is_not_go_standard_library(env, 'C'))
+        self.assertTrue(GoBuilder.is_not_go_standard_library(env, 'lib/greet'))
+        self.assertTrue(GoBuilder.is_not_go_standard_library(env, 'github.com/a/fmt'))
+
+
+class TestToolchain(unittest.TestCase):
+
+    def test_shared_across_environments_and_clones(self):
+        env = SCons.Environment.Environment(tools=[], GO='go-test-binary', ENV={'PATH': '/bin'})
+        toolchain = GoBuilder._get_toolchain(env)
+        self.assertTrue(GoBuilder._get_toolchain(env.Clone()) is toolchain)
+        other = SCons.Environment.Environment(tools=[], GO='go-test-binary', ENV={'PATH': '/bin'})
+        self.assertTrue(GoBuilder._get_toolchain(other) is toolchain)
+        other['ENV']['GOPATH'] = '/tmp'
+        self.assertFalse(GoBuilder._get_toolchain(other.Clone()) is toolchain)
+        # ENV differing only by the job budget's settings shares it
+        budget_env = other.Clone(ENV=GoBuilder._go_budget_env(other, 4))
+        self.assertTrue(GoBuilder._get_toolchain(budget_env) is GoBuilder._get_toolchain(other))
+        budget_env['ENV']['GOFLAGS'] = '-mod=vendor -p=4'
+        self.assertFalse(GoBuilder._get_toolchain(budget_env) is GoBuilder._get_toolchain(other))
+        # and so does the ENV of go tool invocations, with the target platform
+        target_env = other.Clone(GOOS='windows', GOARCH='386', CGO_ENABLED='1', CC='clang')
+        target_env['ENV'] = GoBuilder._go_target_env(target_env)
+        self.assertTrue(GoBuilder._get_toolchain(target_env) is GoBuilder._get_toolchain(other))
+
+    def test_lazy_variables(self):
+        env = SCons.Environment.Environment(tools=[], GO='go-lazy-binary', ENV={},
+                                            GOHOSTOS=GoBuilder.GoToolchainVariable('GOHOSTOS'),
+                                            CGO_ENABLED=GoBuilder.GoToolchainVariable('CGO_ENABLED'),
+                                            GOOS='$GOHOSTOS')
+        toolchain = GoBuilder._get_toolchain(env)
+        # Pretend the toolchain has been probed
+        toolchain._values = {'GOHOSTOS': 'plan9', 'CGO_ENABLED': '0'}
+        self.assertEqual(GoBuilder._go_var(env, 'GOOS'), 'plan9')
+        self.assertEqual(env.subst('$GOOS'), 'plan9')
+        self.assertFalse(GoBuilder._go_cgo_enabled(env))
+
+
+class TestPackageArchives(unittest.TestCase):
+
+    @staticmethod
+    def _archive(import_path, deps, std_imports):
+        archive = GoDummyNode(name=import_path + '.a')
+        archive.abspath = '/pkg/%s.a' % import_path
+        archive.attributes.go_import_path = import_path
+        archive.attributes.go_package_deps = deps
+        archive.attributes.go_std_imports = std_imports
+        return archive
+
+    def test_package_closure(self):
+        util = self._archive('lib/util', [], ['strings'])
+        greet = self._archive('lib/greet', [util], ['fmt'])
+        main = self._archive('main', [greet, util], ['fmt', 'os'])
+        (archives, std_imports) = GoBuilder._go_package_closure(main)
+        self.assertEqual(archives[0], main)
+        self.assertEqual(sorted(a.attributes.go_import_path for a in archives), ['lib/greet', 'lib/util', 'main'])
+        self.assertEqual(std_imports, set(['fmt', 'os', 'strings']))
+
+    def test_write_importcfg(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            importcfg = os.path.join(tmpdir, 'importcfg')
+            GoBuilder._go_write_importcfg(importcfg, {'lib/util': '/pkg/lib/util.a'},
+                                          {'fmt': '/cache/fmt-d', 'unsafe': ''})
+            with open(importcfg) as f:
+                self.assertEqual(f.read().splitlines()[1:],
+                                 ['packagefile lib/util=/pkg/lib/util.a', 'packagefile fmt=/cache/fmt-d'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_assembly_files(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for name in ('x.go', 'x_amd64.s', 'x_arm64.s'):
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    f.write('package x\n')
+            env = SCons.Environment.Environment(tools=[], GOOS='linux', GOARCH='amd64',
+                                                GOTAGS=[], GOVERSION='1.21', CGO_ENABLED=False)
+            self.assertEqual(GoBuilder._package_asm_files(env, env.Dir(tmpdir)), ['x_amd64.s'])
+            self.assertRaises(SCons.Errors.UserError, GoBuilder._go_package_archive, env, 'lib/x',
+                              [env.File(os.path.join(tmpdir, 'x.go'))], [], os.path.join(tmpdir, 'x.a'), [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestCgo(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.env = SCons.Environment.Environment(tools=[], GOOS='linux', GOARCH='amd64',
+                                                 GOTAGS=[], GOVERSION='1.21', CGO_ENABLED=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_directives(self):
+        path = os.path.join(self.tmpdir, 'x.go')
+        with open(path, 'w') as f:
+            f.write('package x\n\n'
+                    '/*\n#cgo CFLAGS: -DA=1 -I${SRCDIR}/include\n'
+                    '#cgo windows LDFLAGS: -lws2_32\n*/\n'
+                    '// #cgo linux,amd64 LDFLAGS: -lm\n'
+                    '// #include <math.h>\n'
+                    'import "C"\n\n'
+                    '// #cgo LDFLAGS: -lignored\n')
+        (name, cflags, ldflags) = GoBuilder._cgo_directives(self.env, [self.env.File(path)])
+        self.assertEqual(name, 'x')
+        self.assertEqual(cflags, ['-DA=1', '-I%s/include' % self.tmpdir])
+        self.assertEqual(ldflags, ['-lm'])
+
+    def test_flags_override(self):
+        self.env['CPPPATH'] = ['inc']
+        flags = self.env.ParseFlags('-O2 -DA=1 -Ifoo')
+        overrides = GoBuilder._cgo_flags_override(self.env, flags, CPPPATH=['objdir'])
+        self.assertEqual(overrides['CPPPATH'], ['objdir', 'inc', 'foo'])
+        self.assertEqual(overrides['CPPDEFINES'], [['A', '1']])
+        self.assertEqual(list(overrides['CCFLAGS']), ['-O2'])
+
+
+class TestTokenSignatures(unittest.TestCase):
+
+    source = ('package x\n\n'
+              'import "fmt"\n\n'
+              '// Hello greets\n'
+              'func Hello(n int) {\n'
+              '\tfor i := 0; i < n; i++ {\n'
+              '\t\tfmt.Println("hi") // greet\n'
+              '\t}\n'
+              '}\n')
+
+    def test_comments_and_formatting(self):
+        h = GoBuilder._go_token_hash
+        self.assertEqual(h(self.source), h(self.source.replace('// Hello greets\n', '')
+                                           .replace(' // greet', '/* greet */')))
+        self.assertEqual(h(self.source), h(self.source.replace('\t', '    ').replace(':=', ' := ')))
+        self.assertNotEqual(h(self.source), h(self.source.replace('"hi"', '"hello"')))
+        self.assertNotEqual(h(self.source), h(self.source.replace('i++', 'i--')))
+
+    def test_semicolons(self):
+        h = GoBuilder._go_token_hash
+        # Newlines only matter where go inserts a semicolon
+        self.assertEqual(h('x := f(a,\nb)\n'), h('x := f(a, b)\n'))
+        self.assertEqual(h('x := a +\nb\n'), h('x := a + b\n'))
+        self.assertNotEqual(h('return\nx\n'), h('return x\n'))
+        self.assertEqual(h('a := 1\nb := 2\n'), h('a := 1; b := 2\n'))
+        self.assertEqual(h('a := 1 /* one\n */ b := 2\n'), h('a := 1\nb := 2\n'))
+
+    def test_significant_comments(self):
+        h = GoBuilder._go_token_hash
+        for directive in ('//go:build linux\n', '// +build linux\n', '//go:embed x.txt\n',
+                          '//go:generate stringer\n', '//export Hello\n'):
+            self.assertNotEqual(h(directive + self.source), h(self.source), directive)
+        cgo = 'package x\n\n// #include <%s.h>\nimport "C"\n'
+        self.assertNotEqual(h(cgo % 'a'), h(cgo % 'b'))
+        group = 'package x\n\nimport (\n\t"fmt"\n\t/*\n#include <%s.h>\n*/\n\t"C"\n)\n'
+        self.assertNotEqual(h(group % 'a'), h(group % 'b'))
+
+    def test_decider(self):
+        tmpdir = tempfile.mkdtemp()
+        sconsign_name = SCons.SConsign.DB_Name
+        env = SCons.Environment.Environment(tools=[], GO_SIGNATURES='content')
+        # Keep the signatures in tmpdir, rather than in the current directory
+        env.SConsignFile(os.path.join(tmpdir, '.sconsign'))
+        try:
+            path = os.path.join(tmpdir, 'x.go')
+            with open(path, 'w') as f:
+                f.write(self.source)
+            node = env.File(path)
+            target = env.Command(os.path.join(tmpdir, 'x.a'), node, 'true')[0]
+            self.assertEqual(GoBuilder._go_signature_env(env), None)
+            # Set after the tool was loaded
+            env['GO_SIGNATURES'] = 'tokens'
+            self.assertTrue(GoBuilder._package_alias(env, 'go-package:x').attributes.go_signature_env is env)
+            self.assertTrue(env.decide_source is GoBuilder.go_token_decider)
+            prev_ni = node.get_ninfo()
+            prev_ni.csig = node.get_csig()
+            self.assertFalse(GoBuilder.go_token_decider(node, target, prev_ni))
+
+            for (text, changed) in ((self.source.replace('// Hello greets', '// Hello says hi'), False),
+                                    (self.source.replace('"hi"', '"hello"'), True)):
+                with open(path, 'w') as f:
+                    f.write(text)
+                node = env.fs.File(path)
+                node.clear_memoized_values()
+                node.ninfo = None
+                self.assertEqual(GoBuilder.go_token_decider(node, target, prev_ni), changed, text)
+        finally:
+            SCons.SConsign.File(sconsign_name)
+            SCons.SConsign.DataBase.pop(env.fs.Top, None)
+            shutil.rmtree(tmpdir)
+
+
+    def test_previous_decider(self):
+        decided = []
+
+        def decider(dependency, target, prev_ni, repo_node=None):
+            decided.append(dependency)
+            return True
+
+        env = SCons.Environment.Environment(tools=[], GO_SIGNATURES='tokens')
+        env.Decider(decider)
+        self.assertTrue(GoBuilder._go_signature_env(env) is env)
+        self.assertTrue(env.decide_source is GoBuilder.go_token_decider)
+        target = env.Command('decider.a', ['decider.h', 'decider.go'], 'true')[0]
+        header = env.File('decider.h')
+        self.assertTrue(GoBuilder.go_token_decider(header, target, None))
+        env['GO_SIGNATURES'] = 'content'
+        source = env.File('decider.go')
+        self.assertTrue(GoBuilder.go_token_decider(source, target, None))
+        self.assertEqual(decided, [header, source])
+
+class TestBatchBuilds(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name in ('main.go', 'b.go', 'b_test.go', 'c_windows.go'):
+            with open(os.path.join(self.tmpdir, name), 'w') as f:
+                f.write('package main\n')
+        self.env = SCons.Environment.Environment(tools=[], GOOS='linux', GOARCH='amd64', GOTAGS=[],
+                                                 GOVERSION='1.21', GO='go', GOEXE='', GOBATCH=True,
+                                                 _go_tags_flag=GoBuilder._go_tags)
+        self.action = GoBuilder._GoBuildAction('$GOLINK', 'build')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _key(self, target, names, env=None):
+        env = env or self.env
+        return self.action.batch_key(env, [env.File(os.path.join(self.tmpdir, t)) for t in target],
+                                     [env.File(os.path.join(self.tmpdir, n)) for n in names])
+
+    def test_batch_key(self):
+        key = self._key(['one'], ['main.go', 'b.go'])
+        self.assertTrue(key)
+        self.assertEqual(self._key(['two'], ['b.go', 'main.go'], self.env.Clone()), key)
+        self.assertNotEqual(self._key(['one'], ['main.go', 'b.go'], self.env.Clone(GOTAGS=['x'])), key)
+        # Only programs built from the whole package directory are batched
+        self.assertEqual(self._key(['one'], ['main.go']), None)
+        self.assertEqual(self._key(['one', 'two'], ['main.go', 'b.go']), None)
+        self.assertEqual(self._key(['one'], ['main.go', 'b.go'], self.env.Clone(GOBATCH=False)), None)
+
+    def test_program_name(self):
+        self.assertEqual(GoBuilder._go_program_name('cmd/tool', False), 'tool')
+        self.assertEqual(GoBuilder._go_program_name('example.com/tool/v2', True), 'tool')
+        self.assertEqual(GoBuilder._go_program_name('example.com/tool/v1', True), 'v1')
+        self.assertEqual(GoBuilder._go_program_name('tool/v2', False), 'v2')
+
+
+class TestJobBudget(unittest.TestCase):
+
+    def test_share(self):
+        self.assertEqual(GoBuilder.GoJobBudget(16, jobs=1).acquire(), 16)
+        self.assertEqual(GoBuilder.GoJobBudget(16, jobs=4).acquire(), 4)
+        self.assertEqual(GoBuilder.GoJobBudget(16, jobs=32).acquire(), 1)
+        budget = GoBuilder.GoJobBudget(6, jobs=4)
+        self.assertEqual([budget.acquire() for i in range(4)], [1, 1, 1, 1])
+        budget = GoBuilder.GoJobBudget(3, jobs=2)
+        self.assertEqual(budget.acquire(), 1)
+        self.assertEqual(budget.acquire(), 1)
+        self.assertEqual(budget.acquire(), 1)
+        self.assertFalse(budget.fits())
+        budget.release(1)
+        self.assertTrue(budget.fits())
+
+    def test_memory(self):
+        budget = GoBuilder.GoJobBudget(8, memory=1000, jobs=8)
+        cpus = budget.acquire(600)
+        self.assertFalse(budget.fits(600))
+        self.assertTrue(budget.fits(400))
+        budget.release(cpus, 600)
+        # An action is always allowed to run alone
+        self.assertTrue(budget.fits(2000))
+
+    def test_env(self):
+        env = {'ENV': {'PATH': '/bin', 'GOFLAGS': '-mod=vendor'}}
+        self.assertEqual(GoBuilder._go_budget_env(env, 4),
+                         {'PATH': '/bin', 'GOFLAGS': '-mod=vendor -p=4', 'GOMAXPROCS': '4'})
+        self.assertEqual(env['ENV']['GOFLAGS'], '-mod=vendor')
+        self.assertEqual(GoBuilder._go_budget_env({'ENV': {}}, 1), {'GOFLAGS': '-p=1', 'GOMAXPROCS': '1'})
+
+
+    def test_disabled_by_default(self):
+        env = SCons.Environment.Environment(tools=[], GO='go', GOVERSION='go1.21', GOHOSTOS='linux',
+                                            GOHOSTARCH='amd64', GOOS='linux', GOARCH='amd64', GOROOT='/goroot',
+                                            GOTOOLDIR='/goroot/tool', GOEXE='', CGO_ENABLED='0', GO_SCAN_CACHE=None)
+        GoBuilder.generate(env)
+        budget = GoBuilder._budget
+        GoBuilder._budget = None
+        try:
+            self.assertEqual(GoBuilder._go_job_budget(env), None)
+        finally:
+            GoBuilder._budget = budget
+
+class TestGenerate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.env = SCons.Environment.Environment(tools=[], GOOS='linux', GOARCH='amd64')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_directives(self):
+        path = os.path.join(self.tmpdir, 'x.go')
+        with open(path, 'w') as f:
+            f.write('package x\n\n'
+                    '//go:generate stringer -type=Pill \n'
+                    '// //go:generate ignored\n'
+                    '//go:generate sh -c "echo $GOPACKAGE $GOFILE:$GOLINE \\"$GOOS\\"" $DOLLAR\n')
+        node = self.env.File(path)
+        directives = GoBuilder._go_generate_directives(node)
+        self.assertEqual(directives, [(3, '//go:generate stringer -type=Pill', 'stringer -type=Pill'),
+                                      (5, directives[1][1], directives[1][1][len('//go:generate '):])])
+        self.assertEqual(GoBuilder._go_generate_words(self.env, node, *directives[1][::2]),
+                         ['sh', '-c', 'echo x x.go:5 "linux"', '$'])
+
+    def test_outputs(self):
+        io = GoBuilder._go_generate_io
+        self.assertEqual(io(['stringer', '-type=Pill,Color']), (['pill_string.go'], []))
+        self.assertEqual(io(['stringer', '-type', 'Pill', '-output', 'p.go']), (['p.go'], []))
+        self.assertEqual(io(['mockgen', '-source=a.go', '-destination=mocks/a.go']), (['mocks/a.go'], []))
+        self.assertEqual(io(['go', 'run', './gen', '-o', 'gen.go']), (['gen.go'], []))
+        self.assertEqual(io(['protoc', '-I', 'proto', '--go_out=.', '--go_opt=paths=source_relative',
+                             '--go-grpc_out=paths=source_relative:api', 'proto/svc.proto']),
+                         (['svc.pb.go', os.path.join('api', 'svc_grpc.pb.go')], ['proto/svc.proto']))
+        self.assertEqual(io(['protoc', '--go_out=.', 'svc.proto']), ([], ['svc.proto']))
+        self.assertEqual(io(['echo', 'hi']), ([], []))
+
+    def test_re2_escape(self):
+        self.assertEqual(GoBuilder._re2_escape('//go:generate a.sh -x=(1|2) $X'),
+                         r'//go:generate a\.sh -x=\(1\|2\) \$X')
+
+
+class TestReproducible(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.go = os.path.join(self.tmpdir, 'go')
+        with open(self.go, 'w') as f:
+            f.write('#!/bin/sh\n')
+        self.env = SCons.Environment.Environment(tools=[], GO=self.go, GOVERSION='go1.21.6', GOOS='linux',
+                                                 GOARCH='amd64', CGO_ENABLED=False, GOROOT='/usr/local/go',
+                                                 GOPATH=[os.path.join(self.tmpdir, 'gopath')],
+                                                 ENV={'GOMODCACHE': os.path.join(self.tmpdir, 'modcache')})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_normalize_paths(self):
+        top = self.env.Dir('#').abspath
+        text = ' '.join([os.path.join(self.tmpdir, 'gopath', 'src', 'a'), os.path.join(self.tmpdir, 'modcache', 'm@v1'),
+                         '/usr/local/go/src/fmt', os.path.join(top, 'src', 'b')])
+        self.assertEqual(GoBuilder._go_normalize_paths(self.env, text),
+                         ' '.join(['$GOPATH0/src/a', '$GOMODCACHE/m@v1', '$GOROOT/src/fmt', '#/src/b']))
+        self.assertEqual(GoBuilder._go_path_prefixes(self.env),
+                         [(os.path.join(self.tmpdir, 'gopath', 'src'), ''), (os.path.join(self.tmpdir, 'modcache'), ''),
+                          (top, '')])
+
+    def test_signature(self):
+        path = os.path.join(self.tmpdir, 'gopath', 'src', 'a')
+        signature = GoBuilder._go_action_signature(self.env, 'go build ' + path)
+        self.assertEqual(signature, 'go build %s\n%s go1.21.6 linux/amd64 cgo=0'
+                         % (path, hashlib.md5(b'#!/bin/sh\n').hexdigest()))
+        self.env['GO_REPRODUCIBLE'] = True
+        self.assertTrue(GoBuilder._go_action_signature(self.env, 'go build ' + path).startswith('go build $GOPATH0/src/a\n'))
+
+        # A different toolchain or platform changes every signature
+        self.assertNotEqual(GoBuilder._go_action_signature(self.env.Clone(GOARCH='arm64'), 'go'),
+                            GoBuilder._go_action_signature(self.env, 'go'))
+        before = GoBuilder._go_action_signature(self.env, 'go')
+        with open(self.go, 'a') as f:
+            f.write('exit 0\n')
+        self.assertNotEqual(GoBuilder._go_action_signature(self.env, 'go'), before)
+
+
+class TestPrescan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for (d, name, contents) in (('src/a', 'a.go', 'package a\nimport "b"\n'),
+                                    ('src/b', 'b.go', '// +build wolf\npackage b\nimport ("fmt")\n'),
+                                    ('src/b', 'b_test.go', 'package b\nimport "testing"\n'),
+                                    ('src/b/testdata', 'c.go', 'package c\n')):
+            if not os.path.isdir(os.path.join(self.tmpdir, d)):
+                os.makedirs(os.path.join(self.tmpdir, d))
+            with open(os.path.join(self.tmpdir, d, name), 'w') as f:
+                f.write(contents)
+        self.env = SCons.Environment.Environment(tools=[], GOPATH=[self.tmpdir], GO_SCAN_JOBS=2,
+                                                 GO_SCAN_BATCH=1, GO_SCAN_ROOTS=[])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_prescan_fills_attributes(self):
+        self.assertEqual(GoBuilder.goPrescan(self.env), 2)
+        a = self.env.File(os.path.join(self.tmpdir, 'src', 'a', 'a.go'))
+        b = self.env.File(os.path.join(self.tmpdir, 'src', 'b', 'b.go'))
+        self.assertEqual(a.attributes.go_scan.packages, ('b',))
+        self.assertEqual(b.attributes.go_scan.packages, ('fmt',))
+        self.assertEqual(b.attributes.go_scan.build_statements, ('wolf',))
+        # Prescanned files aren't parsed again
+        self.assertEqual(GoBuilder.goPrescan(self.env), 0)
+
+
+class TestTestFiles(unittest.TestCase):
+
+    def test_test_files_included_on_request(self):
+        env = GoDummyEnv(goos='linux', goarch='amd64')
+
+        def include(name, tests=False):
+            node = GoDummyNode(name=name, contents='package x\n')
+            return GoBuilder.include_go_file(env, node, tests=tests)
+
+        self.assertFalse(include('x_test.go'))
+        self.assertTrue(include('x_test.go', tests=True))
+        self.assertTrue(include('x.go', tests=True))
+        self.assertTrue(include('x_linux_test.go', tests=True))
+        self.assertFalse(include('x_windows_test.go', tests=True))
+        self.assertFalse(include('x_linux_arm_test.go', tests=True))
+        # A file named test.go is an ordinary file
+        self.assertTrue(include('test.go'))
+
+    def test_implied_goos(self):
+        for (goos, implied) in (('android', 'linux'), ('ios', 'darwin'), ('illumos', 'solaris')):
+            env = GoDummyEnv(goos=goos, goarch='arm64')
+            self.assertTrue(implied in GoBuilder._get_all_tags(env))
+            for name in ('x_%s.go' % goos, 'x_%s.go' % implied, 'x_%s_arm64.go' % implied):
+                node = GoDummyNode(name=name, contents='package x\n')
+                self.assertTrue(GoBuilder.include_go_file(env, node), name)
+        # but not the other way around
+        env = GoDummyEnv(goos='linux', goarch='arm64')
+        self.assertFalse('android' in GoBuilder._get_all_tags(env))
+        self.assertFalse(GoBuilder.include_go_file(env, GoDummyNode(name='x_android.go', contents='package x\n')))
+
+    def test_configuration_kept_on_environment(self):
+        env = SCons.Environment.Environment(tools=[], GOOS='linux', GOARCH='amd64', GOVERSION='go1.21',
+                                            CGO_ENABLED='0', GOTAGS=[])
+        tags = GoBuilder._get_all_tags(env)
+        self.assertTrue(GoBuilder._get_all_tags(env) is tags)
+        override = env.Override({'GOOS': 'windows'})
+        self.assertEqual(GoBuilder._go_configuration(override)[:2], ('windows', 'amd64'))
+        self.assertTrue('windows' in GoBuilder._get_all_tags(override))
+        self.assertTrue(GoBuilder._get_all_tags(env) is tags)
+        env['GOTAGS'].append('extra')
+        self.assertTrue('extra' in GoBuilder._get_all_tags(env))
+
+
+class TestPlatformMatrix(unittest.TestCase):
+
+    def setUp(self):
+        self.matrix = GoBuilder.GoPlatformMatrix([
+            ('linux', 'amd64', frozenset(['linux', 'amd64', 'unix'])),
+            ('windows', 'amd64', frozenset(['windows', 'amd64'])),
+            ('linux', 'arm64', frozenset(['linux', 'arm64', 'unix'])),
+        ])
+
+    def test_name_mask(self):
+        self.assertEqual(self.matrix.name_mask('x.go'), 0b111)
+        self.assertEqual(self.matrix.name_mask('x_linux.go'), 0b101)
+        self.assertEqual(self.matrix.name_mask('x_amd64.go'), 0b011)
+        self.assertEqual(self.matrix.name_mask('x_linux_arm64.go'), 0b100)
+        self.assertEqual(self.matrix.name_mask('x_windows_test.go'), 0)
+        self.assertEqual(self.matrix.name_mask('x_windows_test.go', tests=True), 0b010)
+
+    def test_constraint_mask(self):
+        constraint = GoBuilder.compile_build_constraint([], 'unix && !arm64')
+        self.assertEqual(self.matrix.constraint_mask(constraint), 0b001)
+        self.assertEqual(self.matrix.constraint_mask(None), 0b111)
+
+    def test_include_go_file(self):
+        env = GoDummyEnv()
+        env['_go_matrix'] = self.matrix
+        node = GoDummyNode(name='x_amd64.go', contents='//go:build unix\n\npackage x\n')
+        env['_go_matrix_bit'] = 0b001
+        self.assertTrue(GoBuilder.include_go_file(env, node))
+        env['_go_matrix_bit'] = 0b010
+        self.assertFalse(GoBuilder.include_go_file(env, node))
+        env['_go_matrix_bit'] = 0b100
+        self.assertFalse(GoBuilder.include_go_file(env, node))
+
+
+class TestMatrixEnvironments(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, 'main.go')
+        with open(self.source, 'w') as f:
+            f.write('package main\n')
+        # The toolchain's values are given, so that it isn't run
+        self.env = SCons.Environment.Environment(tools=[], GO='go', GOVERSION='go1.21', GOHOSTOS='linux',
+                                                 GOHOSTARCH='amd64', GOOS='linux', GOARCH='amd64', GOROOT='/goroot',
+                                                 GOTOOLDIR='/goroot/tool', GOEXE='', CGO_ENABLED='0', GO_SCAN_CACHE=None,
+                                                 GO_SYSTEM_PACKAGES=frozenset(['fmt']))
+        GoBuilder.generate(self.env)
+        self.env['GOMATRIXDIR'] = os.path.join(self.tmpdir, '${GOOS}_${GOARCH}')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_later_programs_use_their_own_environment(self):
+        for builder in ('goProgram', 'goPackageProgram'):
+            self.env.goProgramMatrix(builder, [self.source], builder=builder,
+                                     platforms=['linux/amd64', 'darwin/arm64'])
+            host = self.env.goProgram(os.path.join(self.tmpdir, 'host_' + builder), [self.source])[0]
+            build_env = host.get_build_env()
+            self.assertEqual(build_env.get('_go_matrix_bit'), None, builder)
+            self.assertEqual(build_env.subst('$GOOS $GOARCH'), 'linux amd64')
+
+
+
+class TestToolLoading(unittest.TestCase):
+
+    def setUp(self):
+        import SCons.Script.Main
+        import SCons.Script.SConsOptions
+        self.main = SCons.Script.Main
+        self.parser = self.main.OptionsParser
+        parser = SCons.Script.SConsOptions.Parser('')
+        parser.parse_args([], SCons.Script.SConsOptions.SConsValues(parser.get_default_values()))
+        self.main.OptionsParser = parser
+
+    def tearDown(self):
+        self.main.OptionsParser = self.parser
+
+    def make_env(self):
+        env = SCons.Environment.Environment(tools=[], GO='go', GOVERSION='go1.21', GOHOSTOS='linux',
+                                            GOHOSTARCH='amd64', GOOS='linux', GOARCH='amd64', GOROOT='/goroot',
+                                            GOTOOLDIR='/goroot/tool', GOEXE='', CGO_ENABLED='0', GO_SCAN_CACHE=None)
+        GoBuilder.generate(env)
+        return env
+
+    def test_two_environments(self):
+        action_class = GoBuilder._GoCommandAction
+        stats = GoBuilder._stats
+        self.make_env()
+        # As SCons does on python 2 for a tool found on a toolpath
+        imp.reload(GoBuilder)
+        self.make_env()
+        self.assertTrue(self.main.OptionsParser.has_option('--go-stats'))
+        self.assertIs(GoBuilder._GoCommandAction, action_class)
+        self.assertIs(GoBuilder._stats, stats)
+
+class GoDummyTraceNode(GoDummyNode):
+    def __init__(self, name, children=()):
+        GoDummyNode.__init__(self, name=name)
+        self.abspath = '/' + name
+        self._children = list(children)
+
+    def children(self, scan=1):
+        return self._children
+
+
+class TestTrace(unittest.TestCase):
+
+    def test_critical_path(self):
+        util = GoDummyTraceNode('util.a')
+        greet = GoDummyTraceNode('greet.a', [GoDummyTraceNode('go-package:greet', [util])])
+        vend = GoDummyTraceNode('vend.a')
+        main = GoDummyTraceNode('main.a', [greet, vend])
+        app = GoDummyTraceNode('app', [main, GoDummyTraceNode('app.importcfg')])
+
+        trace = GoBuilder.GoTrace()
+        trace.record('compile', [util], 0.0, 3.0)
+        trace.record('compile', [vend], 0.0, 1.0)
+        trace.record('compile', [greet], 3.0, 4.0, cpu=0.5, maxrss=1000)
+        trace.record('compile', [main], 4.0, 5.0)
+        trace.record('link', [app], 5.0, 7.0)
+
+        self.assertEqual(trace.dependencies()[3], [1, 2])
+        self.assertEqual([e['name'] for e in trace.critical_path()],
+                         ['compile util.a', 'compile greet.a', 'compile main.a', 'link app'])
+        self.assertTrue(trace.report().startswith('GoBuilder critical path: 7.000s of 7.000s, 4 of 5'))
+
+        chrome = trace.chrome_trace()
+        self.assertEqual(len(chrome['traceEvents']), 5)
+        greet_event = chrome['traceEvents'][2]
+        self.assertEqual((greet_event['ph'], greet_event['dur']), ('X', 1000000))
+        self.assertEqual(greet_event['args']['deps'], ['compile util.a'])
+        self.assertEqual(greet_event['args']['maxrss_kb'], 1000)
+
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        GoBuilder._stats.reset()
+
+    def test_counters(self):
+        env = GoDummyEnv()
+        env['GO_SYSTEM_PACKAGES'] = frozenset(['fmt'])
+        node = GoDummyNode(name='x.go', contents='// +build windows\n\npackage x\nimport "fmt"\n')
+        GoBuilder.parse_file(env, node)
+        self.assertFalse(GoBuilder._eval_build_statements(env, node))
+        self.assertFalse(GoBuilder.include_go_file(env, GoDummyNode(name='x_test.go')))
+        GoBuilder.is_not_go_standard_library(env, 'fmt')
+
+        stats = GoBuilder.go_stats()
+        self.assertEqual(stats['counters']['files parsed'], 1)
+        self.assertEqual(stats['counters']['bytes read'], len(node.contents))
+        self.assertEqual(stats['counters']['files rejected by name'], 1)
+        self.assertEqual(stats['counters']['stdlib packages'], 1)
+        self.assertEqual(stats['timers']['parse']['calls'], 1)
+        self.assertTrue('files parsed' in GoBuilder._stats.summary())
+
+
 def suite():
     suite = unittest.TestSuite()
     tclasses = [
         TestImportParsing,
+        TestHeaderParsing,
         TestBuildTagParsing,
+        TestBuildConstraints,
+        TestScanCache,
+        TestPackageIndex,
+        TestWatcher,
+        TestImportResolver,
+        TestGoListBackend,
+        TestSystemPackages,
+        TestToolchain,
+        TestPackageArchives,
+        TestCgo,
+        TestTokenSignatures,
+        TestPrescan,
+        TestTestFiles,
+        TestGenerate,
+        TestPlatformMatrix,
+        TestMatrixEnvironments,
+        TestToolLoading,
+        TestBatchBuilds,
+        TestJobBudget,
+        TestReproducible,
+        TestTrace,
+        TestStats,
                ]
     for tclass in tclasses:
         names = unittest.getTestCaseNames(tclass, 'test_')
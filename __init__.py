@@ -25,27 +25,85 @@
 
 
 import SCons.Tool
+import SCons.Node.Alias
+import SCons.Node.FS
 from SCons.Builder import Builder
 from SCons.Action import Action, _subproc
 from SCons.Scanner import Scanner, FindPathDirs
+import SCons.Scanner
 from SCons.Defaults import ObjSourceScan
 import SCons.Subst
+import SCons.Action
+import SCons.Environment
+import SCons.Errors
+import SCons.Warnings
+import SCons.Util
 import os.path
 import os
 import re
+import codecs
+import hashlib
+import shutil
 import string
 import pdb
 import subprocess
+import atexit
+import time
+import json
+import threading
+import contextlib
+import tempfile
+import sys
+import imp
+
+# On python 2 SCons loads a tool found on a toolpath again for each Environment, executing this
+# file again in the module it was loaded in: what the first load defined is put back at the end
+# of the file, so that its classes, caches and statistics stay the ones in use.
+_previous_load = dict(globals()) if '_loaded' in globals() else None
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 
 go_debug = False
 
-# Handle multiline import statements
-m_import = re.compile(r'import\s*(?P<paren>\()\s*(?P<package_names>[^\(]*?)(\))|import\s*(?P<namespace>[^\"]*)?(?P<quote>\")(?P<package_name>.*?)(\")', re.MULTILINE)
-
 # Handle +build statements
 m_build = re.compile(r'\/\/\s*\+build\s(.*)')
 
+# Handle //go:build expressions
+m_go_build = re.compile(r'//go:build\s+(.*)')
+m_go_build_token = re.compile(r'\s*(\|\||&&|!|\(|\)|[\w.]+)')
+
+# #cgo directives in the preamble of a file importing "C", e.g. #cgo linux LDFLAGS: -lm
+m_cgo_directive = re.compile(r'^\s*(?://)?\s*#cgo\s+(?:(.*?)\s+)?(CFLAGS|CPPFLAGS|CXXFLAGS|FFLAGS|LDFLAGS|pkg-config):(.*)$',
+                             re.M)
+m_package_clause = re.compile(r'^\s*package\s+(\w+)', re.M)
+
+# //go:generate directives, which must start at the beginning of a line
+m_go_generate = re.compile(r'^//go:generate[ \t]+(.*?)[ \t\r]*$', re.M)
+
+# A word of a //go:generate command: a quoted go string or a run of non-spaces
+m_go_generate_word = re.compile(r'"(?:[^"\\]|\\.)*"|\S+')
+
+# Tokens used when scanning the header (package clause and imports) of a go file
+m_ident = re.compile(r'\w+')
+m_string = re.compile(r'"(?:[^"\\\n]|\\.)*"')
+
+# Size of the chunks read from a go file while scanning its header
+_header_chunk_size = 8192
+
 # TODO: Determine if lists below include all those supported by both gccgo and google go
 #       or just google go.  If just google go, obtain complete list and add to below
 #       or perhaps after we determine which compiler we're using use the appropriate list
@@ -55,10 +113,16 @@ m_build = re.compile(r'\/\/\s*\+build\s(.*)')
 # https://github.com/golang/go/blob/master/src/go/build/syslist.go
 # Need to include license statement from
 # https://github.com/golang/go/blob/master/LICENSE
-_goosList = "android darwin dragonfly freebsd linux nacl netbsd openbsd plan9 solaris windows".split()
+_goosList = "aix android darwin dragonfly freebsd hurd illumos ios js linux nacl netbsd openbsd plan9 solaris wasip1 windows zos".split()
 _goarchList = "386 amd64 amd64p32 arm armbe arm64 arm64be ppc64 ppc64le mips mipsle mips64 mips64le mips64p32 mips64p32le ppc s390 s390x sparc sparc64".split()
 
-_goVersionTagsList = ['go1.%d'%v for v in xrange(1,8)]
+# GOOS -> the operating system whose build tag and file names it also satisfies
+_goosImplied = {'android': 'linux', 'ios': 'darwin', 'illumos': 'solaris'}
+
+# Operating systems satisfying the unix build tag (go 1.19 and later)
+_goUnixList = "aix android darwin dragonfly freebsd hurd illumos ios linux netbsd openbsd solaris".split()
+
+m_go_version = re.compile(r'(\d+)\.(\d+)')
 
 # TODO: construct list of legal combinations
 #  Use: https://golang.org/doc/install/source#environment for current list.  (may vary by version of google go compiler)
@@ -92,6 +156,1134 @@ _goVersionTagsList = ['go1.%d'%v for v in xrange(1,8)]
 # windows	amd64
 
 
+class GoStats(object):
+    """
+    Counters and timers for the scanner and the toolchain commands it runs. They're cheap
+    enough to always be collected, and are read with go_stats() or printed at the end
+    of the build with --go-stats.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        # name -> [calls, seconds]
+        self.timers = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += time.time() - start
+
+    def snapshot(self):
+        """
+        :return: dictionary of counters, timers and scan cache statistics
+        """
+        return {'counters': dict(self.counters),
+                'timers': dict((name, {'calls': calls, 'seconds': seconds})
+                               for (name, (calls, seconds)) in self.timers.items()),
+                'scan_cache': scan_cache_stats()}
+
+    def summary(self):
+        """
+        :return: the statistics formatted for printing
+        """
+        snapshot = self.snapshot()
+        lines = ['GoBuilder statistics:']
+        for name in sorted(snapshot['counters']):
+            lines.append('  %-36s %10d' % (name, snapshot['counters'][name]))
+        for (name, value) in sorted(snapshot['scan_cache'].items()):
+            lines.append('  %-36s %10d' % ('scan cache ' + name, value))
+        for name in sorted(snapshot['timers']):
+            timer = snapshot['timers'][name]
+            lines.append('  %-36s %10.3fs in %d calls' % (name, timer['seconds'], timer['calls']))
+        return '\n'.join(lines)
+
+
+_stats = GoStats()
+
+
+def go_stats():
+    """
+    Statistics for the scanner and toolchain collected in this run, see GoStats
+    :return: dictionary
+    """
+    return _stats.snapshot()
+
+
+def _get_option(name):
+    """
+    :return: the value of an option added by _add_stats_option, or None when not running
+             under scons or before the options are added
+    """
+    script = sys.modules.get('SCons.Script')
+    return script is not None and getattr(script.Main.OptionsParser.values, name, None) or None
+
+
+def _print_stats():
+    if _get_option('go_stats'):
+        print(_stats.summary())
+
+
+if _previous_load is None:
+    atexit.register(_print_stats)
+
+def _add_stats_option():
+    """
+    Add the --go-stats and --go-trace command line options, when running under scons.
+    On python 2 SCons loads a tool found on a toolpath again for each Environment, which
+    resets this module, so whether they've been added is asked of the option parser.
+    """
+    script = sys.modules.get('SCons.Script')
+    if script is None:
+        return
+    parser = script.Main.OptionsParser
+    if getattr(parser, 'has_option', None) is not None and parser.has_option('--go-stats'):
+        return
+    script.AddOption('--go-stats', dest='go_stats', action='store_true', default=False,
+                     help='Print GoBuilder scanner and toolchain statistics at the end of the build')
+    script.AddOption('--go-trace', dest='go_trace', metavar='FILE', default=None,
+                     help='Write a Chrome trace of the go actions to FILE and print their critical path')
+
+
+class GoTrace(object):
+    """
+    Timings of the go actions run by the build: wall time of every action, and with
+    --go-trace the CPU time and max RSS of the commands they run (where os.wait4 exists).
+    The dependencies between actions are taken from the dependency graph at the end of
+    the build, so the package DAG found by the scanner is part of it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        # dictionaries of name, kind, targets, start, end, cpu, maxrss, thread, status
+        self.events = []
+        self.enabled = False
+
+    def record(self, kind, targets, start, end, cpu=None, maxrss=None, status=0):
+        event = {'name': '%s %s' % (kind, targets[0]), 'kind': kind, 'targets': list(targets),
+                 'start': start, 'end': end, 'cpu': cpu, 'maxrss': maxrss,
+                 'thread': threading.current_thread().ident, 'status': status}
+        with self.lock:
+            self.events.append(event)
+        return event
+
+    def dependencies(self):
+        """
+        :return: dictionary of event index -> indexes of the events it depends on, directly
+                 or through nodes built by no go action (Alias nodes, source files)
+        """
+        producer = {}
+        for (i, event) in enumerate(self.events):
+            for t in event['targets']:
+                producer[t] = i
+
+        reached = {}
+
+        def traced_children(node, seen):
+            try:
+                return reached[node]
+            except KeyError:
+                pass
+            found = set()
+            for child in node.children(scan=0):
+                if child in seen:
+                    continue
+                seen.add(child)
+                if child in producer:
+                    found.add(producer[child])
+                else:
+                    found.update(traced_children(child, seen))
+            reached[node] = found
+            return found
+
+        deps = {}
+        for (i, event) in enumerate(self.events):
+            found = set()
+            for t in event['targets']:
+                found.update(traced_children(t, set(event['targets'])))
+            found.discard(i)
+            deps[i] = sorted(found)
+        return deps
+
+    def critical_path(self):
+        """
+        :return: list of events on the longest (by wall time) chain of dependent actions
+        """
+        deps = self.dependencies()
+        # index -> (chain seconds, previous index)
+        chains = {}
+        for i in sorted(deps, key=lambda i: self.events[i]['end']):
+            best = (0.0, None)
+            for d in deps[i]:
+                if d in chains and chains[d][0] > best[0]:
+                    best = (chains[d][0], d)
+            event = self.events[i]
+            chains[i] = (best[0] + event['end'] - event['start'], best[1])
+        if not chains:
+            return []
+        i = max(chains, key=lambda i: chains[i][0])
+        path = []
+        while i is not None:
+            path.append(self.events[i])
+            i = chains[i][1]
+        path.reverse()
+        return path
+
+    def chrome_trace(self):
+        """
+        :return: the events in Chrome's trace event format (chrome://tracing, Perfetto),
+                 with the package DAG and critical path as extra keys
+        """
+        threads = {}
+        trace_events = []
+        deps = self.dependencies()
+        for (i, event) in enumerate(self.events):
+            tid = threads.setdefault(event['thread'], len(threads) + 1)
+            args = {'targets': [str(t) for t in event['targets']],
+                    'deps': [self.events[d]['name'] for d in deps[i]]}
+            if event['cpu'] is not None:
+                args['cpu_s'] = round(event['cpu'], 6)
+                args['maxrss_kb'] = event['maxrss']
+            if event['status']:
+                args['status'] = event['status']
+            trace_events.append({'name': event['name'], 'cat': event['kind'], 'ph': 'X',
+                                 'pid': 1, 'tid': tid,
+                                 'ts': int((event['start'] - self.start) * 1e6),
+                                 'dur': int((event['end'] - event['start']) * 1e6),
+                                 'args': args})
+        packages = {}
+        for index in list(_package_indexes.values()) + list(_go_list_graphs.values()):
+            for node in index.nodes.values():
+                packages[str(node)] = [str(d) for d in node.depends
+                                       if isinstance(d, SCons.Node.Alias.Alias)]
+        return {'traceEvents': trace_events,
+                'displayTimeUnit': 'ms',
+                'goPackageGraph': packages,
+                'goCriticalPath': [e['name'] for e in self.critical_path()]}
+
+    def report(self):
+        """
+        :return: the critical path formatted for printing
+        """
+        path = self.critical_path()
+        if not path:
+            return 'GoBuilder critical path: no go actions run'
+        total = sum(e['end'] - e['start'] for e in path)
+        busy = sum(e['end'] - e['start'] for e in self.events)
+        wall = max(e['end'] for e in self.events) - min(e['start'] for e in self.events)
+        lines = ['GoBuilder critical path: %.3fs of %.3fs, %d of %d actions, average parallelism %.1f'
+                 % (total, wall, len(path), len(self.events), busy / wall if wall else 1.0)]
+        for e in path:
+            usage = ''
+            if e['cpu'] is not None:
+                usage = '  cpu %.3fs  rss %dk' % (e['cpu'], e['maxrss'])
+            lines.append('  %8.3fs  %s%s' % (e['end'] - e['start'], e['name'], usage))
+        return '\n'.join(lines)
+
+
+_trace = GoTrace()
+_trace_local = threading.local()
+
+
+def go_trace():
+    """
+    The GoTrace of this run
+    """
+    return _trace
+
+
+def _write_trace():
+    filename = _get_option('go_trace')
+    if filename:
+        with open(filename, 'w') as f:
+            json.dump(_trace.chrome_trace(), f, indent=1)
+        print(_trace.report())
+
+
+if _previous_load is None:
+    atexit.register(_write_trace)
+
+
+def _go_traced_spawn(sh, escape, cmd, args, env):
+    """
+    SPAWN for _GoCommandAction with --go-trace: like SCons' posix spawn, but reaps the
+    command with os.wait4 to get its CPU time and max RSS
+    """
+    proc = subprocess.Popen([sh, '-c', ' '.join(args)], env=env, close_fds=True)
+    (pid, status, rusage) = os.wait4(proc.pid, 0)
+    usage = _trace_local.usage
+    usage[0] += rusage.ru_utime + rusage.ru_stime
+    usage[1] = max(usage[1], rusage.ru_maxrss)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode
+
+
+class GoJobBudget(object):
+    """
+    CPU and memory budget shared by the go actions running at once. Each action takes
+    its share of the CPU tokens and GO_ACTION_MEMORY, waiting while no CPU is free or its
+    memory doesn't fit, and runs with -p and GOMAXPROCS set to the CPUs it holds (see
+    _GoCommandAction). The share is the CPUs divided by the number of jobs scons runs at
+    once (at most one per CPU): scons -j32 on 16 CPUs runs 16 go actions with -p 1
+    rather than 32 with -p 16 each, and scons -j4 runs 4 with -p 4.
+    """
+
+    def __init__(self, cpus, memory=None, jobs=1):
+        """
+        :param cpus: number of CPUs
+        :param memory: memory in MB, None for no limit
+        :param jobs: number of jobs scons runs at once (-j)
+        """
+        self.cpus = max(1, cpus)
+        self.memory = memory
+        self.share = max(1, self.cpus // max(1, min(jobs, self.cpus)))
+        self.free_cpus = self.cpus
+        self.free_memory = memory
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def fits(self, memory=0):
+        """Whether an action needing memory MB can start now"""
+        return self.free_cpus >= 1 and (self.memory is None or not self.running or self.free_memory >= memory)
+
+    def acquire(self, memory=0):
+        """
+        Wait until an action can start and take its share
+        :param memory: memory the action is expected to use, in MB
+        :return: number of CPUs taken
+        """
+        with self.condition:
+            while not self.fits(memory):
+                self.condition.wait()
+            cpus = min(self.share, self.free_cpus)
+            self.free_cpus -= cpus
+            if self.memory is not None:
+                self.free_memory -= memory
+            self.running += 1
+        return cpus
+
+    def release(self, cpus, memory=0):
+        with self.condition:
+            self.free_cpus += cpus
+            if self.memory is not None:
+                self.free_memory += memory
+            self.running -= 1
+            self.condition.notify_all()
+
+
+_budget = None
+_budget_lock = threading.Lock()
+
+
+def _go_job_budget(env):
+    """
+    The GoJobBudget of this run, made with the GO_CPU_BUDGET and GO_MEMORY_BUDGET of the
+    first environment to run a go action and scons' -j
+    :return: GoJobBudget, or None if GO_CPU_BUDGET is 0 (the default), the go actions then
+             running with ENV as it is
+    """
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            cpus = int(env.subst('$GO_CPU_BUDGET') or 0)
+            memory = env.subst('$GO_MEMORY_BUDGET')
+            script = sys.modules.get('SCons.Script')
+            jobs = script is not None and script.GetOption('num_jobs') or 1
+            _budget = cpus and GoJobBudget(cpus, memory and int(memory) or None, jobs) or False
+    return _budget or None
+
+
+def _physical_memory():
+    """
+    :return: physical memory in MB, or None if unknown
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _go_budget_env(env, cpus):
+    """
+    ENV for a go action holding cpus CPUs of the GoJobBudget: GOMAXPROCS, and -p in
+    GOFLAGS for the go command (go build, go test). Being in ENV they're neither part
+    of the command line signature nor override flags on the command line.
+    """
+    action_env = dict(env['ENV'])
+    action_env['GOMAXPROCS'] = str(cpus)
+    action_env['GOFLAGS'] = ' '.join(f for f in (action_env.get('GOFLAGS'), '-p=%d' % cpus) if f)
+    return action_env
+
+
+def _go_path_prefixes(env):
+    """
+    Absolute paths which differ between checkouts, most specific first, with what they
+    are replaced by in reproducible builds (see GO_REPRODUCIBLE): each GOPATH src
+    directory and the module cache by nothing, as go build -trimpath does, and the top
+    directory by nothing too, leaving paths relative to it
+    :return: list of (path, replacement)
+    """
+    prefixes = [(os.path.join(p.abspath, 'src'), '') for p in FindPathDirs('GOPATH')(env)]
+    modcache = env['ENV'].get('GOMODCACHE') or _get_toolchain(env).get('GOMODCACHE')
+    if modcache:
+        prefixes.append((modcache, ''))
+    prefixes.append((env.Dir('#').abspath, ''))
+    return prefixes
+
+
+def _go_normalize_paths(env, text):
+    """
+    Replace the absolute paths of the top directory, GOPATH entries, the module cache
+    and GOROOT in text by placeholders
+    """
+    paths = [(p.abspath, '$GOPATH%d' % i) for (i, p) in enumerate(FindPathDirs('GOPATH')(env))]
+    modcache = env['ENV'].get('GOMODCACHE') or _get_toolchain(env).get('GOMODCACHE')
+    if modcache:
+        paths.append((modcache, '$GOMODCACHE'))
+    if _go_var(env, 'GOROOT'):
+        paths.append((_go_var(env, 'GOROOT'), '$GOROOT'))
+    paths.append((env.Dir('#').abspath, '#'))
+    # Longest first, so that a GOPATH inside the top directory keeps its placeholder
+    for (path, placeholder) in sorted(paths, key=lambda p: -len(p[0])):
+        text = text.replace(path, placeholder)
+    return text
+
+
+_file_hashes = {}
+
+
+def _hash_file(path):
+    """MD5 of a file's contents, remembered while its size and mtime don't change"""
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime)
+    try:
+        return _file_hashes[key]
+    except KeyError:
+        pass
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    _file_hashes[key] = md5.hexdigest()
+    return _file_hashes[key]
+
+
+def _go_toolchain_fingerprint(env):
+    """
+    Fingerprint of the toolchain and target platform of env, which is part of the
+    signature of every go action: a hash of the go binary, GOVERSION, GOOS, GOARCH and
+    whether cgo is enabled
+    """
+    go = env.subst('$GO')
+    binary = os.path.isabs(go) and go or SCons.Util.WhereIs(go, env['ENV'].get('PATH'))
+    return '%s %s %s/%s cgo=%d' % (binary and os.path.isfile(binary) and _hash_file(binary) or go,
+                                   _go_var(env, 'GOVERSION'), _go_var(env, 'GOOS'),
+                                   _go_var(env, 'GOARCH'), _go_cgo_enabled(env) and 1 or 0)
+
+
+def _go_action_signature(env, presig):
+    """
+    Signature of a go action's command line: the toolchain fingerprint is added, and with
+    GO_REPRODUCIBLE the absolute paths of the checkout, GOPATH, the module cache and
+    GOROOT are replaced (see _go_normalize_paths), so that identical builds in different
+    directories share CacheDir entries
+    """
+    if env.get('GO_REPRODUCIBLE'):
+        presig = _go_normalize_paths(env, presig)
+    return presig + '\n' + _go_toolchain_fingerprint(env)
+
+
+def _go_trimpath_flag(target, source, env, for_signature):
+    """
+    -trimpath for go build and go test with GO_REPRODUCIBLE
+    """
+    return env.get('GO_REPRODUCIBLE') and '-trimpath' or ''
+
+
+def _go_compile_trimpath(target, source, env, for_signature):
+    """
+    -trimpath for go tool compile with GO_REPRODUCIBLE, see _go_path_prefixes
+    """
+    if not env.get('GO_REPRODUCIBLE'):
+        return ''
+    rewrites = ';'.join('%s=>%s' % p for p in _go_path_prefixes(env))
+    return SCons.Subst.Literal('-trimpath=' + rewrites)
+
+
+class _GoCommandAction(SCons.Action.CommandAction):
+    """
+    Command action for a go tool invocation, whose timings are recorded in the GoTrace,
+    which runs within the GoJobBudget and whose signature covers the toolchain (see
+    _go_action_signature)
+    """
+
+    def __init__(self, cmd, kind, **kw):
+        SCons.Action.CommandAction.__init__(self, cmd, **kw)
+        self.kind = kind
+
+    def get_presig(self, target, source, env, executor=None):
+        return _go_action_signature(env, SCons.Action.CommandAction.get_presig(self, target, source, env, executor))
+
+    def __call__(self, target, source, env, *args, **kw):
+        budget = _go_job_budget(env)
+        if budget is None:
+            return SCons.Action.CommandAction.__call__(self, target, source, env, *args, **kw)
+        memory = int(env.subst('$GO_ACTION_MEMORY') or 0)
+        with _stats.timer('waits for the job budget'):
+            cpus = budget.acquire(memory)
+        try:
+            env = env.Override({'ENV': _go_budget_env(env, cpus)})
+            return SCons.Action.CommandAction.__call__(self, target, source, env, *args, **kw)
+        finally:
+            budget.release(cpus, memory)
+
+    def execute(self, target, source, env, executor=None):
+        rusage = _trace.enabled and hasattr(os, 'wait4') and env.get('SHELL')
+        if rusage:
+            env = env.Override({'SPAWN': _go_traced_spawn})
+            _trace_local.usage = [0.0, 0]
+        start = time.time()
+        status = 1
+        try:
+            status = SCons.Action.CommandAction.execute(self, target, source, env, executor)
+        finally:
+            (cpu, maxrss) = rusage and _trace_local.usage or (None, None)
+            _trace.record(self.kind, target, start, time.time(), cpu, maxrss, status)
+        return status
+
+
+try:
+    _intern = sys.intern
+except AttributeError:
+    _intern = intern
+
+
+def _intern_str(value):
+    try:
+        return _intern(value)
+    except TypeError:
+        # unicode on python 2
+        return value
+
+
+class GoScanRecord(object):
+    """
+    The results of parsing a go file: its import paths, // +build statements and
+    //go:build expression. Records are immutable and shared (see scan_record), so every
+    file with the same imports and constraints refers to one record, and the records'
+    strings are interned.
+    """
+    __slots__ = ('packages', 'build_statements', 'go_build', '_constraint')
+
+    def __init__(self, packages, build_statements, go_build):
+        self.packages = packages
+        self.build_statements = build_statements
+        self.go_build = go_build
+        self._constraint = _no_constraint
+
+    @property
+    def constraint(self):
+        """The compiled build constraint, see compile_build_constraint"""
+        if self._constraint is _no_constraint:
+            self._constraint = compile_build_constraint(self.build_statements, self.go_build)
+        return self._constraint
+
+    def __repr__(self):
+        return 'GoScanRecord(%r, %r, %r)' % (self.packages, self.build_statements, self.go_build)
+
+
+# Marks a record's constraint as not compiled yet, None means no constraint
+_no_constraint = object()
+
+# (packages, build_statements, go_build) -> GoScanRecord
+_scan_records = {}
+
+
+def scan_record(packages, build_statements=(), go_build=None):
+    """
+    Get the shared GoScanRecord for a file's parse results
+    :param packages: import paths
+    :param build_statements: // +build statements
+    :param go_build: //go:build expression or None
+    :return: GoScanRecord
+    """
+    key = (tuple(packages), tuple(build_statements), go_build)
+    try:
+        return _scan_records[key]
+    except KeyError:
+        pass
+
+    record = GoScanRecord(tuple(_intern_str(p) for p in packages),
+                          tuple(_intern_str(b) for b in build_statements),
+                          go_build and _intern_str(go_build))
+    _scan_records[(record.packages, record.build_statements, record.go_build)] = record
+    return record
+
+
+class GoScanCache(object):
+    """
+    Persistent store of parse_file() results, so that an unchanged .go file
+    does not have to be read and parsed again on the next SCons run.
+
+    Entries are keyed by the file's absolute path and record the file's
+    size/mtime (fast path), its content signature (slow path) and the parsed
+    import, // +build and //go:build statements.  Each run which writes the cache back is a
+    new generation; entries which haven't been used for GO_SCAN_CACHE_MAX_AGE generations
+    are evicted on save. An entry's generation is only updated once it's half way to
+    eviction, so that a build which only reads the cache doesn't write it back.
+
+    Information about go toolchains, such as the list of standard library packages,
+    and the package graphs reported by 'go list' (see GoListGraph) are kept alongside,
+    keyed by a fingerprint of the toolchain and configuration.
+    """
+
+    version = 4
+
+    def __init__(self, filename, max_age=10):
+        self.filename = filename
+        self.max_age = max_age
+        self.entries = None
+        self.toolchains = None
+        self.generation = 0
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def _load(self):
+        self.entries = {}
+        self.toolchains = {}
+        try:
+            with open(self.filename, 'rb') as cache_file:
+                data = pickle.load(cache_file)
+            if data.get('version') == self.version:
+                self.entries = data['entries']
+                self.toolchains = data['toolchains']
+                self.generation = data['generation']
+        except (IOError, OSError, EOFError, ValueError, KeyError,
+                AttributeError, pickle.UnpicklingError):
+            # Missing or corrupt cache, start over.
+            pass
+        self.generation += 1
+
+    def fetch(self, node):
+        """
+        Fill node.attributes from the cache if the file hasn't changed
+        :param node: File node to look up
+        :return: Boolean indicating a cache hit
+        """
+        if self.entries is None:
+            self._load()
+
+        path = node.abspath
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+
+        entry = self.entries.get(path)
+        if entry is None:
+            self.misses += 1
+            return False
+
+        (stat, csig, packages, build_statements, go_build, generation) = entry
+        if stat != (st.st_size, st.st_mtime):
+            # size/mtime changed, fall back to comparing content signatures
+            new_csig = node.get_content_hash()
+            if new_csig != csig:
+                self.misses += 1
+                return False
+            self.entries[path] = (self._stat_key(st), csig, packages, build_statements, go_build, self.generation)
+            self.dirty = True
+        elif self._aging(generation):
+            self.entries[path] = (stat, csig, packages, build_statements, go_build, self.generation)
+            self.dirty = True
+
+        self.hits += 1
+        node.attributes.go_scan = scan_record(packages, build_statements, go_build)
+        return True
+
+    def store(self, node):
+        """
+        Record the results of parse_file() for node
+        :param node: File node which has just been parsed
+        """
+        if self.entries is None:
+            self._load()
+
+        path = node.abspath
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+
+        record = node.attributes.go_scan
+        self.entries[path] = (self._stat_key(st),
+                              node.get_content_hash(),
+                              record.packages,
+                              record.build_statements,
+                              record.go_build,
+                              self.generation)
+        self.dirty = True
+
+    def fetch_toolchain(self, key):
+        """
+        Look up information stored by store_toolchain()
+        :param key: fingerprint of the toolchain
+        :return: the stored value or None
+        """
+        if self.entries is None:
+            self._load()
+
+        entry = self.toolchains.get(key)
+        if entry is None:
+            return None
+        if self._aging(entry[1]):
+            self.toolchains[key] = (entry[0], self.generation)
+            self.dirty = True
+        return entry[0]
+
+    def store_toolchain(self, key, value):
+        if self.entries is None:
+            self._load()
+
+        self.toolchains[key] = (value, self.generation)
+        self.dirty = True
+
+    def _aging(self, generation):
+        """
+        :return: whether an entry last marked as used in generation should be marked again
+        """
+        return self.generation - generation >= max(1, self.max_age // 2)
+
+    @staticmethod
+    def _stat_key(st):
+        # A file modified within the mtime granularity of this run could change
+        # again without its mtime changing, so don't trust the fast path for it.
+        if st.st_mtime >= time.time() - 2:
+            return None
+        return (st.st_size, st.st_mtime)
+
+    def save(self):
+        """
+        Evict stale entries and write the cache back to disk
+        """
+        if not self.dirty:
+            return
+
+        oldest = self.generation - self.max_age
+        stale = [path for (path, entry) in self.entries.items() if entry[-1] < oldest]
+        for path in stale:
+            del self.entries[path]
+        self.evicted += len(stale)
+
+        for (key, entry) in list(self.toolchains.items()):
+            if entry[-1] < oldest:
+                del self.toolchains[key]
+
+        tmp_filename = self.filename + '.tmp'
+        try:
+            with open(tmp_filename, 'wb') as cache_file:
+                pickle.dump({'version': self.version,
+                             'generation': self.generation,
+                             'entries': self.entries,
+                             'toolchains': self.toolchains},
+                            cache_file, pickle.HIGHEST_PROTOCOL)
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(tmp_filename, self.filename)
+        except (IOError, OSError) as e:
+            if go_debug: print("Unable to write go scan cache %s: %s" % (self.filename, e))
+        self.dirty = False
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries or ()),
+                'evicted': self.evicted}
+
+
+_scan_caches = {}
+
+
+def _save_scan_caches():
+    for cache in _scan_caches.values():
+        cache.save()
+
+
+if _previous_load is None:
+    atexit.register(_save_scan_caches)
+
+
+def _get_scan_cache(env):
+    """
+    Get the GoScanCache for env, or None if GO_SCAN_CACHE is not set.
+    :param env:
+    :return:
+    """
+    if env is None or not env.get('GO_SCAN_CACHE'):
+        return None
+
+    # Not env.File(), the cache file shouldn't show up as a node in the build tree.
+    filename = env.subst('$GO_SCAN_CACHE')
+    if filename.startswith('#'):
+        filename = os.path.join(env.Dir('#').abspath, filename[1:].lstrip('/\\'))
+    filename = os.path.abspath(filename)
+    try:
+        return _scan_caches[filename]
+    except KeyError:
+        cache = GoScanCache(filename, int(env.get('GO_SCAN_CACHE_MAX_AGE', 10)))
+        _scan_caches[filename] = cache
+        return cache
+
+
+def scan_cache_stats():
+    """
+    Hit/miss counters for all go scan caches used in this run
+    :return: dictionary of totals
+    """
+    totals = {'hits': 0, 'misses': 0, 'entries': 0, 'evicted': 0}
+    for cache in _scan_caches.values():
+        for (key, value) in cache.stats().items():
+            totals[key] += value
+    return totals
+
+
+def scan_go_file(env, node):
+    """
+    Fill node.attributes.go_scan with the file's GoScanRecord, using the scan cache
+    when possible and only calling parse_file() on changed files.
+    :param env:
+    :param node:
+    :return:
+    """
+    stat = _scan_stat(node)
+    if stat is not None and getattr(node.attributes, 'go_scan_stat', None) == stat:
+        # Already scanned (or prescanned) by this process and unchanged since
+        _stats.count('files already scanned')
+        return
+
+    cache = _get_scan_cache(env)
+    if cache is None:
+        parse_file(env, node)
+    elif not cache.fetch(node):
+        parse_file(env, node)
+        cache.store(node)
+    node.attributes.go_scan_stat = stat
+
+
+def _scan_stat(node):
+    try:
+        st = os.stat(node.abspath)
+    except (OSError, AttributeError):
+        return None
+    return (st.st_size, st.st_mtime)
+
+
+def _parse_go_path(path):
+    """
+    Parse the header of the go file at path, run in the goPrescan worker processes
+    :param path:
+    :return: (path, packages, build_statements, go_build expression, bytes read), packages is None on error
+    """
+    try:
+        with open(path, 'rb') as go_file:
+            return (path,) + _parse_go_header(GoHeaderLexer(_decoded_chunks(go_file))) + (go_file.tell(),)
+    except (IOError, OSError):
+        return (path, None, None, None, 0)
+
+
+def _find_go_files(root):
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        # Directories go itself ignores
+        dirnames[:] = [d for d in dirnames if d != 'testdata' and d[0] not in '._']
+        for f in filenames:
+            if f.endswith('.go') and not f.endswith('_test.go'):
+                yield os.path.join(dirpath, f)
+
+
+def _parse_go_paths(paths, jobs, batch):
+    """
+    Parse go files in a pool of jobs processes, batch files at a time
+    :return: list of _parse_go_path() results
+    """
+    if jobs <= 1 or len(paths) <= batch:
+        return [_parse_go_path(p) for p in paths]
+
+    if ProcessPoolExecutor is not None:
+        with ProcessPoolExecutor(jobs) as executor:
+            return list(executor.map(_parse_go_path, paths, chunksize=batch))
+
+    pool = _multiprocessing_pool()(jobs)
+    try:
+        return pool.map(_parse_go_path, paths, batch)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _multiprocessing_pool():
+    """
+    Import multiprocessing's Pool. On python 2 SCons makes 'import pickle' load
+    cPickle, whose Pickler multiprocessing can't subclass, so the pure python
+    pickle module has to be in place while multiprocessing is imported.
+    """
+    saved = sys.modules.get('pickle')
+    if saved is None or saved.__name__ != 'cPickle':
+        from multiprocessing.pool import Pool
+        return Pool
+
+    try:
+        del sys.modules['pickle']
+        (f, pathname, description) = imp.find_module('pickle')
+        try:
+            imp.load_module('pickle', f, pathname, description)
+        finally:
+            if f:
+                f.close()
+        # Pool imports these lazily
+        import multiprocessing.forking
+        import multiprocessing.queues
+        from multiprocessing.pool import Pool
+    finally:
+        sys.modules['pickle'] = saved
+    return Pool
+
+
+def goPrescan(env, roots=None):
+    """
+    Parse every go file under roots and the src directory of every GOPATH entry
+    up front, in a pool of GO_SCAN_JOBS processes, rather than one at a time on the
+    main thread as the scanner reaches them. Files found unchanged in the scan
+    cache aren't parsed again.
+    :param env:
+    :param roots: directories to search, default GO_SCAN_ROOTS
+    :return: number of files parsed
+    """
+    if roots is None:
+        roots = env.get('GO_SCAN_ROOTS', ['#'])
+    dirs = [d.abspath for d in env.arg2nodes(roots, env.fs.Dir)]
+    dirs.extend(os.path.join(p.abspath, 'src') for p in FindPathDirs('GOPATH')(env))
+
+    cache = _get_scan_cache(env)
+    pending = {}
+    for d in dirs:
+        if not os.path.isdir(d):
+            continue
+        for path in _find_go_files(d):
+            if path in pending:
+                continue
+            node = env.fs.File(path)
+            if getattr(node.attributes, 'go_scan_stat', None) is not None:
+                continue
+            if cache and cache.fetch(node):
+                node.attributes.go_scan_stat = _scan_stat(node)
+                continue
+            pending[path] = node
+
+    with _stats.timer('prescan'):
+        results = _parse_go_paths(sorted(pending), int(env.get('GO_SCAN_JOBS') or 1),
+                                  int(env.get('GO_SCAN_BATCH', 64)))
+
+    for (path, packages, build_statements, go_build, nbytes) in results:
+        if packages is None:
+            continue
+        _stats.count('files parsed')
+        _stats.count('files prescanned')
+        _stats.count('bytes read', nbytes)
+        node = pending[path]
+        node.attributes.go_scan = scan_record(packages, build_statements, go_build)
+        node.attributes.go_scan_stat = _scan_stat(node)
+        if cache:
+            cache.store(node)
+
+    if go_debug: print("goPrescan: parsed %d files" % len(pending))
+    return len(pending)
+
+
+_prescanned = set()
+
+
+# Files whose change invalidates the import resolvers (and so everything resolved)
+_module_files = frozenset(['go.mod', 'go.work', 'modules.txt'])
+
+
+class GoWatcher(object):
+    """
+    Watch the go files (and module files) under roots for changes, with inotify when
+    pyinotify is available and by polling (stat of every go file, at most every interval
+    seconds) otherwise. Directories themselves aren't reported: their mtime also changes
+    with build outputs, and go files added or removed are reported as such.
+    """
+
+    def __init__(self, roots, interval=0.2):
+        self.roots = [r for r in roots if os.path.isdir(r)]
+        self.interval = interval
+        self._pending = set()
+        if pyinotify is not None:
+            self._start_inotify()
+        else:
+            self._notifier = None
+            self._last_poll = time.time()
+            self._snapshot = self._poll_snapshot()
+
+    def changes(self, timeout=0):
+        """
+        Wait up to timeout seconds (None to wait until something changes) for changes
+        :return: set of absolute paths of changed, added or removed files
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if self._notifier is not None:
+                wait = None if deadline is None else max(0, deadline - time.time())
+                if self._notifier.check_events(None if wait is None else int(wait * 1000)):
+                    self._notifier.read_events()
+                    self._notifier.process_events()
+            else:
+                wait = self._last_poll + self.interval - time.time()
+                if wait > 0:
+                    if deadline is not None and time.time() + wait > deadline:
+                        break
+                    time.sleep(wait)
+                self._poll()
+            if self._pending or (deadline is not None and time.time() >= deadline):
+                break
+        changed = self._pending
+        self._pending = set()
+        return changed
+
+    def close(self):
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+
+    def _start_inotify(self):
+        pending = self._pending
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                if not event.dir and (event.name.endswith('.go') or event.name in _module_files):
+                    pending.add(event.pathname)
+
+        manager = pyinotify.WatchManager()
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO)
+        self._notifier = pyinotify.Notifier(manager, Handler())
+        for root in self.roots:
+            manager.add_watch(root, mask, rec=True, auto_add=True,
+                              exclude_filter=lambda p: os.path.basename(p)[:1] in '._')
+
+    def _poll_snapshot(self):
+        snapshot = {}
+        for root in self.roots:
+            for (dirpath, dirnames, filenames) in os.walk(root):
+                dirnames[:] = [d for d in dirnames if d[0] not in '._']
+                for name in filenames:
+                    if not (name.endswith('.go') or name in _module_files):
+                        continue
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    snapshot[path] = (st.st_size, st.st_mtime)
+        return snapshot
+
+    def _poll(self):
+        self._last_poll = time.time()
+        snapshot = self._poll_snapshot()
+        for path in set(snapshot) | set(self._snapshot):
+            if snapshot.get(path) != self._snapshot.get(path):
+                self._pending.add(path)
+        self._snapshot = snapshot
+
+
+def go_invalidate(paths):
+    """
+    Forget what's known about changed files and directories, so the next scan of a
+    long running build (scons --interactive) picks up the changes: the package index
+    entries of their directories, every package Alias node's dependencies (rebuilt on
+    next use) and the go list graphs. Changed module files drop the import resolvers and
+    everything resolved with them. Parsed files are checked against their size and mtime
+    anyway (see scan_go_file), and compiled constraints depend only on their text.
+    :param paths: absolute paths of changed files and directories
+    """
+    dirs = set()
+    for path in paths:
+        if os.path.basename(path) in _module_files:
+            _import_resolvers.clear()
+            _package_indexes.clear()
+            _go_list_graphs.clear()
+            return
+        dirs.add(path if not path.endswith('.go') else os.path.dirname(path))
+
+    if any('vendor' in d.split(os.sep) for d in dirs):
+        # A new vendor directory changes the vendor scopes of the packages above it
+        for resolver in _import_resolvers.values():
+            resolver.forget_vendor_scopes()
+    for index in _package_indexes.values():
+        index.invalidate(dirs)
+    _go_list_graphs.clear()
+    _stats.count('watch invalidations')
+
+
+_watcher = None
+
+
+def _start_watcher(env):
+    """
+    Watch GO_SCAN_ROOTS and GOPATH for the rest of the process, see GO_WATCH
+    """
+    global _watcher
+    if _watcher is not None:
+        return
+    roots = [d.abspath for d in env.arg2nodes(env.get('GO_SCAN_ROOTS', ['#']), env.fs.Dir)]
+    roots.extend(os.path.join(p.abspath, 'src') for p in FindPathDirs('GOPATH')(env))
+    _watcher = GoWatcher(roots, float(env.get('GO_WATCH_INTERVAL', 0.2)))
+    _watch_interactive_builds()
+
+
+def _apply_watch_changes():
+    if _watcher is not None:
+        changed = _watcher.changes()
+        if changed:
+            if go_debug: print("GoWatcher: %d changes" % len(changed))
+            go_invalidate(changed)
+
+
+def _watch_interactive_builds():
+    """
+    Apply the changes seen by the watcher before each build of scons --interactive, and
+    only then: a change made during a build is picked up by the next one.
+    """
+    import SCons.Script.Interactive
+    cmd = SCons.Script.Interactive.SConsInteractiveCmd
+    do_build = cmd.do_build
+    if getattr(do_build, 'go_watch', False):
+        return
+
+    def watched_do_build(self, argv):
+        _apply_watch_changes()
+        return do_build(self, argv)
+    watched_do_build.go_watch = True
+    watched_do_build.__doc__ = do_build.__doc__
+    cmd.do_build = watched_do_build
+
+
 def check_go_file(node,env):
     """
     Check if the node is either ready to scan now, or should be scanned
@@ -104,7 +1296,9 @@ def check_go_file(node,env):
 
     file_abspath = node.abspath
 
-    if not include_go_file(env,node):
+    if env.get('GO_SCANNER_BACKEND') == 'golist':
+        process_file = _get_go_list_graph(env, FindPathDirs('GOPATH')(env)).includes(env, node)
+    elif not include_go_file(env,node):
         process_file = False
 
     if go_debug: print "check_go_File:%s  Process:%s"%(file_abspath,process_file)
@@ -118,90 +1312,277 @@ def is_not_go_standard_library(env, packagename):
 
     #TODO: What to do when there's a system package and a package in the project with the same name
 
-    return packagename not in env['GO_SYSTEM_PACKAGES']
+    _stats.count('stdlib lookups')
+
+    # Import paths whose first element contains a dot are never in the standard library
+    if '.' in packagename.split('/', 1)[0]:
+        return True
+
+    if packagename in _get_system_packages(env):
+        _stats.count('stdlib packages')
+        return False
+    return True
+
+
+class GoHeaderLexer(object):
+    """
+    Tokenizer for the header of a go source file, that is the comments, package clause
+    and import declarations which precede the first declaration.
+    Text is pulled from an iterable of chunks only as tokens are requested, so a
+    parser which stops at the first declaration never reads the rest of the file.
+    Yields (kind, value) tuples where kind is one of comment, string, ident or op.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        self._eof = False
+
+    def _fill(self, pos):
+        """
+        Discard the text before pos and append the next chunk to the buffer
+        :param pos: Position of the first unconsumed character
+        :return: False if there was nothing left to read
+        """
+        if self._eof:
+            return False
+        chunk = next(self._chunks, '')
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[pos:] + chunk
+        return True
+
+    def __iter__(self):
+        pos = 0
+        while True:
+            buf = self._buffer
+            # Keep at least two characters of look ahead for // and /*
+            if len(buf) - pos < 2 and self._fill(pos):
+                pos = 0
+                continue
+            if pos >= len(buf):
+                return
+
+            c = buf[pos]
+            if c in ' \t\r\n;':
+                pos += 1
+            elif buf.startswith('//', pos):
+                end = buf.find('\n', pos)
+                if end == -1:
+                    if self._fill(pos):
+                        pos = 0
+                        continue
+                    end = len(buf)
+                yield ('comment', buf[pos:end])
+                pos = end
+            elif buf.startswith('/*', pos):
+                end = buf.find('*/', pos + 2)
+                if end == -1:
+                    if self._fill(pos):
+                        pos = 0
+                        continue
+                    return
+                yield ('comment', buf[pos:end + 2])
+                pos = end + 2
+            elif c == '"':
+                m = m_string.match(buf, pos)
+                if m is None:
+                    if buf.find('\n', pos) == -1 and self._fill(pos):
+                        pos = 0
+                        continue
+                    # Unterminated string, not a valid header
+                    return
+                yield ('string', m.group(0))
+                pos = m.end()
+            elif c == '`':
+                end = buf.find('`', pos + 1)
+                if end == -1:
+                    if self._fill(pos):
+                        pos = 0
+                        continue
+                    return
+                yield ('string', buf[pos:end + 1])
+                pos = end + 1
+            else:
+                m = m_ident.match(buf, pos)
+                if m is None:
+                    yield ('op', c)
+                    pos += 1
+                elif m.end() == len(buf) and self._fill(pos):
+                    # Identifier may continue in the next chunk
+                    pos = 0
+                else:
+                    yield ('ident', m.group(0))
+                    pos = m.end()
+
+
+def _parse_go_header(lexer):
+    """
+    Parse the package clause and import declarations of a go file, stopping at the
+    first token which can't be part of them.
+    :param lexer: GoHeaderLexer for the file
+    :return: (list of imported packages, list of // +build statements,
+              //go:build expression or None)
+    """
+    packages = []
+    build_statements = []
+    go_build = []
+
+    def significant_tokens():
+        for (kind, value) in lexer:
+            if kind == 'comment':
+                b = m_build.match(value)
+                if b and b.group(1):
+                    build_statements.append(b.group(1))
+                b = m_go_build.match(value)
+                if b:
+                    go_build.append(b.group(1).strip())
+            else:
+                yield (kind, value)
+
+    tokens = significant_tokens()
+    for (kind, value) in tokens:
+        if kind != 'ident':
+            break
+        elif value == 'package':
+            # Skip the package name
+            next(tokens, None)
+        elif value == 'import':
+            (kind, value) = next(tokens, (None, None))
+            if (kind, value) == ('op', '('):
+                # import ( ... )
+                for (kind, value) in tokens:
+                    if kind == 'string':
+                        packages.append(value[1:-1])
+                    elif (kind, value) == ('op', ')'):
+                        break
+            else:
+                # import "pkg" or import name "pkg", name may be . or _
+                if kind != 'string':
+                    (kind, value) = next(tokens, (None, None))
+                if kind == 'string':
+                    packages.append(value[1:-1])
+        else:
+            break
+
+    # Only one //go:build line is allowed, go reports an error for more
+    return packages, build_statements, (go_build[0] if go_build else None)
+
+
+def _decoded_chunks(go_file):
+    """
+    Read go_file in bounded chunks, decoding them to text on python 3
+    :param go_file: File object opened in binary mode
+    :return: generator of chunks
+    """
+    decoder = None
+    if str is not bytes:
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    while True:
+        chunk = go_file.read(_header_chunk_size)
+        if decoder:
+            chunk = decoder.decode(chunk, not chunk)
+        if not chunk:
+            return
+        yield chunk
 
 
 def parse_file(env,node):
     """
-    Parse the file and get import and // +build statements
+    Parse the file and get import, // +build and //go:build statements.
+    Only the header of the file is read, go requires both to precede the first declaration.
     :param env:
     :param node:
     :return:
     """
 
-    packages = []
-    build_statements = []
-    content = node.get_contents()
-
-    for b in m_build.finditer(content):
-        if b.group(1):
-            build_statements.append(b.group(1))
+    try:
+        path = node.rfile().abspath
+    except AttributeError:
+        path = None
+
+    with _stats.timer('parse'):
+        if path and os.path.isfile(path):
+            with open(path, 'rb') as go_file:
+                (packages, build_statements, go_build) = _parse_go_header(GoHeaderLexer(_decoded_chunks(go_file)))
+                _stats.count('bytes read', go_file.tell())
+        else:
+            content = node.get_contents()
+            if not isinstance(content, str):
+                content = content.decode('utf-8', 'replace')
+            (packages, build_statements, go_build) = _parse_go_header(GoHeaderLexer([content]))
+            _stats.count('bytes read', len(content))
+    _stats.count('files parsed')
 
     if len(build_statements) > 0:
         if go_debug: print("+build statements (file:%s):%s"%(node.abspath,build_statements))
 
-    for m in m_import.finditer(content):
-        match_dict = m.groupdict()
-        if match_dict['paren']:
-            # imports = [x.strip(' "\t') for x in m.group(2).splitlines()]
-            lines = match_dict['package_names'].splitlines()
-            imports = []
-            for l in lines:
-                l = l.strip(' "\t')
-                if l == '': continue
-
-                # Handle multi-line imports with namespaces by striping namespace
-                quote_pos = l.find('"')
-                if quote_pos != -1:
-                    l = l[quote_pos+1:]
-                imports.append(l)
-
-            if go_debug:
-                print("Import() ["+ ",".join(imports)+"]")
-
-            # Strip empty strings from array. This may happen due to newlines
-            # imports = [i for i in imports if i != '']
-            packages.extend(imports)
-        else:
-            # single line import statements
-            if go_debug:
-                print "Import \"\"", m.group(5)
-            if go_debug and match_dict['namespace']:
-                print "NAMESPACE:%s"%match_dict['namespace']
-            packages.append(match_dict['package_name'])
+    if go_debug:
+        print("Import() ["+ ",".join(packages)+"]")
 
-    node.attributes.go_packages = packages
-    node.attributes.go_build_statements = build_statements
+    node.attributes.go_scan = scan_record(packages, build_statements, go_build)
 
 
-def include_go_file(env,file):
+def _go_file_name_included(name, goos, goarch, tests=False):
+    """
+    Filter a go file on its name: _test suffix, and _GOOS, _GOARCH or _GOOS_GOARCH suffixes
+    :param name: file name
+    :param goos:
+    :param goarch:
+    :param tests: Include _test.go files
+    :return: Boolean indicating if this file should be included
+    """
+    file_parts = name.split('.')[0].split('_')
+    if go_debug: print "parts:%s"%file_parts
+
+    is_test = len(file_parts) > 1 and file_parts[-1] == 'test'
+    if is_test:
+        # foo_linux_test.go is constrained like foo_linux.go
+        file_parts = file_parts[:-1]
+
+    # foo_linux.go is also built for android, as is foo_darwin.go for ios and
+    # foo_solaris.go for illumos
+    matching_os = (goos, _goosImplied.get(goos))
+    if is_test and not tests:
+        return False
+    elif file_parts[-1] not in matching_os and file_parts[-1] in _goosList:
+        return False
+    elif file_parts[-1] != goarch and file_parts[-1] in _goarchList:
+        return False
+    elif (file_parts[-1] == goarch and len(file_parts) > 1 and file_parts[-2] not in matching_os and
+          file_parts[-2] in _goosList):
+        return False
+    return True
+
+
+def include_go_file(env,file,tests=False):
     """
     Use file name (and also scan for +build statements in file to determine
     if this file should be compiled and/or added to dependency tree
     :param env: Environment being used to compile this file
     :param file: The file in question
+    :param tests: Include _test.go files
     :return: Boolean indicating if this file should be included
     """
 
-    include_file = True
+    matrix = env.get('_go_matrix')
+    if matrix is not None:
+        # One configuration of a goProgramMatrix, see GoPlatformMatrix
+        return matrix.include_go_file(env, file, env['_go_matrix_bit'], tests)
 
     # First filter based on file name
-    file_parts = file.name.split('.')[0].split('_')
-    if go_debug: print "parts:%s"%file_parts
+    (goos, goarch) = _go_configuration(env)[:2]
+    include_file = _go_file_name_included(file.name, goos, goarch, tests)
 
-    if file_parts[-1] == 'test':
-        include_file = False
-    elif file_parts[-1] != env['GOOS'] and file_parts[-1] in _goosList:
-        include_file = False
-    elif file_parts[-1] != env['GOARCH'] and file_parts[-1] in _goarchList:
-        include_file = False
-    elif file_parts[-1] == env['GOARCH'] and file_parts[-2] != env['GOOS'] and file_parts[-2] in _goosList:
-        include_file = False
-
-    if include_file:
+    if not include_file:
+        _stats.count('files rejected by name')
+    else:
         # Cheap tests are done, now parse file and get build tags and import statements
-        parse_file(env,file)
+        scan_go_file(env,file)
         include_file = _eval_build_statements(env, file)
+        if not include_file:
+            _stats.count('files rejected by build constraint')
 
     if not include_file:
         if go_debug: print "Rejecting: %s"%file.name
@@ -209,137 +1590,1049 @@ def include_go_file(env,file):
     return include_file
 
 
-def expand_go_packages_to_files(env, gopackage, path):
+# Every token of a go file, for token signatures
+m_go_token = re.compile(r"""
+    (?P<space>[ \t\r\f]+)
+  | (?P<newline>\n)
+  | (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<string>`[^`]*`|"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+  | (?P<number>\.?[0-9](?:[eEpP][+-]|[\w.])*)
+  | (?P<ident>\w+)
+  | (?P<op>\.\.\.|<<=|>>=|&\^=|&&|\|\||<-|\+\+|--|==|!=|<=|>=|:=|&\^|<<|>>|[-+*/%&|^]=|.)
+""", re.S | re.X | re.U)
+
+# Comments which affect the build: constraints, compiler and cgo directives
+m_significant_comment = re.compile(r'//(?:go:|line |export |extern |\s*\+build)')
+
+# Keywords after which go doesn't insert a semicolon at the end of a line
+_go_keywords = frozenset('case chan const default defer else for func go goto if import interface '
+                         'map package range select struct switch type var'.split())
+
+
+def _go_token_hash(text):
+    """
+    Hash of the tokens of a go file, which ignores whitespace and comments: the tokens
+    are those the parser sees, with the semicolons go inserts at the end of lines, so
+    files which differ only in formatting or comments hash the same. Comments which
+    affect the build (//go: directives such as //go:build and //go:embed, // +build,
+    //line, //export and the preamble of import "C") are kept.
+    :param text: contents of the file
+    :return: hex digest
+    """
+    tokens = []
+    last = None
+    # Comments since the last token and before it, in case they're the cgo preamble
+    comments = []
+    preamble = []
+    for m in m_go_token.finditer(text):
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == 'space':
+            continue
+        elif kind == 'comment':
+            if m_significant_comment.match(value):
+                tokens.append(value)
+            comments.append(value)
+            if '\n' not in value or not last:
+                continue
+            # A comment spanning lines ends the line
+            kind = 'newline'
+        if kind == 'newline':
+            if last and (last[0] in ('ident', 'number', 'string') and last[1] not in _go_keywords
+                         or last[1] in (')', ']', '}', '++', '--')):
+                tokens.append(';')
+            last = None
+            continue
+        if (kind, value) == ('string', '"C"'):
+            # The cgo preamble is the comment before import "C", or before "C" in an
+            # import group
+            if last == ('ident', 'import'):
+                tokens.extend(preamble)
+            tokens.extend(comments)
+        preamble = comments
+        comments = []
+        tokens.append(value)
+        last = (kind, value)
+    return hashlib.md5('\x00'.join(tokens).encode('utf-8')).hexdigest()
+
+
+def _fetch_token_signature(env, csig):
+    """
+    Token signature (see _go_token_hash) of the version of a go file with content
+    signature csig. They're kept in the scan cache, one entry per version, so that each
+    version of a file is only tokenized once, the signature of the version a target was
+    last built from can be found, and versions no longer used are evicted.
+    :return: hex digest, or None if not known
+    """
+    cache = _get_scan_cache(env)
+    if cache is None:
+        return _token_signature_memo.get(csig)
+    return cache.fetch_toolchain(('GO_TOKEN_SIGNATURE', csig))
+
+
+def _store_token_signature(env, csig, signature):
+    cache = _get_scan_cache(env)
+    if cache is None:
+        _token_signature_memo[csig] = signature
+    else:
+        cache.store_toolchain(('GO_TOKEN_SIGNATURE', csig), signature)
+
+
+# content signature -> token signature, without a scan cache
+_token_signature_memo = {}
+
+
+def go_token_signature(env, node):
     """
-    Use GOPATH and package name to find directory where package is located and then scan
-    the directory for go packages. Return complete list of found files
-    TODO: filter found files by normal go file pruning (matching GOOS,GOOARCH,
-         and //+build statements in files
+    Signature of a go file which only changes when its tokens, other than comments,
+    change. See _go_token_hash.
     :param env:
-    :param gopackage:
-    :param path:
+    :param node: go File node
+    :return: hex digest
+    """
+    csig = node.get_csig()
+    signature = _fetch_token_signature(env, csig)
+    if signature is None:
+        with _stats.timer('token signatures'):
+            signature = _go_token_hash(node.get_text_contents())
+        _store_token_signature(env, csig, signature)
+    return signature
+
+
+def _is_go_file(node):
+    return isinstance(node, SCons.Node.FS.File) and node.name.endswith('.go')
+
+
+def go_token_decider(dependency, target, prev_ni, repo_node=None):
+    """
+    Decider for GO_SIGNATURES='tokens': a go file has changed when its token signature
+    differs from that of the version target was last built from. Other dependencies, and
+    all of them when GO_SIGNATURES isn't 'tokens', are decided by the Decider the
+    environment had before (see _go_signature_env).
+    """
+    env = target.get_build_env()
+    if not _is_go_file(dependency) or env.get('GO_SIGNATURES') != 'tokens':
+        if dependency.has_builder():
+            decide = getattr(env, '_go_decide_target', None)
+        else:
+            decide = getattr(env, '_go_decide_source', None)
+        if decide is None:
+            return dependency.changed_content(target, prev_ni, repo_node)
+        return decide(dependency, target, prev_ni, repo_node)
+
+    csig = dependency.get_csig()
+    # Also records the signature of this version, for when it changes
+    signature = go_token_signature(env, dependency)
+    prev_csig = getattr(prev_ni, 'csig', None)
+    if csig == prev_csig:
+        return False
+    if prev_csig is None or _fetch_token_signature(env, prev_csig) != signature:
+        return True
+    _stats.count('changes ignored by token signature')
+    return False
+
+
+class GoPackageIndex(object):
+    """
+    Build-wide index of import path -> package directory -> filtered list of go files
+    for a single configuration (GOPATH, modules, GOOS, GOARCH and tags).
+    Imports are resolved to directories by a GoImportResolver, and the directory chosen
+    for each import path and vendor scope is remembered.
+    Each package directory is listed once, and its entry is rebuilt only when the
+    directory's mtime changes.
+    Each package is also represented in the dependency graph by a single Alias node
+    (see package_node), named after the index and the package directory.
+    """
+
+    def __init__(self, name='go-package', resolver=None):
+        self.name = name
+        self.resolver = resolver
+        # directory abspath -> (mtime, has go files, filtered go file nodes)
+        self.directories = {}
+        # (import path, vendor scope) -> (directory abspath, canonical import path)
+        self.resolved = {}
+        # directory abspath -> package Alias node
+        self.nodes = {}
+
+    def package_files(self, env, gopackage, path, importer=None):
+        """
+        Find the directory for gopackage on path and return its filtered go files
+        :param env: Environment used to filter the files
+        :param gopackage: import path of the package
+        :param path: GOPATH entries as Dir nodes
+        :param importer: absolute path of the importing package's directory, for vendoring
+        :return: list of File nodes
+        """
+        return self._find_package(env, gopackage, path, importer)[2]
+
+    def resolve(self, env, gopackage, path, importer=None):
+        """
+        Like package_files, but also return the package's canonical import path, which
+        differs from gopackage for packages found in a GOPATH vendor directory.
+        :return: (canonical import path, list of File nodes)
+        """
+        return self._find_package(env, gopackage, path, importer)[1:]
+
+    def package_node(self, env, gopackage, path, importer=None):
+        """
+        Get the Alias node standing for gopackage. It depends on the package's filtered
+        go files and on the nodes of the packages those import, so its content signature
+        (the signatures of its children) changes whenever any file in the package or in
+        the packages it imports, directly or not, changes.
+        Importing files then need one dependency per imported package, and each package
+        is scanned once however many files import it.
+        :param env: Environment used to filter the files
+        :param gopackage: import path of the package
+        :param path: GOPATH entries as Dir nodes
+        :param importer: absolute path of the importing package's directory, for vendoring
+        :return: Alias node, or None if the package wasn't found
+        """
+        (dir_path, import_path, files) = self._find_package(env, gopackage, path, importer)
+        if not files:
+            return None
+        try:
+            return self.nodes[dir_path]
+        except KeyError:
+            pass
+
+        node = _package_alias(env, '%s:%s' % (self.name, dir_path))
+        node.attributes.go_import_path = import_path
+        # Registered before following the imports, so a cycle can't recurse forever
+        self.nodes[dir_path] = node
+        _reset_dependencies(node)
+        node.add_dependency(files)
+
+        deps = []
+        for f in files:
+            scan_go_file(env, f)
+            for p in _imported_packages(env, f):
+                dep = self.package_node(env, p, path, dir_path)
+                if dep is not None and dep not in deps:
+                    deps.append(dep)
+        node.add_dependency(deps)
+        return node
+
+    def invalidate(self, dirs):
+        """
+        Drop the entries of the directories in dirs and the imports resolved to them, and
+        the package nodes of those directories and of every package importing them,
+        directly or not, whose dependencies are rebuilt when they're next asked for.
+        A directory which had no go files may now take precedence over the one an import
+        was resolved to (such as a new vendored copy), so those imports, and the packages
+        under the vendor directory's parent, are dropped too.
+        """
+        new_dirs = set(d for d in dirs if not self.directories.get(d, (None, False))[1])
+        stale = set(dirs)
+        for (key, (dir_path, import_path)) in list(self.resolved.items()):
+            if dir_path in dirs or new_dirs.intersection(self._preceding_candidates(key, dir_path)):
+                del self.resolved[key]
+                stale.add(dir_path)
+        for dir_path in new_dirs:
+            parts = dir_path.split(os.sep)
+            if 'vendor' in parts:
+                parent = os.sep.join(parts[:parts.index('vendor')])
+                stale.update(d for d in self.nodes if d == parent or d.startswith(parent + os.sep))
+
+        importers = {}
+        for (dir_path, node) in self.nodes.items():
+            for dep in node.depends:
+                importers.setdefault(dep, []).append(dir_path)
+        while stale:
+            node = self.nodes.pop(stale.pop(), None)
+            if node is not None:
+                stale.update(importers.get(node, ()))
+
+        for dir_path in dirs:
+            self.directories.pop(dir_path, None)
+
+    def _preceding_candidates(self, key, dir_path):
+        """
+        :return: the directories searched for key (see _find_package) before dir_path
+        """
+        result = []
+        for (candidate, import_path) in self.resolver.candidates(*key):
+            if candidate == dir_path:
+                break
+            result.append(candidate)
+        return result
+
+    def _find_package(self, env, gopackage, path, importer):
+        if self.resolver is None:
+            self.resolver = _get_import_resolver(env, path)
+        key = (gopackage, self.resolver.vendor_scope(importer))
+
+        resolved = self.resolved.get(key)
+        if resolved is not None:
+            entry = self._directory_entry(env, resolved[0])
+            if entry is not None and entry[1]:
+                return resolved + (entry[2],)
+
+        for (dir_path, import_path) in self.resolver.candidates(gopackage, key[1]):
+            entry = self._directory_entry(env, dir_path)
+            if entry is not None and entry[1]:
+                # The first directory with go files wins, as for go itself
+                self.resolved[key] = (dir_path, import_path)
+                return (dir_path, import_path, entry[2])
+
+        return (None, None, [])
+
+    def _directory_entry(self, env, dir_path):
+        try:
+            mtime = os.stat(dir_path).st_mtime
+        except OSError:
+            return None
+
+        entry = self.directories.get(dir_path)
+        if entry is None or entry[0] != mtime:
+            entry = self._index_directory(env, env.fs.Dir(dir_path), dir_path, mtime)
+            self.directories[dir_path] = entry
+        else:
+            _stats.count('package index hits')
+        return entry
+
+    @staticmethod
+    def _index_directory(env, dir_node, dir_path, mtime):
+        if go_debug: print("Indexing:%s" % dir_path)
+        _stats.count('directories listed')
+
+        scandir = getattr(os, 'scandir', None)
+        if scandir:
+            names = [e.name for e in scandir(dir_path) if e.name.endswith('.go') and e.is_file()]
+        else:
+            names = [n for n in os.listdir(dir_path) if n.endswith('.go')
+                     and os.path.isfile(os.path.join(dir_path, n))]
+
+        go_files = [dir_node.File(n) for n in sorted(names)]
+
+        # Also pick up go files which will be generated by the build
+        on_disk = set(names)
+        for node in list(dir_node.entries.values()):
+            if node.name.endswith('.go') and node.name not in on_disk and node.has_builder():
+                go_files.append(node)
+        # In the same order whether or not they've been generated yet
+        go_files.sort(key=lambda f: f.name)
+
+        return (mtime, len(go_files) > 0, [f for f in go_files if include_go_file(env, f)])
+
+
+class GoPackageAlias(SCons.Node.Alias.Alias):
+    """
+    Alias node for a package (see GoPackageIndex.package_node). With
+    GO_SIGNATURES='tokens' its content signature is made from the token signatures of
+    its go files, so that packages importing it aren't rebuilt for a comment change.
+    """
+
+    def get_contents(self):
+        env = getattr(self.attributes, 'go_signature_env', None)
+        if env is None:
+            return SCons.Node.Alias.Alias.get_contents(self)
+        return ''.join(_is_go_file(n) and go_token_signature(env, n) or n.get_csig()
+                       for n in self.children())
+
+
+def _package_alias(env, name):
+    """
+    Get the GoPackageAlias node called name
+    """
+    node = SCons.Node.Alias.default_ans.get(name)
+    if node is None:
+        node = GoPackageAlias(name)
+        SCons.Node.Alias.default_ans[name] = node
+    node.attributes.go_signature_env = _go_signature_env(env)
+    return node
+
+
+def _go_signature_env(env):
+    """
+    Install go_token_decider in env if GO_SIGNATURES is 'tokens'. Called when go
+    targets and package nodes are made, so it may also be set after the tool is loaded.
+    The Decider env had is kept, and still decides whether what isn't a go file changed.
+    :return: env with GO_SIGNATURES='tokens', else None
+    """
+    if env.get('GO_SIGNATURES') != 'tokens':
+        return None
+    if getattr(env, 'decide_source', None) is not go_token_decider:
+        # Not with env.Decider(), which would also reset how files are copied from a CacheDir
+        env._go_decide_source = env.decide_source
+        env._go_decide_target = env.decide_target
+        env.decide_source = go_token_decider
+        env.decide_target = go_token_decider
+    return env
+
+
+def _reset_dependencies(node):
+    """
+    Remove the dependencies of a package Alias node, when it's recreated after go_invalidate()
+    """
+    if node.depends:
+        node.depends = []
+        node.depends_set = set()
+        node._children_reset()
+
+
+_package_indexes = {}
+
+
+def _get_package_index(env, path):
+    """
+    Get the GoPackageIndex for the configuration of env and path
+    :param env:
+    :param path: GOPATH entries as Dir nodes
     :return:
     """
-    go_files = []
-
-    for p in path:
-        if go_debug: print "Path:%s/src/%s"%(p,gopackage)
-        go_files = p.glob("src/%s/*.go"%gopackage)
-        count=0
-        for f in go_files:
-            # print "(%4d) File:%s  Test:%s"%(count,f.abspath,('_test' in f.abspath))
-            count += 1
-        if len(go_files) > 0:
-            # If we found packages files in this path, the don't continue searching GOPATH
-            break
+    resolver = _get_import_resolver(env, path)
+    key = _package_config_key(env, resolver)
+    try:
+        return _package_indexes[key]
+    except KeyError:
+        index = GoPackageIndex(_package_node_prefix('go-package', key), resolver)
+        _package_indexes[key] = index
+        return index
+
+
+def _package_config_key(env, resolver):
+    return (resolver.key,) + _go_configuration(env)
+
+
+def _package_node_prefix(kind, key):
+    """
+    Prefix of package Alias node names for the configuration key, which has to be
+    stable from one run to the next
+    """
+    return '%s:%s_%s-%s' % (kind, key[1], key[2],
+                            SCons.Util.MD5signature(repr(key[:3] + (sorted(key[3]),)))[:8])
+
+
+class _PrefixTrie(object):
+    """
+    Trie keyed by path elements, for longest prefix matches
+    """
+    __slots__ = ('children', 'value')
+
+    def __init__(self):
+        self.children = {}
+        self.value = None
+
+    def insert(self, elements, value):
+        node = self
+        for e in elements:
+            child = node.children.get(e)
+            if child is None:
+                child = node.children[e] = _PrefixTrie()
+            node = child
+        node.value = value
+
+    def matches(self, elements):
+        """
+        :param elements:
+        :return: list of (number of elements matched, value) for every prefix of elements
+                 which has a value, longest first
+        """
+        found = []
+        node = self
+        if node.value is not None:
+            found.append((0, node.value))
+        for (i, e) in enumerate(elements):
+            node = node.children.get(e)
+            if node is None:
+                break
+            if node.value is not None:
+                found.append((i + 1, node.value))
+        found.reverse()
+        return found
+
+
+def _parse_mod_file(filename):
+    """
+    Read the directives of a go.mod or go.work file needed to locate packages
+    :param filename:
+    :return: dictionary of 'module' (module path), 'go' (go version), 'use' (list of
+             directories), 'require' (module path -> version) and 'replace' (module path ->
+             (path, version), version is None for a directory)
+    """
+    result = {'module': None, 'go': None, 'use': [], 'require': {}, 'replace': {}}
+    block = None
+    with open(filename) as f:
+        for line in f:
+            line = line.split('//', 1)[0].strip()
+            if not line:
+                continue
+            if block:
+                if line == ')':
+                    block = None
+                    continue
+                (directive, args) = (block, line.split())
+            else:
+                args = line.split()
+                (directive, args) = (args[0], args[1:])
+                if args == ['(']:
+                    block = directive
+                    continue
+            args = [a.strip('"`') for a in args]
+
+            if directive in ('module', 'go') and args:
+                result[directive] = args[0]
+            elif directive == 'use' and args:
+                result['use'].append(args[0])
+            elif directive == 'require' and len(args) >= 2:
+                result['require'].setdefault(args[0], args[1])
+            elif directive == 'replace' and '=>' in args:
+                new = args[args.index('=>') + 1:]
+                if new:
+                    result['replace'][args[0]] = (new[0], new[1] if len(new) > 1 else None)
+    return result
+
+
+def _escape_module_path(module_path):
+    """Module cache directories escape upper case letters as ! and the lower case letter"""
+    return re.sub(r'[A-Z]', lambda m: '!' + m.group(0).lower(), module_path)
+
+
+def _find_up(directory, name):
+    """Find name in directory or the closest of its parents"""
+    while True:
+        candidate = os.path.join(directory, name)
+        if os.path.isfile(candidate):
+            return candidate
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+class GoImportResolver(object):
+    """
+    Resolve import paths to package directories, with go's precedence:
+    In module mode the main module (or go.work's modules), then the main module's vendor
+    directory when vendoring, otherwise the required modules (from replace directives or
+    the module cache). In GOPATH mode the vendor directories enclosing the importing
+    package, innermost first, then each GOPATH entry's src directory in turn.
+    Module roots, the module vendor tree and the GOPATH src roots are kept in a trie keyed
+    by import path element, so an import resolves with a single longest prefix walk. It's
+    built once per configuration; only GOPATH vendor directories are found as importing
+    directories are seen, each directory being checked once.
+    """
 
-    # print "filtering test files"
-    # for f in go_files:
-    #     print "%s : %s"%(type(f), f)
+    def __init__(self, key, src_roots, mod_file=None, work_file=None, mod_flag=None, modcache=None):
+        """
+        :param key: configuration key, see _get_import_resolver
+        :param src_roots: src directory of each GOPATH entry
+        :param mod_file: go.mod of the main module, None in GOPATH mode
+        :param work_file: go.work, if in workspace mode
+        :param mod_flag: value of go's -mod flag, if set
+        :param modcache: callable returning GOMODCACHE, only called when needed
+        """
+        self.key = key
+        self.src_roots = src_roots
+        self.module_mode = mod_file is not None or work_file is not None
+        self._modcache = modcache
+        self._modcache_dir = None
+        # import path elements -> (kind, ...), see candidates()
+        self.trie = _PrefixTrie()
+        # directory -> tuple of enclosing GOPATH vendor directories, innermost first
+        self._vendor_scopes = {}
+
+        if not self.module_mode:
+            self.trie.insert([], ('gopath', src_roots))
+            return
+
+        replace = {}
+        if work_file:
+            work = _parse_mod_file(work_file)
+            work_dir = os.path.dirname(work_file)
+            modules = [os.path.normpath(os.path.join(work_dir, d)) for d in work['use']]
+            vendor_dir = os.path.join(work_dir, 'vendor')
+        else:
+            work = None
+            modules = [os.path.dirname(mod_file)]
+            vendor_dir = os.path.join(modules[0], 'vendor')
+
+        require = {}
+        for module_dir in modules:
+            try:
+                mod = _parse_mod_file(os.path.join(module_dir, 'go.mod'))
+            except IOError:
+                continue
+            if mod['module']:
+                self.trie.insert(mod['module'].split('/'), ('module', module_dir))
+            for (module_path, version) in mod['require'].items():
+                require.setdefault(module_path, version)
+            for (module_path, (new, version)) in mod['replace'].items():
+                replace.setdefault(module_path, (module_dir, new, version))
+        if work:
+            # go.work replacements take precedence over those of its modules
+            for (module_path, (new, version)) in work['replace'].items():
+                replace[module_path] = (os.path.dirname(work_file), new, version)
+
+        vendoring = mod_flag == 'vendor' or (not mod_flag and
+                                             os.path.isfile(os.path.join(vendor_dir, 'modules.txt')))
+        if vendoring:
+            self.trie.insert([], ('vendor', vendor_dir))
+            return
+
+        for (module_path, version) in require.items():
+            elements = module_path.split('/')
+            matches = self.trie.matches(elements)
+            if matches and matches[0][0] == len(elements):
+                # A module of the workspace
+                continue
+            self.trie.insert(elements, ('require', module_path, version, replace.get(module_path)))
+
+    def forget_vendor_scopes(self):
+        """
+        Forget the vendor scopes found so far, after vendor directories were added or removed
+        """
+        self._vendor_scopes.clear()
+
+    def vendor_scope(self, importer):
+        """
+        :param importer: absolute path of the importing package's directory, or None
+        :return: the GOPATH vendor directories which apply to importer, innermost first
+        """
+        if self.module_mode or importer is None:
+            return ()
+        try:
+            return self._vendor_scopes[importer]
+        except KeyError:
+            pass
+
+        scope = ()
+        for root in self.src_roots:
+            if importer == root or importer.startswith(root + os.sep):
+                vendor_dir = os.path.join(importer, 'vendor')
+                if os.path.isdir(vendor_dir):
+                    scope = (vendor_dir,)
+                if importer != root:
+                    # Remembered too, so each directory is only checked once
+                    scope += self.vendor_scope(os.path.dirname(importer))
+                break
+        self._vendor_scopes[importer] = scope
+        return scope
+
+    def candidates(self, gopackage, vendor_scope=()):
+        """
+        :param gopackage: import path
+        :param vendor_scope: see vendor_scope()
+        :return: list of (directory, canonical import path) to look for gopackage in, in
+                 order of precedence
+        """
+        result = []
+        for vendor_dir in vendor_scope:
+            dir_path = os.path.join(vendor_dir, gopackage)
+            result.append((dir_path, self._gopath_import_path(dir_path) or gopackage))
+
+        elements = gopackage.split('/')
+        for (matched, value) in self.trie.matches(elements):
+            rest = elements[matched:]
+            kind = value[0]
+            if kind == 'gopath':
+                result.extend((os.path.join(root, *elements), gopackage) for root in value[1])
+            elif kind == 'module':
+                result.append((os.path.join(value[1], *rest), gopackage))
+            elif kind == 'vendor':
+                result.append((os.path.join(value[1], *elements), gopackage))
+            elif kind == 'require':
+                module_dir = self._module_dir(*value[1:])
+                if module_dir:
+                    result.append((os.path.join(module_dir, *rest), gopackage))
+        return result
+
+    def _gopath_import_path(self, dir_path):
+        for root in self.src_roots:
+            if dir_path.startswith(root + os.sep):
+                return os.path.relpath(dir_path, root).replace(os.sep, '/')
+        return None
+
+    def _module_dir(self, module_path, version, replacement):
+        if replacement:
+            (base, new, new_version) = replacement
+            if new_version is None:
+                return os.path.normpath(os.path.join(base, new))
+            (module_path, version) = (new, new_version)
+        if self._modcache_dir is None:
+            self._modcache_dir = (self._modcache and self._modcache()) or ''
+        if not self._modcache_dir:
+            return None
+        return os.path.join(self._modcache_dir, '%s@%s' % (_escape_module_path(module_path), version))
+
+
+_import_resolvers = {}
+
+
+def _go_mod_flag(env):
+    """The value of -mod in GOFLAGS, either the construction variable or ENV's"""
+    flags = env.get('GOFLAGS') or ''
+    if is_List(flags):
+        flags = ' '.join(flags)
+    flags = '%s %s' % (flags, env['ENV'].get('GOFLAGS', ''))
+    m = re.search(r'-mod=(\w+)', flags)
+    return m and m.group(1)
+
+
+def _get_import_resolver(env, path):
+    """
+    Get the GoImportResolver for GOPATH path and the module setup of env: the go.work and
+    go.mod found from the top level directory, GO111MODULE, GOWORK and the -mod flag.
+    :param env:
+    :param path: GOPATH entries as Dir nodes
+    :return:
+    """
+    top = env.fs.Dir('#').abspath
+    env_vars = env['ENV']
+    key = (tuple(p.abspath for p in path), top, env_vars.get('GO111MODULE', ''),
+           env_vars.get('GOWORK', ''), _go_mod_flag(env))
     try:
-        go_files = [ f for f in go_files if include_go_file(env,f)]
-    except TypeError as e:
-        if go_debug: print "TypeError is %s %s"%(e,f)
-    # print "done filtering test files"
-    count = 0
-    # for f in go_files:
-    #     print "X(%4d) File:%s  Test:%s" % (count, f.abspath, ('_test' in f.abspath))
-    #     count += 1
+        return _import_resolvers[key]
+    except KeyError:
+        pass
+
+    mod_file = work_file = None
+    if key[2] != 'off':
+        if key[3] == 'off':
+            pass
+        elif key[3]:
+            work_file = key[3]
+        else:
+            work_file = _find_up(top, 'go.work')
+        if not work_file:
+            mod_file = _find_up(top, 'go.mod')
+
+    def modcache():
+        value = env_vars.get('GOMODCACHE') or _get_toolchain(env).get('GOMODCACHE')
+        if not value and path:
+            value = os.path.join(path[0].abspath, 'pkg', 'mod')
+        return value
 
-    return go_files
+    resolver = GoImportResolver(key, [os.path.join(p, 'src') for p in key[0]],
+                                mod_file, work_file, key[4], modcache)
+    _import_resolvers[key] = resolver
+    return resolver
 
 
-def _eval_build_statement(env,statement,all_tags):
+def expand_go_packages_to_files(env, gopackage, path, importer=None):
     """
-    Process a single build statements arguments
+    Use GOPATH (or the modules) and package name to find directory where package is located
+    and then scan the directory for go packages. Return complete list of found files,
+    filtered by file name and //+build statements in the files.
     :param env:
-    :param statement:
-    :return: Boolean indicating if satisfied
+    :param gopackage:
+    :param path:
+    :param importer: absolute path of the importing package's directory, for vendoring
+    :return:
     """
+    return _get_package_index(env, path).package_files(env, gopackage, path, importer)
 
-    if statement is None:
-        import pdb; pdb.set_trace()
 
-    inverted = statement[0] == '!'
-    retval = False
-    if inverted:
-        statement = statement[1:]
+class PlusBuildConstraint(object):
+    """
+    Compiled form of a file's // +build lines.
+    Each line is a tuple of options which are OR'd, each option is a pair of
+    (required tags, forbidden tags) for the comma separated terms which are AND'd.
+    The lines themselves are AND'd.
+    """
+    __slots__ = ('lines',)
+
+    def __init__(self, build_statements):
+        lines = []
+        for statement in build_statements:
+            options = []
+            for option in statement.split():
+                terms = option.split(',')
+                options.append((frozenset(t for t in terms if t[:1] != '!'),
+                                frozenset(t[1:] for t in terms if t[:1] == '!')))
+            lines.append(tuple(options))
+        self.lines = tuple(lines)
+
+    def __call__(self, tags):
+        for options in self.lines:
+            for (required, forbidden) in options:
+                if required <= tags and tags.isdisjoint(forbidden):
+                    break
+            else:
+                return False
+        return True
 
-    if statement in all_tags:
-        retval = True
 
-    if inverted:
-        return not retval
+class GoBuildConstraint(object):
+    """
+    Compiled form of a //go:build expression, e.g. "linux && (amd64 || arm64) && !purego"
+    """
+    __slots__ = ('expression', 'predicate', '_tokens')
+
+    def __init__(self, expression):
+        self.expression = expression
+        tokens = []
+        pos = 0
+        expression = expression.rstrip()
+        while pos < len(expression):
+            m = m_go_build_token.match(expression, pos)
+            if m is None:
+                raise ValueError("Invalid //go:build expression: %s" % self.expression)
+            tokens.append(m.group(1))
+            pos = m.end()
+        self._tokens = tokens
+        predicate = self._parse_or()
+        if self._tokens:
+            raise ValueError("Invalid //go:build expression: %s" % self.expression)
+        del self._tokens
+        self.predicate = predicate
+
+    def __call__(self, tags):
+        return self.predicate(tags)
+
+    def _next(self):
+        if not self._tokens:
+            raise ValueError("Invalid //go:build expression: %s" % self.expression)
+        return self._tokens.pop(0)
+
+    def _parse_or(self):
+        terms = [self._parse_and()]
+        while self._tokens and self._tokens[0] == '||':
+            self._next()
+            terms.append(self._parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda tags: any(t(tags) for t in terms)
+
+    def _parse_and(self):
+        terms = [self._parse_not()]
+        while self._tokens and self._tokens[0] == '&&':
+            self._next()
+            terms.append(self._parse_not())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda tags: all(t(tags) for t in terms)
+
+    def _parse_not(self):
+        token = self._next()
+        if token == '!':
+            term = self._parse_not()
+            return lambda tags: not term(tags)
+        elif token == '(':
+            term = self._parse_or()
+            if self._next() != ')':
+                raise ValueError("Invalid //go:build expression: %s" % self.expression)
+            return term
+        elif token in ('||', '&&', ')'):
+            raise ValueError("Invalid //go:build expression: %s" % self.expression)
+        return lambda tags: token in tags
+
+
+def _never(tags):
+    return False
+
+
+_compiled_constraints = {}
+
+
+def compile_build_constraint(build_statements, go_build=None):
+    """
+    Compile a file's build constraints into a predicate taking a frozenset of tags.
+    Identical constraints share one compiled object.
+    As with go, a //go:build expression takes precedence over // +build lines.
+    :param build_statements: list of // +build statements
+    :param go_build: //go:build expression or None
+    :return: predicate, or None if the file has no constraints
+    """
+    key = (go_build, tuple(build_statements))
+    try:
+        return _compiled_constraints[key]
+    except KeyError:
+        pass
+
+    if go_build:
+        try:
+            constraint = GoBuildConstraint(go_build)
+        except ValueError as e:
+            if go_debug: print("%s, excluding file" % e)
+            constraint = _never
+    elif build_statements:
+        constraint = PlusBuildConstraint(build_statements)
     else:
-        return retval
+        constraint = None
 
+    _compiled_constraints[key] = constraint
+    return constraint
 
-def _get_all_tags(env):
 
-    tags = []
-    tags.extend(env['GOTAGS'])
-    tags.append(env['GOOS'])
-    tags.append(env['GOARCH'])
+_active_tags = {}
 
-    if env.get('CGO_ENABLED',False):
-        tags.append('cgo')
 
-    go_version = int(env['GOVERSION'].split('.')[1]) # strip '1.' and '.x' and just get middle version
-    tags.extend(_goVersionTagsList[0:go_version])
+def _get_all_tags(env):
+    """
+    Set of tags satisfied by the configuration of env, computed once per configuration
+    :param env:
+    :return: frozenset of tags
+    """
+    return _go_configuration(env)[2]
 
-    # print("ALL_TAGS:%s"%tags)
 
-    return tags
+def _go_configuration(env):
+    """
+    The target platform of env and the tags it satisfies. Kept on env, or on the
+    OverrideEnvironment, until the variables they're made from change, as they're needed
+    for every go file and resolving them may take a toolchain lookup each.
+    :param env:
+    :return: (GOOS, GOARCH, frozenset of tags)
+    """
+    settings = (env.get('GOOS'), env.get('GOARCH'), tuple(env['GOTAGS']), env.get('CGO_ENABLED'),
+                env.get('GOVERSION'), id(env.get('ENV')))
+    # In __dict__, as setting an attribute of an OverrideEnvironment sets it on the
+    # environment it overrides
+    cached = env.__dict__.get('_go_configuration')
+    if cached is not None and cached[0] == settings:
+        return cached[1]
+
+    go_version = _go_var(env, 'GOVERSION')
+    cgo = _go_cgo_enabled(env)
+    goos = _go_var(env, 'GOOS')
+    goarch = _go_var(env, 'GOARCH')
+    key = (goos, goarch, tuple(env['GOTAGS']), cgo, go_version)
+    all_tags = _active_tags.get(key)
+    if all_tags is None:
+        tags = set(env['GOTAGS'])
+        tags.add(goos)
+        tags.add(goarch)
+        if goos in _goosImplied:
+            tags.add(_goosImplied[goos])
+
+        if cgo:
+            tags.add('cgo')
+
+        # Every release tag up to and including the go version, i.e. go1.1 ... go1.N
+        m = m_go_version.search(go_version)
+        minor = int(m.group(2)) if m else 0
+        tags.update('go1.%d'%v for v in range(1, minor+1))
+
+        if minor >= 19 and goos in _goUnixList:
+            tags.add('unix')
+
+        all_tags = frozenset(tags)
+        _active_tags[key] = all_tags
+
+    configuration = (goos, goarch, all_tags)
+    env.__dict__['_go_configuration'] = (settings, configuration)
+    return configuration
 
 
 def _eval_build_statements(env,node):
     """
-    Process // +build statements in source files as follows:
+    Process // +build statements and //go:build expressions in source files as follows:
     If more than one line of +build statements, then each lines logic is evaluated and
     then AND'd with all other lines.
     If there is a comma between two items on a build line that indicates AND'ing them,
     otherwise all items space separated are OR'd.
+    The constraints are compiled once (see compile_build_constraint) and evaluated
+    against the set of tags for env.
     :param env:
     :param node: The node being evaluated. Used for debug messaging.
     :return: Boolean indicating whether the constraints are satisfied.
     """
 
-    # if node.name.endswith('c.go'): pdb.set_trace()
+    constraint = node.attributes.go_scan.constraint
+    if constraint is None:
+        return True
 
-    # A list of build statements, each one representing a line extracted from the source file
-    build_statements = node.attributes.go_build_statements
+    retval = constraint(_get_all_tags(env))
 
-    if not build_statements:
-        return True
+    if go_debug: print("_eval_build_statements:File:%s Process:%s"%(node.abspath,retval))
+
+    return retval
 
-    # Split each line into a list of space separated parts
-    build_statement_parts = [bs.split(' ') for bs in build_statements]
 
-    all_tags = _get_all_tags(env)
-    retval = True
+class GoPlatformMatrix(object):
+    """
+    The configurations of a goProgramMatrix. Whether a file is included is worked out for
+    every configuration at once, as a bit mask with bit i set if configuration i includes
+    the file: file names and (shared, see compile_build_constraint) constraints are each
+    evaluated against all the configurations the first time they're seen, so each
+    configuration's scan only parses a file once and then tests a bit.
+    """
 
-    for line_parts in build_statement_parts:
-        line = False
-        for p in line_parts:
-            lpbool = [_eval_build_statement(env, pp, all_tags) for pp in  p.split(',')]
-            prv = reduce(lambda x, y: x and y,lpbool)
-            if go_debug: print "PARTS:%s =>%s [%s]"%(p,prv,lpbool)
-            line = line or prv
-        retval = retval and line
+    def __init__(self, configs):
+        """
+        :param configs: list of (GOOS, GOARCH, frozenset of tags), one per configuration
+        """
+        self.configs = tuple(configs)
+        self._name_masks = {}
+        self._constraint_masks = {}
+
+    def name_mask(self, name, tests=False):
+        key = (name, tests)
+        try:
+            return self._name_masks[key]
+        except KeyError:
+            pass
+        mask = 0
+        for (i, (goos, goarch, tags)) in enumerate(self.configs):
+            if _go_file_name_included(name, goos, goarch, tests):
+                mask |= 1 << i
+        self._name_masks[key] = mask
+        return mask
+
+    def constraint_mask(self, constraint):
+        if constraint is None:
+            return (1 << len(self.configs)) - 1
+        try:
+            return self._constraint_masks[constraint]
+        except KeyError:
+            pass
+        mask = 0
+        for (i, (goos, goarch, tags)) in enumerate(self.configs):
+            if constraint(tags):
+                mask |= 1 << i
+        self._constraint_masks[constraint] = mask
+        return mask
+
+    def include_go_file(self, env, file, bit, tests=False):
+        """
+        include_go_file() for the configuration with mask bit
+        """
+        if not self.name_mask(file.name, tests) & bit:
+            _stats.count('files rejected by name')
+            return False
+        scan_go_file(env, file)
+        if not self.constraint_mask(file.attributes.go_scan.constraint) & bit:
+            _stats.count('files rejected by build constraint')
+            if go_debug: print("Rejecting: %s" % file.name)
+            return False
+        return True
 
-        if go_debug: print("_eval_build_statements:File:%s Process:%s"%(node.abspath,retval))
 
-    return retval
+def _imported_packages(env, node):
+    """
+    Get the import paths of the packages imported by a scanned go file, other than
+    those in the standard library.
+    :param env:
+    :param node:
+    :return: list of import paths
+    """
+    packages = node.attributes.go_scan.packages
+    if packages:
+        if go_debug: print "packages:%s"%packages
+
+    fixed_packages = []
+    # Add filter to handle package renaming as such
+    # import m "lib/math"         (where the contents of lib/math are accessible via m.SYMBOL
+    for p in packages:
+        quote_pos = p.find('"')
+        if quote_pos != -1:
+            # Import statement has package name, remove it.
+            p = p[quote_pos+1:]
+        fixed_packages.append(p)
 
+    return [go_package for go_package in fixed_packages if is_not_go_standard_library(env, go_package)]
 
-def imported_modules(node, env, path):
+
+def imported_modules(node, env, path, backend=None):
     """
     Scan file for +build statements and also for import statements.
     Store import statements on the node in node.attributes.go_imports
     :param node: The file we are looking at
     :param env:  Environment()
     :param path:
-    :return:
+    :param backend: scanner backend, default GO_SCANNER_BACKEND
+    :return: the package node (see GoPackageIndex.package_node) of each imported package
     """
     """ Find all the imported modules. """
 
@@ -347,31 +2640,339 @@ def imported_modules(node, env, path):
     if not os.path.isfile(str(node)):
         return []
 
+    _go_signature_env(env)
+    if (backend or env.get('GO_SCANNER_BACKEND')) == 'golist':
+        return _get_go_list_graph(env, path).imported_nodes(env, node)
+
+    if env.get('GO_SCAN_JOBS'):
+        prescan_key = tuple(p.abspath for p in path)
+        if prescan_key not in _prescanned:
+            _prescanned.add(prescan_key)
+            goPrescan(env)
+
     deps = []
 
     # print "Paths to search: %s"%path
-    if go_debug: print("Node PATH      : %s (CGF:%s)"%(node.path,hasattr(node.attributes,'go_packages')))
+    if go_debug: print("Node PATH      : %s (CGF:%s)"%(node.path,hasattr(node.attributes,'go_scan')))
 
-    packages = node.attributes.go_packages
-    if packages:
-        if go_debug: print "packages:%s"%packages
+    _stats.count('files scanned')
+    with _stats.timer('scan'):
+        index = _get_package_index(env, path)
+        for go_package in _imported_packages(env, node):
+            dep = index.package_node(env, go_package, path, node.dir.abspath)
+            if dep is not None and dep not in deps:
+                deps.append(dep)
 
-    fixed_packages = []
-    # Add filter to handle package renaming as such
-    # import m "lib/math"         (where the contents of lib/math are accessible via m.SYMBOL
-    for p in packages:
-        quote_pos = p.find('"')
-        if quote_pos != -1:
-            # Import statement has package name, remove it.
-            p = p[quote_pos+1:]
-        fixed_packages.append(p)
+    return deps
 
-    import_packages = [go_package for go_package in fixed_packages if is_not_go_standard_library(env, go_package)]
 
-    for go_package in import_packages:
-        deps += expand_go_packages_to_files(env,go_package,path)
+class GoListWarning(SCons.Warnings.WarningOnByDefault):
+    """
+    Packages go list reported errors for, with GO_SCANNER_BACKEND='golist'
+    """
+    pass
 
-    return deps
+
+class GoListGraph(object):
+    """
+    Package graph reported by go itself, for GO_SCANNER_BACKEND='golist': the package in
+    a directory and everything it depends on come from one 'go list -json -deps' call,
+    whose output is parsed as it's streamed. Go's own file selection (build constraints,
+    cgo, testdata, vendoring and modules) is used, and no go file is parsed by the tool.
+    The results are kept in the scan cache, keyed by the configuration and directory, and
+    reused as long as the signature (names, sizes and mtimes of the go files) of every
+    directory in them, and of the go.mod, go.work and vendor/modules.txt files above the
+    directory, is unchanged. Results with errors aren't kept. A directory already in the
+    graph, as a dependency of one listed earlier, isn't listed again.
+    Packages are represented by Alias nodes like those of GoPackageIndex.package_node.
+    """
+
+    fields = ('Dir', 'ImportPath', 'GoFiles', 'CgoFiles', 'Imports', 'ImportMap', 'Standard',
+              'Error', 'DepsErrors')
+
+    def __init__(self, name, key):
+        self.name = name
+        self.key = key
+        # import path -> package
+        self.packages = {}
+        # directory abspath -> package
+        self.directories = {}
+        # directories listed with -deps, found or not
+        self.listed = set()
+        # import path -> package Alias node
+        self.nodes = {}
+
+    def includes(self, env, node):
+        """
+        :return: whether node is one of the go files go builds for its directory
+        """
+        package = self._package_for_dir(env, node.dir.abspath)
+        return package is not None and node.name in self._file_names(package)
+
+    def imported_nodes(self, env, node):
+        """
+        :return: the package nodes of the packages imported by the package of node
+        """
+        package = self._package_for_dir(env, node.dir.abspath)
+        if package is None:
+            return []
+        return self._imported_nodes(env, package)
+
+    def package_node(self, env, import_path):
+        """
+        Get the Alias node for import_path, which depends on the package's go files and
+        on the nodes of the packages it imports
+        :return: Alias node, or None for standard library or unknown packages
+        """
+        try:
+            return self.nodes[import_path]
+        except KeyError:
+            pass
+
+        package = self.packages.get(import_path)
+        # Packages go couldn't find have no Dir
+        if package is None or package.get('Standard') or not package.get('Dir'):
+            return None
+
+        node = _package_alias(env, '%s:%s' % (self.name, package['Dir']))
+        node.attributes.go_import_path = import_path
+        # Registered before following the imports, so a cycle can't recurse forever
+        self.nodes[import_path] = node
+        _reset_dependencies(node)
+
+        dir_node = env.fs.Dir(package['Dir'])
+        files = [dir_node.File(f) for f in self._file_names(package)]
+        # Also pick up go files which will be generated by the build
+        for entry in list(dir_node.entries.values()):
+            if entry.name.endswith('.go') and entry not in files and entry.has_builder():
+                files.append(entry)
+        node.add_dependency(files)
+        node.add_dependency(self._imported_nodes(env, package))
+        return node
+
+    @staticmethod
+    def _file_names(package):
+        return (package.get('GoFiles') or []) + (package.get('CgoFiles') or [])
+
+    def _imported_nodes(self, env, package):
+        import_map = package.get('ImportMap') or {}
+        deps = []
+        for p in package.get('Imports') or []:
+            dep = self.package_node(env, import_map.get(p, p))
+            if dep is not None and dep not in deps:
+                deps.append(dep)
+        return deps
+
+    def _package_for_dir(self, env, dir_path):
+        package = self.directories.get(dir_path)
+        if package is None and dir_path not in self.listed:
+            self.listed.add(dir_path)
+            self._load(env, dir_path)
+            package = self.directories.get(dir_path)
+        return package
+
+    def _load(self, env, dir_path):
+        cache = _get_scan_cache(env)
+        cache_key = ('GO_LIST',) + self.key + (dir_path,)
+        cached = cache and cache.fetch_toolchain(cache_key)
+        module_signature = _module_signature(dir_path)
+        if cached is not None:
+            (signatures, packages) = cached
+            if (module_signature == signatures[0] and
+                    all(_directory_signature(d) == sig for (d, sig) in signatures[1:])):
+                _stats.count('go list cache hits')
+                self._add(packages)
+                return
+        _stats.count('go list cache misses')
+
+        packages = self._go_list(env, dir_path)
+        self._add(packages)
+
+        if any(p.get('Error') or p.get('DepsErrors') for p in packages):
+            # Missing packages are left to the compiler to report, and may be there next time
+            for error in sorted(set(p['Error'].get('Err', '') for p in packages if p.get('Error'))):
+                SCons.Warnings.warn(GoListWarning, 'go list %s: %s' % (dir_path, error))
+            return
+        if dir_path not in self.directories:
+            return
+
+        signatures = [module_signature] + [(p['Dir'], _directory_signature(p['Dir'])) for p in packages
+                                           if not p.get('Standard') and p.get('Dir')]
+        # Don't keep results for directories which could still change unnoticed
+        if cache and module_signature is not None and all(sig is not None for (d, sig) in signatures[1:]):
+            cache.store_toolchain(cache_key, (signatures, packages))
+
+    def _add(self, packages):
+        for package in packages:
+            self.packages.setdefault(package['ImportPath'], package)
+            if not package.get('Standard') and package.get('Dir'):
+                self.directories.setdefault(package['Dir'], package)
+
+    def _go_list(self, env, dir_path):
+        """
+        Run 'go list -e -json -deps' for dir_path and parse its output as it arrives.
+        The directory is given relative to the top directory, see _go_dir_pattern.
+        :return: list of packages, as dictionaries of the fields used
+        """
+        cmd = [env.subst('$GO'), 'list', '-e', '-deps']
+        m = m_go_version.search(_go_var(env, 'GOVERSION') or '')
+        if m and (int(m.group(1)), int(m.group(2))) >= (1, 19):
+            # Only what's needed, go then skips computing the rest
+            cmd.append('-json=' + ','.join(self.fields))
+        else:
+            cmd.append('-json')
+        if env['GOTAGS']:
+            cmd.extend(['-tags', ','.join(env['GOTAGS'])])
+        mod_flag = _go_mod_flag(env)
+        if mod_flag:
+            cmd.append('-mod=' + mod_flag)
+        top = env.fs.Dir('#').abspath
+        cmd.append(_go_dir_pattern(top, dir_path))
+
+        subp_env = _create_env_for_subprocess({'ENV': _go_target_env(env)})
+        packages = []
+        with _stats.timer('go list -deps'), tempfile.TemporaryFile() as stderr:
+            proc = subprocess.Popen(cmd, env=subp_env, cwd=top, stdout=subprocess.PIPE, stderr=stderr)
+            try:
+                for package in _iter_json_values(proc.stdout):
+                    packages.append(dict((f, package[f]) for f in self.fields if f in package))
+            finally:
+                proc.stdout.close()
+                proc.wait()
+            if proc.returncode:
+                stderr.seek(0)
+                raise SCons.Errors.UserError('%s failed (exit status %d):\n%s' % (
+                    ' '.join(cmd), proc.returncode, stderr.read().decode('utf-8', 'replace').strip()))
+        if go_debug: print("go list %s: %d packages" % (dir_path, len(packages)))
+        return packages
+
+
+def _go_dir_pattern(cwd, dir_path):
+    """
+    Package pattern for the package in dir_path, for a go command run in cwd: relative
+    (./dir), as go doesn't accept absolute paths outside GOPATH
+    """
+    try:
+        pattern = os.path.relpath(dir_path, cwd)
+    except ValueError:
+        # On another drive
+        return dir_path
+    if not pattern.startswith('.'):
+        pattern = '.' + os.sep + pattern
+    return pattern
+
+
+def _iter_json_values(stream, chunk_size=65536):
+    """
+    Parse a stream of concatenated JSON values, as written by 'go list -json', yielding
+    each value as soon as it has been read
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    buf = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        buf += text_decoder.decode(chunk, not chunk)
+        while True:
+            start = len(buf) - len(buf.lstrip())
+            if start == len(buf):
+                buf = ''
+                break
+            try:
+                (value, end) = decoder.raw_decode(buf, start)
+            except ValueError:
+                # Incomplete value, read more
+                buf = buf[start:]
+                break
+            yield value
+            buf = buf[end:]
+        if not chunk:
+            if buf.strip():
+                raise ValueError('Truncated JSON from go list: %r' % buf[:80])
+            return
+
+
+def _directory_signature(dir_path):
+    """
+    Names, sizes and mtimes of the go files in dir_path
+    :return: tuple, or None if the directory is missing or a file was modified too recently
+             for its mtime to be trusted
+    """
+    try:
+        names = sorted(n for n in os.listdir(dir_path) if n.endswith('.go'))
+    except OSError:
+        return None
+    recent = time.time() - 2
+    signature = []
+    for n in names:
+        try:
+            st = os.stat(os.path.join(dir_path, n))
+        except OSError:
+            return None
+        if st.st_mtime >= recent:
+            return None
+        signature.append((n, st.st_size, st.st_mtime))
+    return tuple(signature)
+
+
+def _module_signature(dir_path):
+    """
+    Sizes and mtimes of the go.mod, go.work and vendor/modules.txt files in dir_path and
+    its parents, which decide how go resolves the imports of the package in dir_path
+    :return: tuple, or None if a file was modified too recently for its mtime to be trusted
+    """
+    recent = time.time() - 2
+    signature = []
+    while True:
+        for name in ('go.mod', 'go.work', os.path.join('vendor', 'modules.txt')):
+            f = os.path.join(dir_path, name)
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            if st.st_mtime >= recent:
+                return None
+            signature.append((f, st.st_size, st.st_mtime))
+        parent = os.path.dirname(dir_path)
+        if parent == dir_path:
+            return tuple(signature)
+        dir_path = parent
+
+
+_go_list_graphs = {}
+
+
+def _get_go_list_graph(env, path):
+    """
+    Get the GoListGraph for the configuration of env and path
+    :param env:
+    :param path: GOPATH entries as Dir nodes
+    :return:
+    """
+    key = _package_config_key(env, _get_import_resolver(env, path)) + (env.subst('$GO'),)
+    try:
+        return _go_list_graphs[key]
+    except KeyError:
+        # The tags are part of key as a frozenset, whose order isn't stable between runs
+        cache_key = key[:3] + (tuple(sorted(key[3])), key[4])
+        graph = GoListGraph(_package_node_prefix('go-list', key), cache_key)
+        _go_list_graphs[key] = graph
+        return graph
+
+
+def check_go_test_file(node, env):
+    """
+    scan_check for goTest: go files of the package, test files included
+    """
+    return node.name.endswith('.go') and include_go_file(env, node, tests=True)
+
+
+def imported_test_modules(node, env, path):
+    """
+    Scanner function for goTest. Always uses the python scanner, test files and their
+    imports aren't part of the package graph reported by go list -deps.
+    """
+    return imported_modules(node, env, path, backend='python')
 
 
 is_String = SCons.Util.is_String
@@ -403,66 +3004,312 @@ def _create_env_for_subprocess(env):
     return new_env
 
 
+def _list_goroot_packages(goroot):
+    """
+    Enumerate the standard library packages in $GOROOT/src, skipping the directories
+    go itself ignores (testdata, vendor and names starting with . or _) and cmd/...
+    :param goroot:
+    :return: list of import paths, or None if GOROOT has no sources (gccgo)
+    """
+    src = os.path.join(goroot, 'src')
+    if not os.path.isdir(src):
+        return None
+
+    packages = []
+    for (dirpath, dirnames, filenames) in os.walk(src):
+        rel = os.path.relpath(dirpath, src)
+        excluded = ('testdata', 'vendor', 'cmd') if rel == '.' else ('testdata', 'vendor')
+        dirnames[:] = [d for d in dirnames if d not in excluded and d[0] not in '._']
+        if rel != '.' and any(f.endswith('.go') for f in filenames):
+            packages.append(rel.replace(os.sep, '/'))
+    return packages
+
+
 def _get_system_packages(env):
     """
-    Determine list of system packages by subtracting the list of project packages from
-    the list of all packages known within the scope of the current project
+    Get the set of standard library packages, either as set by the user in
+    GO_SYSTEM_PACKAGES or as determined for the toolchain used by env.
     :param env:
-    :return:
+    :return: frozenset of import paths
     """
+    system_packages = env.get('GO_SYSTEM_PACKAGES')
+    if system_packages is None:
+        system_packages = _get_toolchain(env).system_packages(env)
+    return system_packages
 
-    # use
-    subp_env = _create_env_for_subprocess(env)
 
-    all_packages = set(subprocess.check_output([env.subst('$GO'), "list", "..."], env=subp_env).split())
+def _to_str(output):
+    if not isinstance(output, str):
+        output = output.decode('utf-8', 'replace')
+    return output
 
-    proj_packages = set(subprocess.check_output([env.subst('$GO'), "list", "./..."], env=subp_env).split())
 
-    system_packages = all_packages - proj_packages
+def _run_go(name, cmd, subp_env):
+    """
+    Run a toolchain command, timed in go_stats() under name
+    :return: its output
+    """
+    with _stats.timer(name):
+        return _to_str(subprocess.check_output(cmd, env=subp_env))
 
-    # print "All PACKAGES: %s" % all_packages
-    # print "    PACKAGES: %s" % proj_packages
-    # print "GlobPackages: %s" % system_packages
-    # print "PACKAGES: %s" % [s for s in stdout]
-    env['GO_SYSTEM_PACKAGES'] = list(system_packages)
 
+class GoToolchain(object):
+    """
+    Information about a go toolchain, probed with a single 'go env -json' (plus
+    'go version' for toolchains which don't report GOVERSION) the first time any of
+    it is needed. One instance is shared by every Environment, and Clone, which uses
+    the same $GO binary and ENV.
+    """
 
-def _get_go_version_vendor(env):
+    def __init__(self, go, subp_env):
+        self.go = go
+        self.subp_env = subp_env
+        self._values = None
+        self._system_packages = None
+        self._lock = threading.Lock()
+        # configuration -> {import path: export data file}
+        self._std_exports = {}
+        # (configuration, root packages) -> [import paths], for go list -deps
+        self._std_closures = {}
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = self._probe()
+        return self._values
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def _probe(self):
+        values = {}
+        try:
+            values.update(json.loads(_run_go('go env', [self.go, "env", "-json"], self.subp_env)))
+        except (subprocess.CalledProcessError, ValueError):
+            # go older than 1.9 and gccgo don't support -json
+            values.update(self._get_go_env_values())
+
+        if not values.get('GOVERSION') or not values.get('GOHOSTOS'):
+            values.update(self._get_go_version_vendor())
+
+        if go_debug: print("GO VERSION:%s GOHOSTOS:%s GOHOSTARCH:%s" % (values.get('GOVERSION'),
+                                                                      values.get('GOHOSTOS'),
+                                                                      values.get('GOHOSTARCH')))
+        return values
+
+    def _get_go_version_vendor(self):
+        """
+        Extract go version information from running 'go version'
+
+        Seems to come in two flavors:
+        gcc go    : go version go1.4.2 gccgo (GCC) 5.3.0 linux/amd64
+        google go : go version go1.2.1 linux/amd64
+        :return: dictionary of values
+        """
+        version_parts = _run_go('go version', [self.go, "version"], self.subp_env).split()
+
+        go_version = version_parts[2][2:]
+        (go_os,go_arch) = version_parts[-1].split('/')
+
+        return {'GOHOSTOS': go_os, 'GOHOSTARCH': go_arch, 'GOVERSION': go_version}
+
+    def _get_go_env_values(self):
+        go_env_values = _run_go('go env', [self.go, "env"], self.subp_env).splitlines()
+
+        values = {}
+        for var in go_env_values:
+            if var.startswith('set '):
+                # windows
+                var = var[4:]
+            if '=' not in var: continue
+            (variable,value) = var.split('=',1)
+            if value[:1] in ('"', "'"):
+                value = value[1:-1]
+            values[variable] = value
+        return values
+
+    def system_packages(self, env):
+        """
+        Determine the set of standard library packages by listing $GOROOT/src, or by
+        asking 'go list std' for toolchains without sources in GOROOT (gccgo).
+        The result is cached on disk keyed by the go binary and GOROOT, so that
+        startup doesn't depend on the size of the user's GOPATH.
+        :param env: Environment used to find the scan cache
+        :return: frozenset of import paths
+        """
+        if self._system_packages is not None:
+            return self._system_packages
+
+        goroot = self.get('GOROOT', '')
+        go_binary = env.WhereIs(self.go) or self.go
+
+        fingerprint = ['GO_SYSTEM_PACKAGES', go_binary, goroot]
+        for p in (go_binary, os.path.join(goroot, 'VERSION'), os.path.join(goroot, 'src')):
+            try:
+                st = os.stat(p)
+                fingerprint.append((st.st_size, st.st_mtime))
+            except OSError:
+                fingerprint.append(None)
+        fingerprint = tuple(fingerprint)
+
+        cache = _get_scan_cache(env)
+        system_packages = cache and cache.fetch_toolchain(fingerprint)
+
+        if system_packages is None:
+            packages = goroot and _list_goroot_packages(goroot)
+            if packages is None:
+                packages = _run_go('go list std', [self.go, "list", "std"], self.subp_env).split()
+
+            # "C" is the pseudo package used by cgo
+            system_packages = frozenset(packages) | frozenset(['C'])
+            if cache:
+                cache.store_toolchain(fingerprint, system_packages)
+
+        self._system_packages = system_packages
+        return system_packages
+
+
+    def std_exports(self, env, packages, deps=False):
+        """
+        Find the export data (compiled archive) of standard library packages for
+        the configuration of env, using 'go list -export'. Called at build time, go
+        compiles any of them which aren't already in its build cache.
+        :param env:
+        :param packages: standard library import paths
+        :param deps: Also include every standard library package they depend on
+        :return: dictionary of import path -> export data file
+        """
+        goos = _go_var(env, 'GOOS')
+        goarch = _go_var(env, 'GOARCH')
+        cgo = _go_cgo_enabled(env)
+        config = (goos, goarch, tuple(env['GOTAGS']), cgo)
+
+        with self._lock:
+            exports = self._std_exports.setdefault(config, {})
+            if deps:
+                closure_key = (config, frozenset(packages))
+                wanted = self._std_closures.get(closure_key)
+            else:
+                wanted = [p for p in packages if p in exports]
+                if len(wanted) != len(packages):
+                    wanted = None
+
+            if wanted is None:
+                subp_env = dict(self.subp_env)
+                subp_env.update(GOOS=goos, GOARCH=goarch, CGO_ENABLED=cgo and '1' or '0')
+                cmd = [self.go, 'list', '-export', '-f', '{{if .Standard}}{{.ImportPath}}={{.Export}}{{end}}']
+                if deps:
+                    cmd.append('-deps')
+                if env['GOTAGS']:
+                    cmd.extend(['-tags', ','.join(env['GOTAGS'])])
+                cmd.extend(sorted(packages))
+
+                wanted = []
+                for line in _run_go('go list -export', cmd, subp_env).splitlines():
+                    if '=' not in line: continue
+                    (import_path, export) = line.split('=', 1)
+                    exports[import_path] = export
+                    wanted.append(import_path)
+                if deps:
+                    self._std_closures[closure_key] = wanted
+
+            return dict((p, exports[p]) for p in wanted)
+
+
+# (GO, ENV fingerprint) -> GoToolchain
+_toolchains = {}
+
+
+def _toolchain_env(subp_env):
+    """
+    ENV used to probe a toolchain: subp_env without the GOMAXPROCS and -p in GOFLAGS set
+    for each action by the GoJobBudget (see _go_budget_env), nor the target platform set
+    for go tool invocations (see _go_target_env), which come from construction variables
     """
-    Extract go version information from running 'go version'
+    toolchain_env = dict(subp_env)
+    toolchain_env.pop('GOMAXPROCS', None)
+    for variable in _target_variables:
+        toolchain_env.pop(variable, None)
+    goflags = [f for f in toolchain_env.pop('GOFLAGS', '').split() if not f.startswith('-p=')]
+    if goflags:
+        toolchain_env['GOFLAGS'] = ' '.join(goflags)
+    return toolchain_env
 
-    Seems to come in two flavors:
-    gcc go    : go version go1.4.2 gccgo (GCC) 5.3.0 linux/amd64
-    google go : go version go1.2.1 linux/amd64
+
+def _get_toolchain(env):
+    """
+    Get the GoToolchain for the $GO binary and ENV used by env. Environments whose ENV
+    only differ by the job budget's settings share it.
     :param env:
     :return:
     """
-    subp_env = _create_env_for_subprocess(env)
+    go = env.subst('$GO')
+    subp_env = _toolchain_env(_create_env_for_subprocess(env))
+    key = (go, tuple(sorted(subp_env.items())))
+    try:
+        return _toolchains[key]
+    except KeyError:
+        toolchain = GoToolchain(go, subp_env)
+        _toolchains[key] = toolchain
+        return toolchain
+
+
+class GoToolchainVariable(object):
+    """
+    Construction variable whose value comes from the toolchain the first time it's substituted
+    """
 
-    version_parts = subprocess.check_output([env.subst('$GO'), "version"], env=subp_env).split()
+    def __init__(self, name):
+        self.name = name
 
-    go_version = version_parts[2][2:]
-    (go_os,go_arch) = version_parts[-1].split('/')
+    def __call__(self, target, source, env, for_signature):
+        return _get_toolchain(env).get(self.name, '')
 
-    print("GO VERSION:%s GOOS:%s GOARCH:%s"%(go_version, go_os,go_arch))
-    env['GOHOSTOS'] = go_os
-    env['GOHOSTARCH'] = go_arch
-    env['GOVERSION'] = go_version
 
+# Variables which are filled in from 'go env' when not set by the user: what it reports
+# but GOPATH (which is a construction variable of its own) and GOFLAGS (which go applies itself)
+_toolchain_variables = ['GOHOSTOS', 'GOHOSTARCH', 'GOVERSION', 'GOROOT', 'GOTOOLDIR', 'GOEXE', 'CGO_ENABLED',
+                        'GOOS', 'GOARCH', 'GO111MODULE', 'GOBIN', 'GOCACHE', 'GOENV', 'GOEXPERIMENT',
+                        'GOGCCFLAGS', 'GOINSECURE', 'GOMOD', 'GOMODCACHE', 'GONOPROXY', 'GONOSUMDB',
+                        'GOPRIVATE', 'GOPROXY', 'GOSUMDB', 'GOTMPDIR', 'GOTOOLCHAIN', 'GOVCS', 'GOWORK',
+                        'GO386', 'GOAMD64', 'GOARM', 'GOARM64', 'GOMIPS', 'GOMIPS64', 'GOPPC64', 'GORISCV64',
+                        'GOWASM']
 
-def _get_go_env_values(env):
-    subp_env = _create_env_for_subprocess(env)
+# ENV variables set for go tool invocations from the construction variables of the same name
+_target_variables = ['GOOS', 'GOARCH', 'CGO_ENABLED', 'CC']
+
+m_variable_reference = re.compile(r'\$\{?(\w+)\}?$')
 
-    go_env_values = subprocess.check_output([env.subst('$GO'), "env"], env=subp_env).split(b'\n')
 
-    for var in go_env_values:
-        if not var: continue
-        # print("Line:%s"%var)
-        (variable,value) = var.split('=',1)
-        if (variable.startswith('GO') or variable == 'CGO_ENABLED') and variable not in ('GOPATH'):
-            # TODO: Decide if we stomp on any existing values here.
-            env[variable] = value[1:-1]
-            if go_debug: print("Setting: %s = %s"%(variable,env[variable]))
+def _go_var(env, name, default=None):
+    """
+    Get the value of a go construction variable, resolving values which are
+    probed from the toolchain or which reference another variable (e.g. GOOS=$GOHOSTOS)
+    :param env:
+    :param name:
+    :param default:
+    :return:
+    """
+    value = env.get(name, default)
+    if isinstance(value, GoToolchainVariable):
+        return value(None, None, env, False)
+    if is_String(value) and '$' in value:
+        m = m_variable_reference.match(value)
+        if m:
+            return _go_var(env, m.group(1), '')
+        return env.subst(value)
+    return value
+
+
+def _go_cgo_enabled(env):
+    """
+    :param env:
+    :return: Boolean indicating whether CGO_ENABLED is set, go reports it as '0' or '1'
+    """
+    cgo = _go_var(env, 'CGO_ENABLED', False)
+    if is_String(cgo):
+        cgo = cgo.strip() not in ('', '0')
+    return bool(cgo)
 
 
 def _go_emitter(target, source, env):
@@ -484,6 +3331,843 @@ def _go_tags(target, source, env, for_signature):
     return retval
 
 
+def _env_call(env, name, *args, **kw):
+    """
+    Call the builder, or method added with AddMethod, called name of env. With SCons 3.1
+    getattr(env, name) on an OverrideEnvironment also rebinds that method of the
+    environment it overrides to it: MethodWrapper.__init__ sets the rebound method on
+    its environment, which OverrideEnvironment forwards to the environment it overrides.
+    """
+    builder = env['BUILDERS'].get(name)
+    if builder is not None:
+        return builder(env, *args, **kw)
+    base = env
+    while isinstance(base, SCons.Environment.OverrideEnvironment):
+        base = base.__dict__['__subject']
+    return getattr(base, name).method(env, *args, **kw)
+
+
+def _go_target_env(env):
+    """
+    ENV for go tool invocations, with the target platform of env
+    :param env:
+    :return: dictionary
+    """
+    target_env = dict(env['ENV'])
+    target_env['GOOS'] = _go_var(env, 'GOOS')
+    target_env['GOARCH'] = _go_var(env, 'GOARCH')
+    target_env['CGO_ENABLED'] = _go_cgo_enabled(env) and '1' or '0'
+    if env.get('CC'):
+        # The C compiler used by cgo, as for the package's C files
+        target_env['CC'] = env.subst('$CC')
+    return target_env
+
+
+def _go_importcfg_emitter(target, source, env):
+    """
+    Add the importcfg file written for a goPackage or goLink target
+    """
+    target.append(env.File(str(target[0]) + '.importcfg'))
+    return target, source
+
+
+def _go_package_emitter(target, source, env):
+    """
+    A goPackage target is the archive used by the linker, the compiler's export data
+    (the package's API) is written separately to a .x file. Packages importing this
+    one depend only on the export data, so that with content signatures a change which
+    doesn't affect the API doesn't recompile them.
+    """
+    (target, source) = _go_importcfg_emitter(target, source, env)
+    archive = str(target[0])
+    if archive.endswith('.a'):
+        archive = archive[:-2]
+    target.append(env.File(archive + '.x'))
+    return target, source
+
+
+def _go_write_importcfg(importcfg, archives, std_exports, import_map=None):
+    lines = ['# import config']
+    for (import_path, canonical) in sorted((import_map or {}).items()):
+        lines.append('importmap %s=%s' % (import_path, canonical))
+    for (import_path, archive) in sorted(archives.items()):
+        lines.append('packagefile %s=%s' % (import_path, archive))
+    for (import_path, export) in sorted(std_exports.items()):
+        # unsafe has no export data
+        if export and import_path not in archives:
+            lines.append('packagefile %s=%s' % (import_path, export))
+    with open(importcfg, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def _go_compile_importcfg(target, source, env):
+    """
+    Write the importcfg for compiling a package: its direct imports only
+    """
+    archive = target[0]
+    archives = dict((dep.attributes.go_import_path, dep.attributes.go_export.abspath)
+                    for dep in archive.attributes.go_package_deps)
+    std_imports = archive.attributes.go_std_imports
+    std_exports = std_imports and _get_toolchain(env).std_exports(env, std_imports) or {}
+    _go_write_importcfg(target[1].abspath, archives, std_exports, archive.attributes.go_import_map)
+    return 0
+
+
+def _go_package_closure(archive):
+    """
+    :param archive: goPackage archive node
+    :return: (list of archive nodes, set of standard library imports) for archive and
+             every package it depends on, directly or indirectly.
+    """
+    archives = []
+    std_imports = set()
+    seen = set()
+    stack = [archive]
+    while stack:
+        a = stack.pop()
+        if a in seen: continue
+        seen.add(a)
+        archives.append(a)
+        std_imports.update(a.attributes.go_std_imports)
+        stack.extend(a.attributes.go_package_deps)
+    return archives, std_imports
+
+
+def _go_link_importcfg(target, source, env):
+    """
+    Write the importcfg for linking a program: every package it depends on
+    """
+    (archives, std_imports) = _go_package_closure(source[0])
+    # The runtime is linked into every program
+    std_imports.add('runtime')
+    if _go_cgo_enabled(env):
+        std_imports.add('runtime/cgo')
+    std_exports = _get_toolchain(env).std_exports(env, std_imports, deps=True)
+    _go_write_importcfg(target[1].abspath,
+                        dict((a.attributes.go_import_path, a.abspath) for a in archives[1:]),
+                        std_exports)
+    return 0
+
+
+# archive abspath -> archive node, for packages already set up by goPackageProgram
+_package_archives = {}
+
+
+def _go_package_archive(env, import_path, files, path, archive_path, in_progress):
+    """
+    Create the goPackage archive for a package, and recursively for every
+    package it imports which isn't part of the standard library.
+    :param env:
+    :param import_path: import path of the package, main for the program itself
+    :param files: filtered go files of the package
+    :param path: GOPATH entries as Dir nodes
+    :param archive_path: File node or path for the archive
+    :param in_progress: import paths being set up, to detect import cycles
+    :return: archive node
+    """
+    archive = env.arg2nodes(archive_path, env.fs.File)[0]
+    try:
+        return _package_archives[archive.abspath]
+    except KeyError:
+        pass
+
+    if import_path in in_progress:
+        raise SCons.Errors.UserError("Import cycle not allowed: %s" % ' -> '.join(in_progress + [import_path]))
+    in_progress = in_progress + [import_path]
+
+    asm_files = files and _package_asm_files(env, files[0].dir)
+    if asm_files:
+        raise SCons.Errors.UserError("Package %s has assembly files (%s), which goPackageProgram doesn't build:"
+                                     " use goProgram for programs importing it"
+                                     % (import_path, ', '.join(asm_files)))
+
+    for f in files:
+        scan_go_file(env, f)
+    cgo_files = [f for f in files if 'C' in f.attributes.go_scan.packages]
+    if cgo_files and not _go_cgo_enabled(env):
+        # As for go, files using cgo are left out when it's disabled
+        files = [f for f in files if f not in cgo_files]
+        cgo_files = []
+
+    imports = []
+    for f in files:
+        for p in f.attributes.go_scan.packages:
+            if p not in imports:
+                imports.append(p)
+
+    deps = []
+    std_imports = []
+    # import path -> canonical import path, for vendored packages
+    import_map = {}
+    pkgdir = env.subst('$GOPKGDIR')
+    index = _get_package_index(env, path)
+    importer = files and files[0].dir.abspath
+    for p in imports:
+        if not is_not_go_standard_library(env, p):
+            if p != 'C':
+                std_imports.append(p)
+            continue
+        (dep_import_path, dep_files) = index.resolve(env, p, path, importer)
+        if not dep_files:
+            # Leave it to the compiler to report the missing package
+            continue
+        if dep_import_path != p:
+            import_map[p] = dep_import_path
+        deps.append(_go_package_archive(env, dep_import_path, dep_files, path,
+                                        os.path.join(pkgdir, dep_import_path + '.a'), in_progress))
+
+    sources = files
+    cgo_objects = []
+    if cgo_files:
+        (sources, cgo_objects) = _go_cgo_package(env, import_path, files, cgo_files, archive)
+        # Imported by the cgo generated files
+        std_imports.extend(p for p in ('runtime/cgo', 'syscall', 'unsafe') if p not in std_imports)
+
+    _go_signature_env(env)
+    (archive, importcfg, export) = _env_call(env, 'goPackage', archive, sources,
+                                             GOPACKAGEPATH=import_path, GOPACKOBJS=cgo_objects)
+    if cgo_objects:
+        env.Depends(archive, cgo_objects)
+    archive.attributes.go_import_path = import_path
+    archive.attributes.go_export = export
+    archive.attributes.go_package_deps = deps
+    archive.attributes.go_std_imports = std_imports
+    archive.attributes.go_import_map = import_map
+    # Depend on the API of imported packages, not their archives
+    env.Depends([archive, export], [dep.attributes.go_export for dep in deps])
+
+    _package_archives[archive.abspath] = archive
+    return archive
+
+
+def _cgo_directives(env, cgo_files):
+    """
+    Read the package name and the #cgo directives in the preambles of a package's cgo
+    files, for the configuration of env. pkg-config packages are resolved by running it.
+    :return: (package name, list of compiler flags, list of linker flags)
+    """
+    tags = _get_all_tags(env)
+    package_name = None
+    (cflags, ldflags, pkg_config) = ([], [], [])
+    for f in cgo_files:
+        text = f.get_text_contents()
+        preamble = text[:text.find('import "C"')]
+        m = m_package_clause.search(preamble)
+        if m:
+            package_name = m.group(1)
+        for (condition, kind, flags) in m_cgo_directive.findall(preamble):
+            if condition and not compile_build_constraint([condition])(tags):
+                continue
+            flags = flags.replace('${SRCDIR}', f.dir.abspath).split()
+            if kind in ('CFLAGS', 'CPPFLAGS'):
+                cflags.extend(flags)
+            elif kind == 'LDFLAGS':
+                ldflags.extend(flags)
+            elif kind == 'pkg-config':
+                pkg_config.extend(flags)
+
+    if pkg_config:
+        subp_env = _create_env_for_subprocess(env)
+        cflags.extend(_run_go('pkg-config', ['pkg-config', '--cflags'] + pkg_config, subp_env).split())
+        ldflags.extend(_run_go('pkg-config', ['pkg-config', '--libs'] + pkg_config, subp_env).split())
+    return (package_name, cflags, ldflags)
+
+
+def _cgo_flags_override(env, flags, **extra):
+    """
+    Construction variable overrides adding extra and flags (as returned by ParseFlags) to
+    the values in env, extra first
+    """
+    overrides = {}
+    for key in set(flags) | set(extra):
+        if not (flags.get(key) or extra.get(key)):
+            continue
+        current = env.get(key) or []
+        if not is_List(current):
+            current = [current]
+        overrides[key] = list(extra.get(key, [])) + list(current) + list(flags.get(key, []))
+    return overrides
+
+
+def _go_cgo_package(env, import_path, files, cgo_files, archive):
+    """
+    Set up the cgo part of a goPackageProgram package, as go build does it but with each
+    step a target: go tool cgo writes the go and C shims for the cgo files (goCgo), the
+    shims and the package's C files are compiled with SCons' own C builders (so their
+    headers are found by the CPPPATH scanner, and each object is only rebuilt when it
+    changed), linked into _cgo_.o to find the dynamic imports (goCgoImport), and the
+    objects are added to the package archive once compiled.
+    :param archive: the package's archive node, the cgo files are written beside it
+    :return: (go files to compile, C object nodes)
+    """
+    if 'Object' not in env['BUILDERS'] or 'Program' not in env['BUILDERS']:
+        raise SCons.Errors.UserError("Package %s uses cgo, which needs a C compiler tool in the Environment"
+                                     % import_path)
+
+    pkg_dir = files[0].dir
+    objdir = env.fs.Dir(archive.abspath[:-len('.a')] + '.cgo')
+    (package_name, cflags, ldflags) = _cgo_directives(env, cgo_files)
+
+    c_env = env.Override(_cgo_flags_override(env, env.ParseFlags(env.subst('$CGO_CFLAGS'), cflags),
+                                             CPPPATH=[pkg_dir, objdir]))
+
+    names = ['_cgo_gotypes.go', '_cgo_main.c', '_cgo_export.c', '_cgo_export.h', '_cgo_flags']
+    for f in cgo_files:
+        names.extend([f.name[:-3] + '.cgo1.go', f.name[:-3] + '.cgo2.c'])
+    # c_env, so the headers included by the preambles are found by cgoScanner
+    generated = _env_call(c_env, 'goCgo', [objdir.File(n) for n in names], cgo_files,
+                          GOPACKAGEPATH=import_path, GOCGOFLAGS=cflags)
+
+    goos = _go_var(env, 'GOOS')
+    goarch = _go_var(env, 'GOARCH')
+    c_sources = [n for n in generated if n.name.endswith('.cgo2.c') or n.name == '_cgo_export.c']
+    c_sources.extend(pkg_dir.File(n) for n in sorted(os.listdir(pkg_dir.abspath))
+                     if n.endswith('.c') and _go_file_name_included(n, goos, goarch))
+    # Named explicitly, SCons wouldn't add OBJSUFFIX to x.cgo2
+    objsuffix = env.subst('$OBJSUFFIX')
+    objects = [_env_call(c_env, 'Object', objdir.File(c.name[:-len('.c')] + objsuffix), c)[0]
+               for c in c_sources]
+    cgo_main = _env_call(c_env, 'Object', objdir.File('_cgo_main' + objsuffix),
+                         objdir.File('_cgo_main.c'))[0]
+
+    link_env = env.Override(_cgo_flags_override(env, env.ParseFlags(env.subst('$CGO_LDFLAGS'), ldflags)))
+    dynobj = _env_call(link_env, 'Program', os.path.join(objdir.abspath, '_cgo_.o'), [cgo_main] + objects)[0]
+    dynimport = _env_call(env, 'goCgoImport', objdir.File('_cgo_import.go'), dynobj,
+                          GOCGOPACKAGE=package_name)[0]
+
+    go_sources = [f for f in files if f not in cgo_files]
+    go_sources.extend(n for n in generated if n.name.endswith('.go'))
+    go_sources.append(dynimport)
+    return (go_sources, objects)
+
+
+def _go_pack_objects(target, source, env):
+    """
+    Add the C objects of a cgo package (GOPACKOBJS) to its archive
+    """
+    objects = env.get('GOPACKOBJS')
+    if not objects:
+        return 0
+    cmd = [env.subst('$GO'), 'tool', 'pack', 'r', target[0].abspath] + [o.abspath for o in objects]
+    start = time.time()
+    status = subprocess.call(cmd, env=_create_env_for_subprocess(env))
+    _trace.record('pack', target, start, time.time(), status=status)
+    return status
+
+
+def _go_pack_objects_str(target, source, env):
+    if not env.get('GOPACKOBJS'):
+        return None
+    return env.subst('$GO tool pack r $TARGET $GOPACKOBJS', target=target, source=source)
+
+
+def goPackageProgram(env, target, source, **kw):
+    """
+    Build a go program by compiling each package it imports to its own archive
+    (goPackage, go tool compile) and linking those (goLink, go tool link), rather than
+    in a single go build. SCons can then compile packages in parallel and only recompile
+    the packages which changed.
+    :param env:
+    :param target: the program
+    :param source: go files of the main package
+    :return: list of target nodes
+    """
+    if kw:
+        env = env.Override(kw)
+    env = env.Override({'ENV': _go_target_env(env)})
+
+    path = FindPathDirs('GOPATH')(env)
+    sources = env.arg2nodes(source, env.fs.File)
+    program = env.arg2nodes(target, env.fs.File)[0]
+
+    main_archive = _go_package_archive(env, 'main', sources, path,
+                                       os.path.join(env.subst('$GOPKGDIR'), '_main', program.name + '.a'), [])
+    targets = _env_call(env, 'goLink', program, main_archive)
+    # The archives themselves are only needed by the linker
+    env.Depends(targets, sorted(_go_package_closure(main_archive)[0][1:], key=str))
+    return targets
+
+
+def _package_files(env, dir_node, tests=False):
+    """
+    The go files of the package in dir_node which go would build
+    :param tests: include _test.go files, as go test does
+    :return: list of File nodes
+    """
+    try:
+        names = sorted(n for n in os.listdir(dir_node.abspath) if n.endswith('.go'))
+    except OSError:
+        names = []
+    files = [dir_node.File(n) for n in names]
+    # Also pick up go files which will be generated by the build
+    for node in list(dir_node.entries.values()):
+        if node.name.endswith('.go') and node.name not in names and node.has_builder():
+            files.append(node)
+    files.sort(key=lambda f: f.name)
+    return [f for f in files if include_go_file(env, f, tests)]
+
+
+def _package_asm_files(env, dir_node):
+    """
+    The assembly files (.s, and .S for cgo) of the package in dir_node which go would
+    build, as far as their names tell
+    :return: list of file names
+    """
+    (goos, goarch) = _go_configuration(env)[:2]
+    try:
+        names = sorted(os.listdir(dir_node.abspath))
+    except OSError:
+        names = []
+    return [n for n in names if n.endswith(('.s', '.S')) and _go_file_name_included(n, goos, goarch)]
+
+
+def _package_test_files(env, dir_node):
+    """
+    The go files of the package in dir_node which go test would build, test files included
+    :return: (list of File nodes, whether any of them is a test file)
+    """
+    files = _package_files(env, dir_node, tests=True)
+    return (files, any(f.name.endswith('_test.go') for f in files))
+
+
+def _go_test_list(binary, cwd, subp_env):
+    """
+    :return: names of the tests, examples, benchmarks and fuzz targets in a test binary
+    """
+    output = _to_str(subprocess.check_output([binary, '-test.list', '.'], cwd=cwd, env=subp_env))
+    return sorted(line.strip() for line in output.splitlines() if m_ident.match(line.strip() or '-'))
+
+
+def _go_run_test(target, source, env):
+    """
+    Run a test binary (source[0]) in its package directory, or the GOTESTSHARD'th of
+    GOTESTSHARDS shards of its tests. The output is written to target only if the tests
+    pass, and printed if they fail.
+    """
+    binary = source[0].abspath
+    cwd = env['GOTESTCWD']
+    subp_env = _create_env_for_subprocess(env)
+    cmd = [binary] + env.subst('$GOTESTRUNFLAGS', target=target, source=source).split()
+
+    shards = int(env.get('GOTESTSHARDS', 1))
+    if shards > 1:
+        names = _go_test_list(binary, cwd, subp_env)[int(env['GOTESTSHARD'])::shards]
+        if not names:
+            with open(target[0].abspath, 'w') as f:
+                f.write('no tests in this shard\n')
+            return 0
+        cmd.append('-test.run=^(%s)$' % '|'.join(names))
+
+    start = time.time()
+    with _stats.timer('go test run'):
+        proc = subprocess.Popen(cmd, cwd=cwd, env=subp_env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = _to_str(proc.communicate()[0])
+    _trace.record('test', target, start, time.time(), status=proc.returncode)
+
+    if proc.returncode:
+        sys.stdout.write(output)
+        if os.path.exists(target[0].abspath):
+            os.unlink(target[0].abspath)
+        return proc.returncode
+
+    with open(target[0].abspath, 'w') as f:
+        f.write(output)
+    return 0
+
+
+def _go_test_shard(target, source, env, for_signature):
+    shards = int(env.get('GOTESTSHARDS', 1))
+    if shards > 1:
+        return ' (shard %d of %d)' % (int(env['GOTESTSHARD']) + 1, shards)
+    return ''
+
+
+def goTest(env, target, source, shards=None, **kw):
+    """
+    Compile the tests of a package into a test binary (go test -c) and run it. Each run is
+    a target, written only when the tests pass, whose signature covers the test binary and
+    the package's go files, test files included, and every package they import, directly
+    or not. Packages whose sources haven't changed therefore aren't tested again, and
+    packages are compiled and tested in parallel with -j.
+    :param env:
+    :param target: name of the test binary, without GOTESTSUFFIX. Results are written to
+                   target + GOTESTRESULTSUFFIX, or target.N + GOTESTRESULTSUFFIX for shards
+    :param source: the package directory
+    :param shards: split the tests into this many targets, run in parallel (default
+                   GOTESTSHARDS)
+    :return: list of result nodes, empty if the package has no test files
+    """
+    if kw:
+        env = env.Override(kw)
+    env = env.Override({'ENV': _go_target_env(env)})
+
+    dir_node = env.arg2nodes(source, env.fs.Dir)[0]
+    (files, has_tests) = _package_test_files(env, dir_node)
+    if not has_tests:
+        if go_debug: print("goTest: no test files in %s" % dir_node)
+        return []
+
+    target = env.subst(target)
+    binary = _env_call(env, 'goTestBinary', target + env.subst('$GOTESTSUFFIX'), files)
+    if shards is None:
+        shards = int(env.get('GOTESTSHARDS', 1))
+
+    results = []
+    suffix = env.subst('$GOTESTRESULTSUFFIX')
+    for shard in range(shards):
+        name = target + suffix if shards == 1 else '%s.%d%s' % (target, shard + 1, suffix)
+        results.extend(_env_call(env, 'goTestResult', name, binary + files, GOTESTCWD=dir_node.abspath,
+                                 GOTESTSHARD=shard, GOTESTSHARDS=shards))
+    return results
+
+
+def _go_generate_directives(node):
+    """
+    :param node: go File node
+    :return: list of (line number, directive line, command) of its //go:generate directives
+    """
+    text = node.get_text_contents()
+    return [(text.count('\n', 0, m.start()) + 1, m.group(0).rstrip(), m.group(1))
+            for m in m_go_generate.finditer(text)]
+
+
+def _go_generate_words(env, node, line, command):
+    """
+    Split a //go:generate command into words as go generate does, expanding the
+    variables go generate sets
+    """
+    m = m_package_clause.search(node.get_text_contents())
+    variables = {'GOFILE': node.name, 'GOLINE': str(line), 'GOPACKAGE': m and m.group(1) or '',
+                 'GOOS': _go_var(env, 'GOOS'), 'GOARCH': _go_var(env, 'GOARCH'), 'DOLLAR': '$'}
+    words = []
+    for word in m_go_generate_word.findall(command):
+        if word.startswith('"'):
+            word = re.sub(r'\\(.)', r'\1', word[1:-1])
+        words.append(re.sub(r'\$(\w+)', lambda v: variables.get(v.group(1), v.group(0)), word))
+    return words
+
+
+# Flags naming the output file of common generators (mockgen's -destination, stringer's
+# -output, ...)
+_go_generate_output_flags = frozenset(['o', 'out', 'output', 'destination'])
+
+# Flags whose value may be the next word
+_go_generate_value_flags = _go_generate_output_flags | frozenset(['type', 'I', 'proto_path'])
+
+
+def _go_generate_io(words):
+    """
+    Find the files a generator writes and reads, from its arguments: the value of an
+    output flag, stringer's default output, and the files protoc generates with
+    paths=source_relative, with their .proto files as inputs
+    :param words: the generator's command, see _go_generate_words
+    :return: (outputs, inputs), paths relative to the directory of the go file
+    """
+    (outputs, inputs) = ([], [])
+    flags = {}
+    args = []
+    i = 1
+    while i < len(words):
+        word = words[i]
+        if word.startswith('-') and len(word) > 1:
+            (name, eq, value) = word.lstrip('-').partition('=')
+            if not eq and name in _go_generate_value_flags and i + 1 < len(words):
+                i += 1
+                value = words[i]
+            flags.setdefault(name, []).append(value)
+        else:
+            args.append(word)
+        i += 1
+
+    for name in _go_generate_output_flags:
+        outputs.extend(flags.get(name, []))
+    generator = os.path.basename(words[0]) if words else ''
+    if generator == 'stringer' and not outputs and flags.get('type'):
+        outputs.append(flags['type'][0].split(',')[0].lower() + '_string.go')
+    elif generator == 'protoc':
+        protos = [a for a in args if a.endswith('.proto')]
+        includes = flags.get('I', []) + flags.get('proto_path', [])
+        inputs.extend(protos)
+        for (plugin, suffix) in (('go', '.pb.go'), ('go-grpc', '_grpc.pb.go')):
+            for out in flags.get(plugin + '_out', []):
+                (opts, colon, out_dir) = out.rpartition(':')
+                opts = opts.split(',') + flags.get(plugin + '_opt', [])
+                if 'paths=source_relative' not in opts:
+                    # Written under their go_package import paths
+                    continue
+                for proto in protos:
+                    for include in includes:
+                        if proto.startswith(include.rstrip('/') + '/'):
+                            proto = proto[len(include.rstrip('/')) + 1:]
+                            break
+                    outputs.append(os.path.normpath(os.path.join(out_dir, proto[:-len('.proto')] + suffix)))
+    return (outputs, inputs)
+
+
+def _re2_escape(text):
+    """Escape text for a regular expression of go's regexp package"""
+    return re.sub(r'([\\.+*?()|\[\]{}^$])', r'\\\1', text)
+
+
+def _go_generate_stamp(target, source, env):
+    for node in target:
+        if getattr(node.attributes, 'go_generate_stamp', False):
+            with open(node.get_abspath(), 'w'):
+                pass
+    return 0
+
+
+def goGenerate(env, source, outputs=None, **kw):
+    """
+    Run the //go:generate directives of go files as SCons actions, one per directive, each
+    a go generate -run of that directive. A directive's targets are the files it
+    generates, found from its arguments (see _go_generate_io) or given in outputs, and
+    its sources are the go file, the package's other go files, the files found from its
+    arguments and the generator itself, so generators only run again when one of these
+    changes, and independent generators run in parallel with -j. The generated go files
+    are picked up by the scanner as part of their package. A directive whose outputs
+    aren't known gets a stamp file in GOGENERATEDIR as its target.
+    :param env:
+    :param source: go files or package directories
+    :param outputs: dictionary of directive command (the text after //go:generate) ->
+                    list of the files it generates, relative to the go file's directory
+    :return: list of target nodes
+    """
+    if kw:
+        env = env.Override(kw)
+    outputs = outputs or {}
+
+    directives = []
+    for node in env.arg2nodes(source, env.fs.Entry):
+        node = node.disambiguate()
+        if isinstance(node, SCons.Node.FS.Dir):
+            files = [f for f in _package_files(env, node) if not f.has_builder()]
+        else:
+            files = [node]
+        for go_file in files:
+            for (n, (line, text, command)) in enumerate(_go_generate_directives(go_file)):
+                words = _go_generate_words(env, go_file, line, command)
+                (found, inputs) = _go_generate_io(words)
+                generated = [go_file.dir.File(o) for o in outputs.get(command, found)]
+                directives.append((go_file, n, text, words, generated, inputs))
+
+    # The package's own files, but not those generated by any of the directives
+    generated = set(t for d in directives for t in d[4])
+    targets = []
+    for (go_file, n, text, words, generated_files, inputs) in directives:
+        sources = [go_file] + [f for f in _package_files(env, go_file.dir)
+                               if f != go_file and f not in generated and not f.has_builder()]
+        sources.extend(go_file.dir.File(i) for i in inputs)
+        if words and words[0] != 'go':
+            generator = (os.sep in words[0] or '/' in words[0]) and go_file.dir.File(words[0]).abspath \
+                or env.WhereIs(words[0], path=env['ENV'].get('PATH'))
+            if generator and os.path.isfile(generator):
+                sources.append(env.File(generator))
+
+        if not generated_files:
+            stamp = env.Dir('$GOGENERATEDIR').File('%s.%d' % (go_file.path, n))
+            stamp.attributes.go_generate_stamp = True
+            generated_files = [stamp]
+        targets.extend(_env_call(env, 'goGenerateDirective', generated_files, sources,
+                                 GOGENERATERUN=SCons.Subst.Literal('^%s$' % _re2_escape(text))))
+    return targets
+
+
+def _go_platform_overrides(env, platform):
+    """
+    Construction variables for one platform of a goProgramMatrix
+    :param platform: 'GOOS/GOARCH' or a dictionary of construction variables
+    :return: dictionary
+    """
+    if is_String(platform):
+        (goos, goarch) = env.subst(platform).split('/')
+        overrides = {'GOOS': goos, 'GOARCH': goarch}
+    else:
+        overrides = dict(platform)
+    goos = overrides.setdefault('GOOS', _go_var(env, 'GOOS'))
+    goarch = overrides.setdefault('GOARCH', _go_var(env, 'GOARCH'))
+
+    # Host toolchain values are probed once, with env, rather than once per platform.
+    # Like go, cgo is off by default when cross compiling.
+    for variable in ('GOHOSTOS', 'GOHOSTARCH', 'GOVERSION', 'GOROOT', 'GOTOOLDIR'):
+        overrides.setdefault(variable, _go_var(env, variable))
+    cross = (goos, goarch) != (overrides['GOHOSTOS'], overrides['GOHOSTARCH'])
+    overrides.setdefault('CGO_ENABLED', not cross and _go_cgo_enabled(env))
+    overrides.setdefault('GOEXE', goos == 'windows' and '.exe' or '')
+    overrides.setdefault('PROGSUFFIX', '$GOEXE')
+    overrides.setdefault('GO_SYSTEM_PACKAGES', _get_system_packages(env))
+    return overrides
+
+
+def goProgramMatrix(env, target, source, platforms=None, builder='goProgram', **kw):
+    """
+    Build a go program for several platforms. Each configuration's targets are built in
+    its own directory, GOMATRIXDIR (default #build/${GOOS}_${GOARCH}), the toolchain is
+    probed once and source files are parsed once for all of them: only the file name and
+    build constraint filters are evaluated per configuration, see GoPlatformMatrix.
+    :param env:
+    :param target: the program, relative to GOMATRIXDIR
+    :param source: go files of the main package
+    :param platforms: list of 'GOOS/GOARCH' strings or dictionaries of construction
+                      variables (default GOPLATFORMS)
+    :param builder: goProgram or goPackageProgram
+    :return: list of target nodes of every configuration
+    """
+    if kw:
+        env = env.Override(kw)
+    if platforms is None:
+        platforms = env['GOPLATFORMS']
+
+    config_envs = [env.Override(_go_platform_overrides(env, p)) for p in platforms]
+    matrix = GoPlatformMatrix((_go_var(e, 'GOOS'), _go_var(e, 'GOARCH'), _get_all_tags(e))
+                              for e in config_envs)
+
+    targets = []
+    for (i, config_env) in enumerate(config_envs):
+        config_env = config_env.Override({'_go_matrix': matrix,
+                                          '_go_matrix_bit': 1 << i,
+                                          'ENV': _go_target_env(config_env)})
+        program = os.path.join(config_env.subst('$GOMATRIXDIR'), config_env.subst(target))
+        targets.extend(_env_call(config_env, builder, program, source))
+    return targets
+
+
+# Major version elements of module paths (/v2), which go skips when naming programs
+m_major_version = re.compile(r'v(?:[2-9]|[1-9][0-9]+)$')
+
+
+def _go_program_name(import_path, module_mode):
+    """
+    Name go build gives the program of the main package import_path: its last element,
+    skipping a major version element (/v2) in module mode
+    """
+    elements = import_path.split('/')
+    if module_mode and len(elements) > 1 and m_major_version.match(elements[-1]):
+        elements.pop()
+    return elements[-1]
+
+
+def _go_exec_name(env, dir_node):
+    """
+    File name of the program go build writes for the main package in dir_node
+    """
+    dir_path = dir_node.abspath
+    resolver = _get_import_resolver(env, FindPathDirs('GOPATH')(env))
+    import_path = None
+    if resolver.module_mode:
+        mod_file = _find_up(dir_path, 'go.mod')
+        module_path = mod_file and _parse_mod_file(mod_file)['module']
+        if module_path:
+            rel = os.path.relpath(dir_path, os.path.dirname(mod_file))
+            import_path = module_path if rel == '.' else module_path + '/' + rel.replace(os.sep, '/')
+    else:
+        import_path = resolver._gopath_import_path(dir_path)
+    return _go_program_name(import_path or dir_node.name, resolver.module_mode) + (_go_var(env, 'GOEXE') or '')
+
+
+def _go_batched(targets):
+    return bool(targets) and getattr(targets[0].attributes, 'go_batch', False)
+
+
+class _GoBuildAction(_GoCommandAction):
+    """
+    The go build of goProgram. With GOBATCH set, programs built from all the go files of
+    a package directory are batched with the others using the same go command, flags,
+    tags and ENV (so GOOS and GOARCH), see batch_key. The out of date programs of a batch
+    are then built by a single go build -o DIR/ of their package directories, paying for
+    the toolchain startup and the loading of shared packages once, and moved from DIR
+    (in GOBATCHDIR) to their targets.
+    """
+
+    def __init__(self, cmd, kind, **kw):
+        # Only the out of date programs of a batch are removed before it's built
+        kw.setdefault('targets', '$CHANGED_TARGETS')
+        _GoCommandAction.__init__(self, cmd, kind, **kw)
+        self.batch_action = _GoCommandAction('$GOBATCHCOM', 'build', cmdstr='$GOBATCHCOMSTR')
+
+    def batch_key(self, env, target, source):
+        if not env.get('GOBATCH') or len(target) != 1 or not source:
+            return None
+        dir_node = source[0].dir
+        if any(s.dir != dir_node or not s.name.endswith('.go') for s in source):
+            return None
+        if set(source) != set(_package_files(env, dir_node)):
+            # go build of the directory would build other files
+            return None
+        target[0].attributes.go_batch = True
+        return (id(self), env.subst('$GO ${_go_tags_flag} $GOFLAGS $GOEXE', target=target, source=source),
+                tuple(sorted((k, str(v)) for (k, v) in env['ENV'].items())))
+
+    def _batch_builds(self, env, executor):
+        """
+        Group the out of date programs of a batch into go builds, each of which writes a
+        program name once
+        :return: list of (output Dir node, [(target, package Dir node, program name)])
+        """
+        changed = set(executor.get_action_targets())
+        pending = []
+        for batch in executor.batches:
+            if batch.targets[0] in changed:
+                dir_node = batch.sources[0].dir
+                pending.append((batch.targets[0], dir_node, _go_exec_name(env, dir_node)))
+
+        key = hashlib.md5(executor.batches[0].targets[0].get_abspath().encode('utf-8')).hexdigest()[:12]
+        builds = []
+        while pending:
+            (build, rest, names) = ([], [], set())
+            for item in pending:
+                (rest if item[2] in names else build).append(item)
+                names.add(item[2])
+            builds.append((env.Dir('$GOBATCHDIR').Dir('%s.%d' % (key, len(builds))), build))
+            pending = rest
+        return builds
+
+    def _build_env(self, env, out_dir, programs):
+        return env.Override({'GOBATCHOUT': out_dir,
+                             'GOBATCHPACKAGES': [_go_dir_pattern(env.Dir('#').abspath, p[1].get_abspath())
+                                                 for p in programs]})
+
+    def get_presig(self, target, source, env, executor=None):
+        if not _go_batched(target):
+            return _GoCommandAction.get_presig(self, target, source, env, executor)
+        # Without the batch's directories, so that adding a program to a batch doesn't
+        # rebuild the others
+        return _go_action_signature(env, env.subst_target_source('$GOBATCHCOM', SCons.Subst.SUBST_SIG,
+                                                                 target, source))
+
+    def strfunction(self, target, source, env, executor=None):
+        if executor is None or not _go_batched(target):
+            return _GoCommandAction.strfunction(self, target, source, env, executor)
+        return '\n'.join(self.batch_action.strfunction([p[0] for p in programs], [],
+                                                       self._build_env(env, out_dir, programs))
+                         for (out_dir, programs) in self._batch_builds(env, executor))
+
+    def execute(self, target, source, env, executor=None):
+        if executor is None or not _go_batched(target):
+            return _GoCommandAction.execute(self, target, source, env, executor)
+        for (out_dir, programs) in self._batch_builds(env, executor):
+            if not os.path.isdir(out_dir.get_abspath()):
+                os.makedirs(out_dir.get_abspath())
+            status = self.batch_action.execute([p[0] for p in programs], [],
+                                               self._build_env(env, out_dir, programs))
+            if status:
+                return status
+            for (program, dir_node, name) in programs:
+                if os.path.exists(program.get_abspath()):
+                    os.remove(program.get_abspath())
+                shutil.move(os.path.join(out_dir.get_abspath(), name), program.get_abspath())
+        return 0
+
+
+def _go_pkgdir_tags(target, source, env, for_signature):
+    """
+    Keep archives built with different GOTAGS apart in GOPKGDIR
+    """
+    if env['GOTAGS']:
+        return '_' + '_'.join(sorted(env['GOTAGS']))
+    return ''
+
+
 def generate(env):
     go_suffix = '.go'
 
@@ -502,26 +4186,51 @@ def generate(env):
     # Only honor user provide GOROOT. otherwise don't specify.
     env['ENV']['GOPATH'] = env['ENV'].get('GOPATH',env.get('GOPATH','.'))
 
-    # Populate GO_SYSTEM_PACKAGES
-    # TODO: Add documentation for GO_SYSTEM_PACKAGES
-    _get_system_packages(env)
+    # Persistent cache of parsed imports and // +build statements. Set to None to disable.
+    env['GO_SCAN_CACHE'] = env.get('GO_SCAN_CACHE', '#.sconsign_goscan')
+    env['GO_SCAN_CACHE_MAX_AGE'] = env.get('GO_SCAN_CACHE_MAX_AGE', 10)
 
-    _get_go_version_vendor(env)
+    # Number of processes used to parse go files ahead of the scanner, see goPrescan
+    env['GO_SCAN_JOBS'] = env.get('GO_SCAN_JOBS', 0)
+    env['GO_SCANNER_BACKEND'] = env.get('GO_SCANNER_BACKEND', 'python')
 
-    _get_go_env_values(env)
+    # 'tokens' to ignore comment and formatting changes to go files, see go_token_decider
+    env['GO_SIGNATURES'] = env.get('GO_SIGNATURES', 'content')
+    _go_signature_env(env)
+
+    # The toolchain is only probed when one of these is first needed, and the results
+    # are shared with every other Environment using the same go binary and ENV.
+    # GO_SYSTEM_PACKAGES is likewise determined on first use unless set by the user.
+    # The target platform set in ENV is left out of the toolchain's (see _toolchain_env),
+    # and taken as is.
+    # TODO: Add documentation for GO_SYSTEM_PACKAGES
+    for variable in ('GOOS', 'GOARCH', 'CGO_ENABLED'):
+        if variable not in env and env['ENV'].get(variable):
+            env[variable] = env['ENV'][variable]
+    for variable in _toolchain_variables:
+        if variable not in env:
+            env[variable] = GoToolchainVariable(variable)
 
     goSuffixes = [".go"]
 
     # compileAction = Action("$GOCOM","$GOCOMSTR")
 
-    linkAction = Action("$GOLINK","$GOLINKSTR")
+    linkAction = _GoBuildAction("$GOLINK", 'build', cmdstr="$GOLINKSTR")
 
     goScanner = Scanner(function=imported_modules,
                         scan_check=check_go_file,
                         name="goScanner",
                         skeys=goSuffixes,
                         path_function=FindPathDirs('GOPATH'),
-                        recursive=True)
+                        # Package Alias nodes are returned as is
+                        node_class=SCons.Node.Node)
+
+    goTestScanner = Scanner(function=imported_test_modules,
+                            scan_check=check_go_test_file,
+                            name="goTestScanner",
+                            skeys=goSuffixes,
+                            path_function=FindPathDirs('GOPATH'),
+                            node_class=SCons.Node.Node)
 
     goProgram = Builder(action=linkAction,
                         prefix="$PROGPREFIX",
@@ -531,6 +4240,64 @@ def generate(env):
                         src_builder="goObject")
     env["BUILDERS"]["goProgram"] = goProgram
 
+    goPackage = Builder(action=[Action(_go_compile_importcfg, None),
+                                _GoCommandAction('$GOCOMPILECOM', 'compile', cmdstr='$GOCOMPILECOMSTR'),
+                                Action(_go_pack_objects, _go_pack_objects_str, varlist=['GOPACKOBJS'])],
+                        emitter=_go_package_emitter,
+                        suffix='.a',
+                        src_suffix='.go')
+    env["BUILDERS"]["goPackage"] = goPackage
+
+    # Finds the headers #included by the preambles of the go files, on CPPPATH
+    cgoScanner = SCons.Scanner.ClassicCPP("cgoScanner", goSuffixes, "CPPPATH",
+                                          r'^[ \t]*(?://)?[ \t]*#[ \t]*include[ \t]*(<|")([^>"]+)(>|")')
+    goCgo = Builder(action=_GoCommandAction('$GOCGOCOM', 'cgo', cmdstr='$GOCGOCOMSTR'),
+                    source_scanner=cgoScanner)
+    env["BUILDERS"]["goCgo"] = goCgo
+
+    goCgoImport = Builder(action=_GoCommandAction('$GOCGOIMPORTCOM', 'cgo -dynimport',
+                                                  cmdstr='$GOCGOIMPORTCOMSTR'))
+    env["BUILDERS"]["goCgoImport"] = goCgoImport
+
+    goLink = Builder(action=[Action(_go_link_importcfg, None),
+                             _GoCommandAction('$GOPKGLINKCOM', 'link', cmdstr='$GOPKGLINKCOMSTR')],
+                     emitter=_go_importcfg_emitter,
+                     prefix="$PROGPREFIX",
+                     suffix="$PROGSUFFIX",
+                     src_suffix='.a')
+    env["BUILDERS"]["goLink"] = goLink
+
+    goTestBinary = Builder(action=_GoCommandAction('$GOTESTCOM', 'test -c', cmdstr='$GOTESTCOMSTR'),
+                           source_scanner=goTestScanner,
+                           src_suffix='.go')
+    env["BUILDERS"]["goTestBinary"] = goTestBinary
+
+    goTestResult = Builder(action=Action(_go_run_test, '$GOTESTRUNCOMSTR',
+                                         varlist=['GOTESTRUNFLAGS', 'GOTESTSHARD', 'GOTESTSHARDS']),
+                           source_scanner=goTestScanner)
+    env["BUILDERS"]["goTestResult"] = goTestResult
+
+    goGenerateDirective = Builder(action=[_GoCommandAction('$GOGENERATECOM', 'generate',
+                                                           cmdstr='$GOGENERATECOMSTR'),
+                                          Action(_go_generate_stamp, None)])
+    env["BUILDERS"]["goGenerateDirective"] = goGenerateDirective
+
+    env.AddMethod(goPackageProgram, 'goPackageProgram')
+    env.AddMethod(goTest, 'goTest')
+    env.AddMethod(goGenerate, 'goGenerate')
+    env.AddMethod(goProgramMatrix, 'goProgramMatrix')
+    env.AddMethod(goPrescan, 'goPrescan')
+
+    _add_stats_option()
+    if _get_option('go_trace'):
+        _trace.enabled = True
+
+    # Watch go files for changes, for long running builds (scons --interactive)
+    env['GO_WATCH'] = env.get('GO_WATCH', os.environ.get('GO_WATCH', '') not in ('', '0'))
+    env['GO_WATCH_INTERVAL'] = env.get('GO_WATCH_INTERVAL', os.environ.get('GO_WATCH_INTERVAL', 0.2))
+    if env['GO_WATCH']:
+        _start_watcher(env)
+
     # goLibrary = SCons.Builder.Builder(action=SCons.Defaults.ArAction,
     #                                   prefix="$LIBPREFIX",
     #                                   suffix="$LIBSUFFIX",
@@ -547,25 +4314,83 @@ def generate(env):
     #                    source_scanner=goScanner)
     # env["BUILDERS"]["goObject"] = goObject
 
-    # initialize GOOS and GOARCH
+    # GOOS and GOARCH are initialized with the toolchain's variables above
     # TODO: Validate the values of each to make sure they are valid for GO.
     # TODO: Document all the GO variables.
 
-    env['GOOS']   = env.get('GOOS',env['GOHOSTOS'])
-    env['GOARCH'] = env.get('GOARCH',env['GOHOSTARCH'])
-
     env['_go_tags_flag'] = _go_tags
 
-    env["GOFLAGS"] = env["GOFLAGS"] or None
+    env["GOFLAGS"] = env.get("GOFLAGS") or None
 
     if 'GOTAGS' not in env:
         env['GOTAGS'] = []
 
-    env['GOCOM'] = '$GO build -o $TARGET ${_go_tags_flag} $GOFLAGS $SOURCES'
+    # CPU and memory (in MB) shared by the go actions, see GoJobBudget. Off unless
+    # GO_CPU_BUDGET is set, scons' -j then being the only limit
+    env['GO_CPU_BUDGET'] = env.get('GO_CPU_BUDGET', 0)
+    env['GO_MEMORY_BUDGET'] = env.get('GO_MEMORY_BUDGET', _physical_memory())
+    env['GO_ACTION_MEMORY'] = env.get('GO_ACTION_MEMORY', 512)
+
+    # Builds which don't depend on the checkout's location, see _go_action_signature
+    env['GO_REPRODUCIBLE'] = env.get('GO_REPRODUCIBLE', False)
+    env['_go_trimpath_flag'] = _go_trimpath_flag
+    env['_go_compile_trimpath'] = _go_compile_trimpath
+
+    env['GOCOM'] = '$GO build -o $TARGET $_go_trimpath_flag ${_go_tags_flag} $GOFLAGS $SOURCES'
     env['GOCOMSTR'] = '$GOCOM'
-    env['GOLINK'] = '$GO build -o $TARGET $_go_tags_flag $GOFLAGS $SOURCES'
+    env['GOLINK'] = '$GO build -o $TARGET $_go_trimpath_flag $_go_tags_flag $GOFLAGS $SOURCES'
     env['GOLINKSTR'] = '$GOLINK'
 
+    # Batched goProgram builds, see _GoBuildAction
+    env['GOBATCH'] = env.get('GOBATCH', False)
+    env['GOBATCHDIR'] = env.get('GOBATCHDIR', '#.gobatch')
+    env['GOBATCHCOM'] = '$GO build -o ${GOBATCHOUT}/ $_go_trimpath_flag $_go_tags_flag $GOFLAGS $GOBATCHPACKAGES'
+    env['GOBATCHCOMSTR'] = '$GOBATCHCOM'
+
+    # Per package compilation, see goPackageProgram
+    env['GOPKGDIR'] = env.get('GOPKGDIR', '#pkg/${GOOS}_${GOARCH}${_go_pkgdir_tags}')
+    env['_go_pkgdir_tags'] = _go_pkgdir_tags
+    env['GOCOMPILE'] = '$GO tool compile'
+    env['GOCOMPILEFLAGS'] = env.get('GOCOMPILEFLAGS', '')
+    env['GOCOMPILECOM'] = ('$GOCOMPILE -o ${TARGETS[2]} -linkobj $TARGET -p $GOPACKAGEPATH -pack '
+                           '-importcfg ${TARGETS[1]} $_go_compile_trimpath $GOCOMPILEFLAGS $SOURCES')
+    env['GOCOMPILECOMSTR'] = '$GOCOMPILECOM'
+    env['GOLINKER'] = '$GO tool link'
+    env['GOLDFLAGS'] = env.get('GOLDFLAGS', '')
+    env['GOPKGLINKCOM'] = ('$GOLINKER -o $TARGET -importcfg ${TARGETS[1]} -buildmode=exe '
+                           '${CC and "-extld=" + CC or ""} $GOLDFLAGS $SOURCE')
+    env['GOPKGLINKCOMSTR'] = '$GOPKGLINKCOM'
+
+    # cgo packages of goPackageProgram
+    env['CGO_CFLAGS'] = env.get('CGO_CFLAGS', '-O2 -g -fPIC -pthread')
+    env['CGO_LDFLAGS'] = env.get('CGO_LDFLAGS', '-O2 -g -pthread')
+    env['GOCGOCOM'] = ('$GO tool cgo -objdir ${TARGET.dir} -importpath $GOPACKAGEPATH -- '
+                       '-I ${TARGET.dir} -I ${SOURCE.dir} $CGO_CFLAGS $GOCGOFLAGS ${SOURCES.abspath}')
+    env['GOCGOCOMSTR'] = '$GOCGOCOM'
+    env['GOCGOIMPORTCOM'] = '$GO tool cgo -dynpackage $GOCGOPACKAGE -dynimport $SOURCE -dynout $TARGET'
+    env['GOCGOIMPORTCOMSTR'] = '$GOCGOIMPORTCOM'
+
+    # goProgramMatrix
+    env['GOMATRIXDIR'] = env.get('GOMATRIXDIR', '#build/${GOOS}_${GOARCH}')
+    env['GOPLATFORMS'] = env.get('GOPLATFORMS', ['$GOHOSTOS/$GOHOSTARCH'])
+
+    # goTest
+    env['GOTESTSUFFIX'] = env.get('GOTESTSUFFIX', '.test')
+    env['GOTESTRESULTSUFFIX'] = env.get('GOTESTRESULTSUFFIX', '.result')
+    env['GOTESTFLAGS'] = env.get('GOTESTFLAGS', '')
+    env['GOTESTRUNFLAGS'] = env.get('GOTESTRUNFLAGS', '')
+    env['GOTESTSHARDS'] = env.get('GOTESTSHARDS', 1)
+    env['GOTESTCOM'] = '$GO test -c -o $TARGET $_go_trimpath_flag $_go_tags_flag $GOFLAGS $GOTESTFLAGS ${SOURCE.dir.abspath}'
+    env['GOTESTCOMSTR'] = '$GOTESTCOM'
+    env['_go_test_shard'] = _go_test_shard
+    env['GOTESTRUNCOMSTR'] = 'Testing ${SOURCES[1].dir}${_go_test_shard}'
+
+    # goGenerate
+    env['GOGENERATEDIR'] = env.get('GOGENERATEDIR', '#.gogenerate')
+    env['GOGENERATEFLAGS'] = env.get('GOGENERATEFLAGS', '')
+    env['GOGENERATECOM'] = '$GO generate $_go_tags_flag $GOGENERATEFLAGS -run $GOGENERATERUN ${SOURCE.abspath}'
+    env['GOGENERATECOMSTR'] = '$GOGENERATECOM'
+
 
 
     # import SCons.Tool
@@ -579,3 +4404,8 @@ def generate(env):
 def exists(env):
     print('GOBUILDER exists')
     return env.Detect("go") or env.Detect("gnugo")
+
+
+if _previous_load is not None:
+    globals().update(_previous_load)
+_loaded = True
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+"""
+Benchmarks for GoBuilder's scanner, build tag evaluation and tool startup.
+
+Generates a synthetic GOPATH (packages x files per package x import fan-out x
+build tag density) and times each phase in a fresh python process:
+
+    tool_load         import the tool and run generate()
+    full_scan         scan the program's dependency tree with no scan cache
+    noop_scan         scan again with the scan cache and nothing changed
+    incremental_scan  scan again after changing one file
+    tag_filter        evaluate file names and build constraints for every file
+    scan_memory       size of the scan results kept on the nodes after a scan, and the
+                      process's peak resident memory
+
+Run from the directory containing the GoBuilder checkout, with SCons on the path:
+
+    PYTHONPATH=$SCONS_LIB_DIR python GoBuilder/misc/benchmark.py -o before.json
+    PYTHONPATH=$SCONS_LIB_DIR python GoBuilder/misc/benchmark.py --compare before.json
+
+Results are written as JSON. The toolchain isn't run unless --go is given, so
+the timings only cover GoBuilder itself.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+TOOL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PHASES = ['tool_load', 'full_scan', 'noop_scan', 'incremental_scan', 'tag_filter', 'scan_memory']
+
+# (build constraint line, included for linux/amd64 without extra tags)
+CONSTRAINTS = [
+    ('//go:build linux', True),
+    ('//go:build !windows && amd64', True),
+    ('// +build linux,amd64 darwin', True),
+    ('//go:build (linux || darwin) && !bench_disabled', True),
+    ('//go:build windows', False),
+    ('// +build ignore', False),
+]
+
+
+def package_name(i):
+    return 'p%03d' % i
+
+
+def generate_tree(root, packages, files, fanout, tag_density, body_lines, seed=1):
+    """
+    Write the synthetic GOPATH below root. Package i imports packages i+1 .. i+fanout,
+    and the main package imports the first fanout packages.
+    :return: dict describing the tree
+    """
+    rnd = random.Random(seed)
+    counts = {'packages': packages, 'files': 0, 'constrained_files': 0, 'excluded_files': 0}
+    body = ''.join('var v%d = %d\n' % (n, n) for n in range(body_lines))
+
+    def write(path, constraint, imports, decl):
+        lines = []
+        if constraint:
+            lines.extend(['// Code generated for benchmarking.', constraint, ''])
+        lines.append('package %s' % os.path.basename(os.path.dirname(path)))
+        lines.append('')
+        lines.append('import (')
+        lines.extend(['\t"%s"' % p for p in imports])
+        lines.append(')')
+        lines.append('')
+        lines.extend('var _ = %s.F' % p.split('/')[-1] for p in imports if p.startswith('bench/'))
+        lines.append('var _ = fmt.Sprint')
+        lines.append(decl)
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n' + body)
+        counts['files'] += 1
+
+    for i in range(packages):
+        pkg_dir = os.path.join(root, 'src', 'bench', package_name(i))
+        os.makedirs(pkg_dir)
+        imports = ['fmt'] + ['bench/%s' % package_name(d) for d in range(i + 1, min(i + 1 + fanout, packages))]
+        for j in range(files):
+            name = 'f%03d.go' % j
+            constraint = None
+            # f000 declares F and is always built
+            if j and rnd.random() < tag_density:
+                counts['constrained_files'] += 1
+                choice = rnd.randrange(len(CONSTRAINTS) + 1)
+                if choice == len(CONSTRAINTS):
+                    name = 'f%03d_windows.go' % j
+                    counts['excluded_files'] += 1
+                else:
+                    (constraint, included) = CONSTRAINTS[choice]
+                    if not included:
+                        counts['excluded_files'] += 1
+            write(os.path.join(pkg_dir, name), constraint, imports,
+                  'func F() {}' if j == 0 else 'func f%03d() {}' % j)
+
+    main_dir = os.path.join(root, 'src', 'bench', 'main')
+    os.makedirs(main_dir)
+    write(os.path.join(main_dir, 'main.go'), None,
+          ['fmt'] + ['bench/%s' % package_name(d) for d in range(min(fanout, packages))],
+          'func main() {}')
+
+    # Files modified within the last couple of seconds are always checked by content,
+    # which isn't what happens in a real tree
+    age_tree(root)
+    return counts
+
+
+def age_tree(root, age=3600):
+    then = time.time() - age
+    for (dirpath, dirnames, filenames) in os.walk(os.path.join(root, 'src')):
+        for name in filenames:
+            os.utime(os.path.join(dirpath, name), (then, then))
+
+
+def touch_file(root, packages):
+    """Change one file of a package in the middle of the import graph"""
+    path = os.path.join(root, 'src', 'bench', package_name(packages // 2), 'f000.go')
+    with open(path, 'a') as f:
+        f.write('// changed %f\n' % time.time())
+    then = time.time() - 60
+    os.utime(path, (then, then))
+
+
+def _load_tool(args, timings):
+    import SCons.Environment
+
+    env = SCons.Environment.Environment(tools=[], ENV=dict(os.environ),
+                                        GOPATH=[args.tree], GOOS='linux', GOARCH='amd64', GOTAGS=[])
+    if not args.go:
+        env['GO_SYSTEM_PACKAGES'] = frozenset(['fmt', 'C'])
+        env['GOHOSTOS'] = 'linux'
+        env['GOHOSTARCH'] = 'amd64'
+        env['GOVERSION'] = 'go1.21'
+        env['CGO_ENABLED'] = '1'
+
+    start = time.time()
+    sys.path.insert(0, os.path.dirname(TOOL_DIR))
+    tool = __import__(os.path.basename(TOOL_DIR))
+    tool.generate(env)
+    timings['tool_load'] = time.time() - start
+    return (env, tool)
+
+
+def _walk(node, seen, counts):
+    for child in node.children():
+        if child in seen:
+            continue
+        seen.add(child)
+        if str(child).startswith('go-package:'):
+            counts['package_nodes'] += 1
+        else:
+            counts['file_nodes'] += 1
+        _walk(child, seen, counts)
+
+
+def _tree_files(env, root):
+    files = []
+    for (dirpath, dirnames, filenames) in os.walk(os.path.join(root, 'src')):
+        files.extend(env.File(os.path.join(dirpath, n)) for n in filenames if n.endswith('.go'))
+    return files
+
+
+def _deep_size(obj, seen):
+    """Size of obj and everything it refers to, counting shared objects once"""
+    import SCons.Node
+
+    if id(obj) in seen or isinstance(obj, SCons.Node.Node):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        children = list(obj.keys()) + list(obj.values())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        children = obj
+    else:
+        children = [getattr(obj, name) for name in getattr(type(obj), '__slots__', ()) if hasattr(obj, name)]
+        children.extend(getattr(obj, '__dict__', {}).values())
+    for child in children:
+        size += _deep_size(child, seen)
+    return size
+
+
+def scan_metadata_size(files):
+    """Bytes used by the go_* attributes the scanner keeps on files"""
+    seen = set()
+    size = 0
+    for f in files:
+        attributes = vars(f.attributes)
+        size += sys.getsizeof(attributes)
+        for (name, value) in attributes.items():
+            if name.startswith('go_'):
+                size += _deep_size(name, seen) + _deep_size(value, seen)
+    return size
+
+
+def run_phase(args):
+    """Run a single phase in this process and print its timing as JSON"""
+    os.chdir(args.tree)
+    timings = {}
+    (env, tool) = _load_tool(args, timings)
+    result = {'seconds': timings['tool_load']}
+
+    if args.phase == 'scan_memory':
+        import resource
+
+        program = env.goProgram('bench', ['src/bench/main/main.go'])[0]
+        start = time.time()
+        program.scan()
+        result['seconds'] = time.time() - start
+        result['metadata_bytes'] = scan_metadata_size(_tree_files(env, args.tree))
+        result['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    elif args.phase in ('full_scan', 'noop_scan', 'incremental_scan'):
+        program = env.goProgram('bench', ['src/bench/main/main.go'])[0]
+        start = time.time()
+        program.scan()
+        tool._save_scan_caches()
+        result['seconds'] = time.time() - start
+        counts = {'package_nodes': 0, 'file_nodes': 0}
+        _walk(program, set(), counts)
+        result.update(counts)
+        stats = tool.scan_cache_stats()
+        if stats:
+            result['scan_cache'] = stats
+    elif args.phase == 'tag_filter':
+        files = _tree_files(env, args.tree)
+        for f in files:
+            tool.scan_go_file(env, f)
+        start = time.time()
+        included = [f for f in files if tool.include_go_file(env, f)]
+        result['seconds'] = time.time() - start
+        result['files'] = len(files)
+        result['included_files'] = len(included)
+
+    print(json.dumps(result))
+
+
+def _child(args, phase):
+    command = [sys.executable, os.path.abspath(__file__), '--phase', phase, '--tree', args.tree]
+    if args.go:
+        command.append('--go')
+    output = subprocess.check_output(command)
+    if not isinstance(output, str):
+        output = output.decode('utf-8')
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def _revision():
+    try:
+        output = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=TOOL_DIR,
+                                         stderr=open(os.devnull, 'w'))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if not isinstance(output, str):
+        output = output.decode('utf-8')
+    return output.strip()
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_benchmarks(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='gobuilder-bench-')
+    args.tree = os.path.join(workdir, 'gopath')
+    if os.path.exists(args.tree):
+        shutil.rmtree(args.tree)
+    cache = os.path.join(args.tree, '.sconsign_goscan')
+
+    try:
+        tree = generate_tree(args.tree, args.packages, args.files, args.fanout, args.tag_density,
+                             args.body_lines)
+        phases = {}
+        for phase in args.phases:
+            runs = []
+            for n in range(args.repeat):
+                if phase == 'full_scan' and os.path.exists(cache):
+                    os.unlink(cache)
+                elif phase in ('noop_scan', 'incremental_scan', 'scan_memory') and not os.path.exists(cache):
+                    _child(args, 'full_scan')
+                if phase == 'incremental_scan':
+                    touch_file(args.tree, args.packages)
+                runs.append(_child(args, phase))
+            times = [r.pop('seconds') for r in runs]
+            phases[phase] = dict(runs[-1], times=times, min=min(times), median=_median(times))
+            print('%-17s min %8.3fs  median %8.3fs' % (phase, min(times), _median(times)), file=sys.stderr)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    return {
+        'revision': _revision(),
+        'python': sys.version.split()[0],
+        'parameters': {
+            'packages': args.packages,
+            'files': args.files,
+            'fanout': args.fanout,
+            'tag_density': args.tag_density,
+            'body_lines': args.body_lines,
+            'repeat': args.repeat,
+            'go': args.go,
+        },
+        'tree': tree,
+        'phases': phases,
+    }
+
+
+def compare(baseline, results):
+    """Print the change in the median time of each phase relative to baseline"""
+    print('%-17s %10s %10s %8s' % ('phase', 'baseline', 'current', 'ratio'), file=sys.stderr)
+    for phase in PHASES:
+        if phase not in baseline['phases'] or phase not in results['phases']:
+            continue
+        old = baseline['phases'][phase]['median']
+        new = results['phases'][phase]['median']
+        print('%-17s %9.3fs %9.3fs %7.2fx' % (phase, old, new, new / old if old else float('inf')),
+              file=sys.stderr)
+        for key in ('metadata_bytes', 'max_rss_kb'):
+            if key in baseline['phases'][phase] and key in results['phases'][phase]:
+                old = baseline['phases'][phase][key]
+                new = results['phases'][phase][key]
+                print('  %-15s %10d %10d %7.2fx' % (key, old, new, float(new) / old if old else float('inf')),
+                      file=sys.stderr)
+    if baseline.get('parameters') != results.get('parameters'):
+        print('warning: benchmark parameters differ from the baseline', file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--packages', type=int, default=200, help='number of packages (default 200)')
+    parser.add_argument('--files', type=int, default=10, help='go files per package (default 10)')
+    parser.add_argument('--fanout', type=int, default=5, help='packages imported by each package (default 5)')
+    parser.add_argument('--tag-density', type=float, default=0.2,
+                        help='fraction of files with build constraints (default 0.2)')
+    parser.add_argument('--body-lines', type=int, default=50,
+                        help='lines of code after the imports in each file (default 50)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each phase (default 3)')
+    parser.add_argument('--phases', default=','.join(PHASES),
+                        help='comma separated phases to run (default all)')
+    parser.add_argument('--go', action='store_true', help='use the go toolchain for system packages')
+    parser.add_argument('--workdir', help='generate the tree here and keep it (default a temporary directory)')
+    parser.add_argument('-o', '--output', help='write the JSON results here (default stdout)')
+    parser.add_argument('--compare', metavar='BASELINE', help='JSON results to compare against')
+    parser.add_argument('--phase', help=argparse.SUPPRESS)
+    parser.add_argument('--tree', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.phase:
+        run_phase(args)
+        return 0
+
+    args.phases = [p for p in args.phases.split(',') if p]
+    unknown = set(args.phases) - set(PHASES)
+    if unknown:
+        parser.error('unknown phases: %s' % ', '.join(sorted(unknown)))
+
+    results = run_benchmarks(args)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Rebuild go targets whenever a go file changes, through a long running scons --interactive.
+
+scons keeps the tool loaded, the toolchain probed and the scanned package graph in
+memory between builds, and with GO_WATCH=1 in its environment invalidates only the
+package index entries and package nodes affected by each change (see GoBuilder's
+GoWatcher and go_invalidate). This script watches the same files and asks for a build
+once a burst of changes has settled, printing the time from the change to the end of
+the build.
+
+Run from the top of the SCons project, with SCons on the path:
+
+    PYTHONPATH=$SCONS_LIB_DIR python GoBuilder/misc/gowatch.py app -- -j8
+
+Targets (default: scons' defaults) are built after each change; arguments after --
+are passed to scons.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+
+TOOL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROMPT = b'scons>>> '
+
+
+class InteractiveSCons(object):
+    """
+    A scons --interactive process, whose output is copied to stdout while watching for
+    the prompt it prints when ready for the next command
+    """
+
+    def __init__(self, cmd, env):
+        self.proc = subprocess.Popen(cmd, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.ready = threading.Event()
+        self._thread = threading.Thread(target=self._copy_output)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _copy_output(self):
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        tail = b''
+        while True:
+            data = os.read(self.proc.stdout.fileno(), 4096)
+            if not data:
+                self.ready.set()
+                return
+            out.write(data)
+            out.flush()
+            tail = (tail + data)[-len(PROMPT):]
+            if tail == PROMPT:
+                self.ready.set()
+
+    def run(self, command):
+        """
+        Send command and wait until scons is ready for the next one
+        :return: False if scons has exited
+        """
+        self.ready.wait()
+        if self.proc.poll() is not None:
+            return False
+        self.ready.clear()
+        self.proc.stdin.write((command + '\n').encode('utf-8'))
+        self.proc.stdin.flush()
+        self.ready.wait()
+        return self.proc.poll() is None
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    scons_args = []
+    if '--' in argv:
+        scons_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('targets', nargs='*', help='targets to build after each change')
+    parser.add_argument('--scons', default='scons', help='scons command (default scons)')
+    parser.add_argument('--root', action='append', dest='roots',
+                        help='directory to watch, may be repeated (default . and $GOPATH/src)')
+    parser.add_argument('--interval', type=float, default=0.2,
+                        help='polling interval in seconds without pyinotify (default 0.2)')
+    parser.add_argument('--settle', type=float, default=0.05,
+                        help='quiet time in seconds before building (default 0.05)')
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.dirname(TOOL_DIR))
+    GoBuilder = __import__(os.path.basename(TOOL_DIR))
+
+    roots = [os.path.abspath(r) for r in args.roots or ['.']]
+    if not args.roots:
+        roots.extend(os.path.join(p, 'src') for p in os.environ.get('GOPATH', '').split(os.pathsep) if p)
+    watcher = GoBuilder.GoWatcher(roots, args.interval)
+
+    env = dict(os.environ)
+    env['GO_WATCH'] = '1'
+    env['GO_WATCH_INTERVAL'] = str(args.interval)
+    scons = InteractiveSCons(args.scons.split() + ['--interactive'] + scons_args, env)
+    command = ' '.join(['build'] + args.targets)
+
+    try:
+        if not scons.run(command):
+            return 1
+        while True:
+            changed = watcher.changes(None)
+            start = time.time()
+            # Wait for editors and generators to finish writing
+            more = watcher.changes(args.settle)
+            while more:
+                changed |= more
+                more = watcher.changes(args.settle)
+            print('gowatch: %d changed, %s' % (len(changed), ', '.join(sorted(changed)[:3])))
+            if not scons.run(command):
+                return 1
+            print('gowatch: rebuilt in %.3fs' % (time.time() - start))
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        watcher.close()
+        scons.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())